@@ -2,11 +2,18 @@
 # encoding: utf-8
 
 import collections
+import copy
 import functools
+import threading
+import time
+import uuid
 
 from django import http
+from django.conf import settings
 from django.contrib import auth
 from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _
 from django.utils.encoding import force_bytes
@@ -57,16 +64,104 @@ def get_api_key_for_user(user):
     ))
 
 
+# Verified API keys, mapped to `(user, version, expiry)`, least recently used
+# first. The automations which call the API use the same key over and over, so
+# this saves unsigning the key and fetching the user on almost every request.
+# It is per-process, so each hit is checked against the user's version in the
+# shared cache (one cache get), which is dropped whenever the User is saved or
+# deleted. Without a SHARED_CACHE, other processes don't see the version being
+# dropped, so API_KEY_CACHE_TIMEOUT is only a few seconds.
+_verified_keys = collections.OrderedDict()
+_verified_keys_lock = threading.Lock()
+
+
+def _version_key(user_id):
+    return 'api-key:version:%i' % user_id
+
+
+def _get_version(user_id):
+    """Returns the user's current version, starting a new one if needed"""
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def _get_cached_user(key):
+    with _verified_keys_lock:
+        cached = _verified_keys.get(key)
+        if cached is None:
+            return None
+        user, version, expiry = cached
+        if expiry <= time.time():
+            del _verified_keys[key]
+            return None
+        _verified_keys.move_to_end(key)
+    if cache.get(_version_key(user.id)) != version:
+        with _verified_keys_lock:
+            if _verified_keys.get(key) is cached:
+                del _verified_keys[key]
+        return None
+    # Views are free to modify `request.user`, so each gets its own copy.
+    return copy.copy(user)
+
+
+def _cache_user(key, user, version):
+    with _verified_keys_lock:
+        expiry = time.time() + settings.API_KEY_CACHE_TIMEOUT
+        _verified_keys[key] = (copy.copy(user), version, expiry)
+        _verified_keys.move_to_end(key)
+        while len(_verified_keys) > settings.API_KEY_CACHE_SIZE:
+            _verified_keys.popitem(last=False)
+
+
+def clear_api_key_cache(user_id=None):
+    """Forgets verified API keys, either all of them or just `user_id`'s
+
+    Clearing a user's keys drops their version, so other processes forget
+    them too.
+    """
+    with _verified_keys_lock:
+        if user_id is None:
+            _verified_keys.clear()
+            return
+        for key, (user, version, expiry) in list(_verified_keys.items()):
+            if user.id == user_id:
+                del _verified_keys[key]
+    cache.delete(_version_key(user_id))
+
+
+def user_changed(sender, instance, **kwargs):
+    """Receives `post_save`/`post_delete` for Users, see `apps.WorkaholicConfig`"""
+    # The user's password (and so their salt) may have changed. The version is
+    # dropped again once that commits, in case another process cached the old
+    # User under a new version meanwhile.
+    clear_api_key_cache(instance.id)
+    key = _version_key(instance.id)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
 def get_user_for_api_key(key):
+    user = _get_cached_user(key)
+    if user is not None:
+        return user
+
     try:
         json = _unsign(key)
     except signing.BadSignature:
         raise BadApiKeySignature
+    # Read before the User, so that a save in between leaves the key stale
+    # rather than caching an old User under the new version.
+    version = _get_version(json['user'])
     user = auth.models.User.objects.get(id=json['user'])
 
     if _get_password_salt(user) != json['salt']:
         raise ExpiredApiKey
 
+    if version is not None:
+        _cache_user(key, user, version)
     return user
 
 
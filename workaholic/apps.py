@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from django.apps import AppConfig
+from django.contrib import auth
+from django.db.models import signals
+
+
+class WorkaholicConfig(AppConfig):
+    name = 'workaholic'
+
+    def ready(self):
+        # Connected here rather than where they're defined, so that they're
+        # connected in every process (e.g. `manage.py shell`), not just those
+        # which happen to import the module.
+        from . import api
+        signals.post_save.connect(
+            api.user_changed, sender=auth.models.User, dispatch_uid='api_key_user_saved'
+        )
+        signals.post_delete.connect(
+            api.user_changed, sender=auth.models.User, dispatch_uid='api_key_user_deleted'
+        )
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import collections
+import datetime
+import logging
+import struct
+import zlib
+
+from django.utils import timezone
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# PeriodArchive.data is zlib compressed little-endian int64s: the start of each
+# Period, as microseconds since the epoch, delta-encoded from the previous
+# start, followed by each Period's duration in microseconds. Periods are
+# ordered by start. Deltas and durations are small and repetitive, so they
+# compress well.
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def pack(periods):
+    """Packs `(start, end)` pairs into PeriodArchive.data"""
+    periods = sorted(periods)
+    deltas, durations = [], []
+    previous = 0
+    for start, end in periods:
+        start_us = _microseconds(start - _EPOCH)
+        deltas.append(start_us - previous)
+        durations.append(_microseconds(end - start))
+        previous = start_us
+    values = deltas + durations
+    return zlib.compress(struct.pack('<%iq' % len(values), *values))
+
+
+def unpack(data):
+    """Unpacks PeriodArchive.data into a list of `(start, end)`, by start"""
+    raw = zlib.decompress(bytes(data))
+    values = struct.unpack('<%iq' % (len(raw) // 8), raw)
+    count = len(values) // 2
+    periods = []
+    start_us = 0
+    for delta, duration in zip(values[:count], values[count:]):
+        start_us += delta
+        start = _EPOCH + datetime.timedelta(microseconds=start_us)
+        periods.append((start, start + datetime.timedelta(microseconds=duration)))
+    return periods
+
+
+def month_of(value):
+    return value.astimezone(timezone.utc).date().replace(day=1)
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def horizon(user_id):
+    """When the user's unarchived history begins, or None if they have no archive
+
+    Everything before this is in PeriodArchives.
+    """
+    latest = (
+        models.PeriodArchive.objects
+            .filter(user_id=user_id)
+            .order_by('-month')
+            .values_list('month', flat=True)
+            .first()
+    )
+    if latest is None:
+        return None
+    return datetime.datetime.combine(next_month(latest), datetime.time(tzinfo=timezone.utc))
+
+
+def iter_periods(user_ids, start=None, end=None):
+    """Yields `(user_id, start, end)` for archived Periods, by user then start
+
+    With `start`/`end`, only Periods which started in [start, end). Only the
+    archive rows for the months in question are read.
+    """
+    archives = models.PeriodArchive.objects.filter(user_id__in=user_ids)
+    if start is not None:
+        archives = archives.filter(month__gte=month_of(start))
+    if end is not None:
+        archives = archives.filter(month__lte=month_of(end))
+    archives = archives.order_by('user_id', 'month').values_list('user_id', 'data')
+    for user_id, data in archives.iterator():
+        for period_start, period_end in unpack(data):
+            if start is not None and period_start < start:
+                continue
+            if end is not None and period_start >= end:
+                continue
+            yield user_id, period_start, period_end
+
+
+def archive_users(user_ids, before, dry_run=False):
+    """Moves the users' ended Periods which started before `before` to archives
+
+    `before` should be the start of a month. Periods are added to any archive
+    already held for their month. The caller should hold the users' TrackerState
+    locks (see `tracker.archive_periods()`). Returns `(users, months,
+    periods)` archived.
+    """
+    periods = (
+        models.Period.objects
+            .filter(user_id__in=user_ids, start__lt=before, end__isnull=False)
+            .order_by('user_id', 'start', 'id')
+            .values_list('user_id', 'id', 'start', 'end')
+            .iterator()
+    )
+    months = collections.OrderedDict()
+    ids = []
+    for user_id, id, start, end in periods:
+        months.setdefault((user_id, month_of(start)), []).append((start, end))
+        ids.append(id)
+    stats = len(set(user_id for user_id, _ in months)), len(months), len(ids)
+    if dry_run or not ids:
+        return stats
+
+    # Only the archives for the months being written are read: filtering on
+    # users and months separately may match a few others, which are ignored.
+    existing = {}
+    archives = models.PeriodArchive.objects.filter(
+        user_id__in=set(user_id for user_id, _ in months),
+        month__in=set(month for _, month in months),
+    )
+    for archive in archives:
+        key = (archive.user_id, archive.month)
+        if key in months:
+            existing[key] = archive
+    created = []
+    for (user_id, month), month_periods in months.items():
+        archive = existing.get((user_id, month))
+        if archive is None:
+            created.append(models.PeriodArchive(
+                user_id=user_id, month=month, count=len(month_periods), data=pack(month_periods)
+            ))
+        else:
+            month_periods = unpack(archive.data) + month_periods
+            archive.count = len(month_periods)
+            archive.data = pack(month_periods)
+            archive.save(update_fields=['count', 'data'])
+    models.PeriodArchive.objects.bulk_create(created, batch_size=100)
+
+    for i in range(0, len(ids), 500):
+        models.Period.objects.filter(id__in=ids[i:i + 500]).delete()
+    return stats
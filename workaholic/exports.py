@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import csv
+import heapq
+import json
+import logging
+
+from django.conf import settings
+from django.contrib import auth
+from django.db.models import Q
+
+from . import archive, models, reports
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+class BadExportException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class _Echo:
+    """File-like object which `csv.writer` can write a line at a time to"""
+
+    def write(self, value):
+        return value
+
+
+def filter_periods(periods, tz, start_date=None, end_date=None):
+    """Periods which started in [start_date, end_date), in the time zone `tz`"""
+    if start_date is not None:
+        periods = periods.filter(start__gte=reports.local_midnight(start_date, tz))
+    if end_date is not None:
+        periods = periods.filter(start__lt=reports.local_midnight(end_date, tz))
+    return periods
+
+
+def iter_periods(periods, chunk_size=None):
+    """Yields `(id, start, end)` for `periods` in (start, id) order
+
+    Rows are read `chunk_size` at a time, each chunk picking up after the last
+    row of the previous one. Unlike `.iterator()` (which still fetches the
+    whole result into the driver) memory use doesn't grow with the number of
+    periods, and each query is a short range scan of the (user, start) index.
+    """
+    if chunk_size is None:
+        chunk_size = settings.EXPORT_CHUNK_SIZE
+
+    periods = periods.order_by('start', 'id').values_list('id', 'start', 'end')
+    chunk = list(periods[:chunk_size])
+    while chunk:
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id, last_start, _ = chunk[-1]
+        chunk = list(
+            periods
+                .filter(start__gte=last_start)
+                .filter(Q(start__gt=last_start) | Q(id__gt=last_id))[:chunk_size]
+        )
+
+
+def iter_user_periods(user_id, tz, start_date=None, end_date=None, chunk_size=None):
+    """Yields `(id, start, end)` for a user's periods, including archived ones
+
+    Archived periods no longer have an id, so it is None. Both are read in
+    start order and merged as they're read.
+    """
+    start = reports.local_midnight(start_date, tz) if start_date is not None else None
+    end = reports.local_midnight(end_date, tz) if end_date is not None else None
+    archived = (
+        (None, period_start, period_end)
+        for _, period_start, period_end in archive.iter_periods([user_id], start, end)
+    )
+    periods = filter_periods(
+        models.Period.objects.filter(user_id=user_id), tz, start_date, end_date
+    )
+    return heapq.merge(archived, iter_periods(periods, chunk_size), key=lambda row: row[1])
+
+
+def iter_all_periods(tz, start_date=None, end_date=None, chunk_size=None):
+    """Yields `(username, id, start, end)` for every user's periods"""
+    users = auth.models.User.objects.order_by('id').values_list('id', 'username')
+    for user_id, username in users.iterator():
+        for row in iter_user_periods(user_id, tz, start_date, end_date, chunk_size):
+            yield (username,) + row
+
+
+def _format_datetime(value, tz):
+    if value is None:
+        return None
+    return value.astimezone(tz).isoformat()
+
+
+def serialize(rows, fields, format, tz):
+    """Yields `rows` of `fields` as lines of CSV or JSONL
+
+    Datetimes (`start` and `end`) are written in ISO 8601, in the time zone
+    `tz`. On-going periods have an empty `end`.
+    """
+    if format not in CONTENT_TYPES:
+        raise BadExportException('Unknown format: %s' % format)
+
+    if format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(fields)
+    for row in rows:
+        row = dict(zip(fields, row))
+        for name in ('start', 'end'):
+            row[name] = _format_datetime(row[name], tz)
+        if format == 'csv':
+            yield writer.writerow([
+                '' if row[name] is None else row[name] for name in fields
+            ])
+        else:
+            yield json.dumps(row) + '\n'
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import uuid
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, like the real thing does.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        config = self.server.config
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(config.latency)
+
+        if random.random() < config.error_rate:
+            headers = {}
+            if config.retry_after is not None:
+                headers['Retry-After'] = str(config.retry_after)
+            self._respond(503, b'Unavailable', headers)
+            return
+
+        registration_ids = json.loads(body.decode('utf-8'))['registration_ids']
+        results = []
+        for registration_id in registration_ids:
+            if random.random() < config.not_registered_rate:
+                results.append(dict(error='NotRegistered'))
+            else:
+                results.append(dict(message_id='0:%s' % uuid.uuid4().hex))
+        success = sum('message_id' in result for result in results)
+        data = json.dumps(dict(
+            multicast_id=random.getrandbits(48),
+            success=success,
+            failure=len(results) - success,
+            canonical_ids=0,
+            results=results,
+        ))
+        self._respond(200, data.encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def _respond(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGcmServer(object):
+    """A local stand-in for GCM's HTTP endpoint, for testing and benchmarking
+
+    It accepts the same multicast requests as GCM and replies in the same
+    format. Each request takes `latency` seconds. A proportion `error_rate`
+    of requests fail with a 503 (and a `Retry-After` header, if `retry_after`
+    is given), and a proportion `not_registered_rate` of recipients are
+    reported as `NotRegistered`.
+
+    Use `.url` as `settings.GCM_URL` once the server has been started.
+    """
+
+    def __init__(self, latency=0, error_rate=0, not_registered_rate=0, retry_after=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.not_registered_rate = not_registered_rate
+        self.retry_after = retry_after
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%i/gcm/send' % (host, port)
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.config = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import bisect
+import collections
+import csv
+import datetime
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import dateparse, timezone
+
+import pytz
+
+from . import archive, models, rollups, tracker
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl')
+
+ImportStats = collections.namedtuple('ImportStats', ['imported', 'rejected', 'errors'])
+
+# Stands in for the end of an on-going Period when comparing.
+_FOREVER = datetime.datetime.max.replace(tzinfo=pytz.utc)
+
+
+class BadImportException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class _DryRun(Exception):
+    pass
+
+
+def decode(lines, encoding='utf-8'):
+    """Decodes an iterable of byte lines, yielding None for those which can't be
+
+    Each line is decoded on its own, so that one bad line only rejects its
+    row, rather than the rest of the file after it.
+    """
+    for line in lines:
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError:
+            yield None
+
+
+def _parse_csv(lines):
+    unreadable = set()
+
+    def readable(lines):
+        for number, line in enumerate(lines, 1):
+            if line is None:
+                # Stands in for the line, so that it still makes up a row.
+                unreadable.add(number)
+                line = '\ufffd\n'
+            yield line
+
+    reader = csv.DictReader(readable(lines))
+    for fields in reader:
+        if any(number <= reader.line_num for number in unreadable):
+            unreadable.clear()
+            fields = None
+        yield reader.line_num, fields
+
+
+def _parse_jsonl(lines):
+    for number, line in enumerate(lines, 1):
+        if line is None:
+            yield number, None
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def parse(lines, format):
+    """Yields `(line number, fields)` for each row in an iterable of lines
+
+    The lines are read as they are needed, so the whole file never has to be
+    in memory. Lines which couldn't be decoded (see `decode()`) should be
+    None. `fields` is None if the row couldn't be read.
+    """
+    if format == 'csv':
+        return _parse_csv(lines)
+    if format == 'jsonl':
+        return _parse_jsonl(lines)
+    raise BadImportException('Unknown format: %s' % format)
+
+
+def _parse_datetime(fields, name, tz):
+    value = fields.get(name)
+    try:
+        parsed = dateparse.parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise BadImportException('Expected an ISO 8601 `%s`' % name)
+    if timezone.is_naive(parsed):
+        parsed = tz.localize(parsed)
+    return parsed
+
+
+def validate(fields, tz, now):
+    """Returns `(start, end)` for a parsed row, or raises BadImportException
+
+    Times without an offset are taken to be in `tz`. Only periods which have
+    ended can be imported.
+    """
+    if not isinstance(fields, dict):
+        raise BadImportException('Could not read row')
+    start = _parse_datetime(fields, 'start', tz)
+    end = _parse_datetime(fields, 'end', tz)
+    if end <= start:
+        raise BadImportException('Period must end after it starts')
+    if end > now:
+        raise BadImportException('Period must have ended')
+    return start, end
+
+
+def _check_overlaps(user, rows):
+    """Splits a batch of `(line, start, end)` into accepted and rejected rows
+
+    Rows are rejected if they are in a month which has been archived, or
+    overlap an existing Period or an earlier row in the batch. The existing
+    Periods are fetched with one range query (`tracker.get_overlapping_periods()`)
+    covering the whole batch.
+    """
+    rows = sorted(rows, key=lambda row: row[1])
+    earliest = rows[0][1]
+    latest = max(end for _, _, end in rows)
+    existing = [
+        (period.start, period.end or _FOREVER)
+        for period in tracker.get_overlapping_periods(user, earliest, latest)
+    ]
+    existing_starts = [start for start, _ in existing]
+    # The latest end of any existing Period starting at or before each one.
+    existing_ends = []
+    for _, end in existing:
+        existing_ends.append(max(end, existing_ends[-1]) if existing_ends else end)
+
+    horizon = archive.horizon(user.id)
+
+    accepted, rejected = [], []
+    accepted_end = None
+    for line, start, end in rows:
+        i = bisect.bisect_left(existing_starts, end)
+        if horizon is not None and start < horizon:
+            rejected.append((line, 'Period is in an archived month'))
+        elif i > 0 and existing_ends[i - 1] > start:
+            rejected.append((line, 'Overlaps an existing period'))
+        elif accepted_end is not None and accepted_end > start:
+            rejected.append((line, 'Overlaps another imported period'))
+        else:
+            accepted.append((start, end))
+            accepted_end = end
+    return accepted, rejected
+
+
+def _import_batch(user, rows):
+    with transaction.atomic():
+        tracker.lock_state(user)
+        accepted, rejected = _check_overlaps(user, rows)
+        periods = [
+            models.Period(user=user, start=start, end=end)
+            for start, end in accepted
+        ]
+        models.Period.objects.bulk_create(periods)
+        models.TrackerEvent.objects.bulk_create(
+            models.TrackerEvent(user=user, kind=kind, timestamp=timestamp)
+            for start, end in accepted
+            for kind, timestamp in (
+                (models.TrackerEvent.START, start),
+                (models.TrackerEvent.END, end),
+            )
+        )
+        rollups.add_periods(periods)
+    return len(periods), rejected
+
+
+def import_periods(user, rows, tz, batch_size=None, dry_run=False, on_batch=None):
+    """Imports ended periods for `user` from `parse()`d rows
+
+    Rows are validated and inserted `batch_size` at a time, each batch in its
+    own transaction. Invalid and overlapping rows are skipped and reported
+    (up to `settings.IMPORT_MAX_ERRORS` of them) as `(line number, error)`.
+    `on_batch` is called with the running ImportStats after each batch. With
+    `dry_run`, everything is rolled back at the end.
+    """
+    if batch_size is None:
+        batch_size = settings.IMPORT_BATCH_SIZE
+
+    imported, rejected, errors = 0, 0, []
+
+    def reject(line, error):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < settings.IMPORT_MAX_ERRORS:
+            errors.append((line, error))
+
+    def flush(batch):
+        nonlocal imported
+        if batch:
+            count, overlapping = _import_batch(user, batch)
+            imported += count
+            for line, error in overlapping:
+                reject(line, error)
+        if on_batch is not None:
+            on_batch(ImportStats(imported, rejected, errors))
+
+    def run():
+        now = timezone.now()
+        batch = []
+        for line, fields in rows:
+            try:
+                start, end = validate(fields, tz, now)
+            except BadImportException as e:
+                reject(line, e.msg)
+                continue
+            batch.append((line, start, end))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        flush(batch)
+
+    if not dry_run:
+        run()
+    else:
+        # Each batch's transaction becomes a savepoint in this one.
+        try:
+            with transaction.atomic():
+                run()
+                raise _DryRun
+        except _DryRun:
+            pass
+    return ImportStats(imported, rejected, errors)
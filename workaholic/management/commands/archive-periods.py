@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ... import tracker
+
+
+class Command(BaseCommand):
+    help = 'Moves old periods into compressed monthly archives'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=settings.ARCHIVE_AFTER_MONTHS,
+            help='Keep periods from this many months before the current one')
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+            help='Only archive this user id (may be given more than once)')
+        parser.add_argument('--batch-size', type=int,
+            default=settings.TRACKER_REBUILD_BATCH_SIZE,
+            help='Users archived per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Report what would be archived, but don\'t archive it')
+
+    def handle(self, *args, **options):
+        stats = tracker.archive_periods(
+            months=options['months'],
+            user_ids=options['user_ids'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        self.stdout.write('%s %i periods from %i users into %i monthly archives' % (
+            'Would archive' if options['dry_run'] else 'Archived',
+            stats.periods, stats.users, stats.months,
+        ))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ... import tracker
+
+
+class Command(BaseCommand):
+    help = 'Merges fragmented periods and ends stray on-going ones'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gap', type=float,
+            default=settings.TRACKER_COMPACT_GAP.total_seconds(),
+            help='Merge periods which start within this many seconds of the last')
+        parser.add_argument('--close-after', type=float,
+            help='End on-going periods which have been going for this many hours')
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+            help='Only compact this user id (may be given more than once)')
+        parser.add_argument('--batch-size', type=int,
+            default=settings.TRACKER_REBUILD_BATCH_SIZE,
+            help='Users compacted per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Report what would change, but don\'t change it')
+
+    def handle(self, *args, **options):
+        close_after = None
+        if options['close_after'] is not None:
+            close_after = datetime.timedelta(hours=options['close_after'])
+        stats = tracker.compact_periods(
+            gap=datetime.timedelta(seconds=options['gap']),
+            close_after=close_after,
+            user_ids=options['user_ids'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        self.stdout.write(
+            '%s %i users: %i periods updated, %i merged away, %i on-going ended' % (
+                'Would compact' if options['dry_run'] else 'Compacted',
+                stats.users, stats.updated, stats.merged, stats.ended,
+            )
+        )
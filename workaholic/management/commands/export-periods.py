@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import exports, reports
+
+
+class Command(BaseCommand):
+    help = 'Exports every user\'s periods as CSV or JSONL'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(exports.CONTENT_TYPES), default='csv')
+        parser.add_argument('--tz', default=settings.TIME_ZONE,
+            help='Time zone of the dates and of the exported times')
+        parser.add_argument('--from', dest='start_date',
+            help='Only periods which started on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='end_date',
+            help='Only periods which started before this date (YYYY-MM-DD)')
+        parser.add_argument('--output',
+            help='File to write to, rather than stdout')
+
+    def handle(self, *args, **options):
+        try:
+            tz = reports.get_timezone(options['tz'])
+            start_date = reports.parse_date(options['start_date'])
+            end_date = reports.parse_date(options['end_date'])
+        except reports.BadReportException as e:
+            raise CommandError(e.msg)
+
+        rows = exports.iter_all_periods(tz, start_date, end_date)
+        lines = exports.serialize(rows, ['user', 'id', 'start', 'end'], options['format'], tz)
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
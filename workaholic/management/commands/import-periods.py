@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+
+from django.conf import settings
+from django.contrib import auth
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import imports, reports
+
+
+class Command(BaseCommand):
+    help = 'Imports a user\'s ended periods from CSV or JSONL'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - for stdin')
+        parser.add_argument('--user', help='Username to import for')
+        parser.add_argument('--format', choices=imports.FORMATS,
+            help='Defaults to the file\'s extension')
+        parser.add_argument('--tz', default=settings.TIME_ZONE,
+            help='Time zone of times without an offset')
+        parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE,
+            help='Periods validated and inserted per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Check the periods, but don\'t save them')
+
+    def handle(self, *args, **options):
+        if not options['user']:
+            raise CommandError('Expected --user')
+        try:
+            user = auth.models.User.objects.get(username=options['user'])
+        except auth.models.User.DoesNotExist:
+            raise CommandError('No such user: %s' % options['user'])
+        try:
+            tz = reports.get_timezone(options['tz'])
+        except reports.BadReportException as e:
+            raise CommandError(e.msg)
+        format = options['format'] or options['path'].rpartition('.')[2]
+        if format not in imports.FORMATS:
+            raise CommandError('Expected --format to be one of: %s' % ', '.join(imports.FORMATS))
+
+        if options['path'] == '-':
+            stats = self._import(sys.stdin.buffer, user, format, tz, options)
+        else:
+            with open(options['path'], 'rb') as f:
+                stats = self._import(f, user, format, tz, options)
+
+        for line, error in stats.errors:
+            self.stdout.write('Line %i: %s' % (line, error))
+        if options['dry_run']:
+            self.stdout.write('Dry run: nothing was saved')
+
+    def _import(self, f, user, format, tz, options):
+        def progress(stats):
+            self.stdout.write('Imported %i, rejected %i' % (stats.imported, stats.rejected))
+
+        return imports.import_periods(
+            user, imports.parse(imports.decode(f), format), tz,
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            on_batch=progress,
+        )
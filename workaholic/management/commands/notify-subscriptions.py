@@ -1,14 +1,74 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import datetime
+
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import translation
 
 from ... import push
 
 
+def _parse_shard(value):
+    """Parses `i/N` into a 0-based `(index, count)` tuple. `i` is 1-based."""
+    try:
+        i, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise CommandError('Expected --shard in the form i/N, e.g. 1/4')
+    if not 1 <= i <= count:
+        raise CommandError('Expected --shard i/N with 1 <= i <= N')
+    return i - 1, count
+
+
 class Command(BaseCommand):
     can_import_settings = True
 
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None,
+            help='Number of notifications to send in parallel')
+        parser.add_argument('--timeout', type=float, default=None,
+            help='Seconds to wait for each request to the push service')
+        parser.add_argument('--batch-size', type=int, default=None,
+            help='Maximum number of subscriptions to notify per request')
+        parser.add_argument('--chunk-size', type=int, default=None,
+            help='Number of subscriptions to load from the database at a time')
+        parser.add_argument('--shard', default=None,
+            help='Only notify shard i of N, given as i/N (e.g. 1/4)')
+        parser.add_argument('--resume', action='store_true',
+            help='Carry on from the checkpoint left by a recent unfinished run')
+        parser.add_argument('--overdue', action='store_true',
+            help='Only notify users who have been at work for PUSH_OVERDUE_AFTER')
+        parser.add_argument('--overdue-after', type=float, default=None, metavar='HOURS',
+            help='Only notify users who have been at work for this many hours')
+
     def handle(self, *args, **options):
-        push.notify_all_subscriptions()
+        shard = None
+        checkpoint = 'notify-subscriptions'
+        if options['shard'] is not None:
+            shard = _parse_shard(options['shard'])
+            checkpoint = 'notify-subscriptions:%i/%i' % (shard[0] + 1, shard[1])
+        overdue_after = None
+        if options['overdue_after'] is not None:
+            overdue_after = datetime.timedelta(hours=options['overdue_after'])
+        elif options['overdue']:
+            overdue_after = settings.PUSH_OVERDUE_AFTER
+        if overdue_after is not None:
+            checkpoint += ':overdue'
+
+        stats = push.notify_all_subscriptions(
+            concurrency=options['concurrency'],
+            timeout=options['timeout'],
+            batch_size=options['batch_size'],
+            chunk_size=options['chunk_size'],
+            shard=shard,
+            checkpoint=checkpoint,
+            resume=options['resume'],
+            overdue_after=overdue_after,
+        )
+        self.stdout.write('Sent %i notifications (%i failed, %i queued for retry) in %.2fs' % (
+            stats.sent, stats.failed, stats.retrying, stats.elapsed
+        ))
+        self.stdout.write('Pruned %i dead subscriptions, canonicalised %i' % (
+            stats.pruned, stats.canonicalised
+        ))
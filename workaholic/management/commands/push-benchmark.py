@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from django.conf import settings
+from django.contrib import auth
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import fakegcm, models, push
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures notify_all_subscriptions against a local fake GCM server. '
+        'This creates (and then deletes) a user and subscriptions in the '
+        'database, so only use it on a database you can spare.'
+    )
+    can_import_settings = True
+
+    BENCHMARK_USERNAME = 'push-benchmark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscriptions', type=int, default=10000,
+            help='Number of subscriptions to create and notify')
+        parser.add_argument('--latency', type=float, default=50, metavar='MS',
+            help='Time the fake server takes to handle each request')
+        parser.add_argument('--error-rate', type=float, default=0,
+            help='Proportion of requests which fail with a 503')
+        parser.add_argument('--not-registered-rate', type=float, default=0,
+            help='Proportion of recipients reported as NotRegistered')
+        parser.add_argument('--retry-after', type=int, default=None, metavar='SECONDS',
+            help='Retry-After header to send with 503s')
+        parser.add_argument('--concurrency', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--yes', action='store_true',
+            help='Confirm that the benchmark may write to this database')
+
+    def handle(self, *args, **options):
+        if not options['yes']:
+            raise CommandError(
+                'This writes to the database in settings. Pass --yes if you are sure.'
+            )
+        # Failures aren't retried, but push-worker would be competing with us.
+        if models.PushDelivery.objects.filter(status=models.PushDelivery.PENDING).exists():
+            raise CommandError('Refusing to run while the push outbox has pending deliveries')
+
+        server = fakegcm.FakeGcmServer(
+            latency=options['latency'] / 1000,
+            error_rate=options['error_rate'],
+            not_registered_rate=options['not_registered_rate'],
+            retry_after=options['retry_after'],
+        )
+        # Deleting the user cleans up after us, even if we fail part way.
+        user = auth.models.User.objects.create_user(self.BENCHMARK_USERNAME)
+        try:
+            models.PushSubscription.objects.bulk_create(
+                models.PushSubscription(user=user, identifier='benchmark-%i' % i)
+                for i in range(options['subscriptions'])
+            )
+            with server:
+                self._benchmark(user, server.url, options)
+        finally:
+            user.delete()
+
+    def _benchmark(self, user, url, options):
+        concurrency = options['concurrency'] or settings.PUSH_CONCURRENCY
+        session = push.create_session(concurrency)
+        latencies = []
+        def record_latency(resp, *args, **kwargs):
+            latencies.append(resp.elapsed.total_seconds())
+        session.hooks['response'].append(record_latency)
+        # Our subscriptions all look like GCM ones, so that's all we need.
+        provider = push.GcmProvider(
+            'gcm',
+            session=session,
+            concurrency=concurrency,
+            batch_size=options['batch_size'] or settings.GCM_BATCH_SIZE,
+            url=url,
+        )
+
+        stats = push.notify_all_subscriptions(
+            user_ids=[user.id],
+            providers=dict(gcm=provider),
+            # Retries would go to the real outbox, to be sent to the real GCM.
+            retry=False,
+        )
+
+        latencies.sort()
+        notified = stats.sent + stats.failed
+        self.stdout.write('Notified %i subscriptions in %i requests in %.2fs' % (
+            notified, len(latencies), stats.elapsed
+        ))
+        self.stdout.write('Throughput: %.1f notifications/s, %.1f requests/s' % (
+            notified / stats.elapsed, len(latencies) / stats.elapsed
+        ))
+        self.stdout.write('Request latency: p50 %.1fms, p99 %.1fms' % (
+            _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000
+        ))
+        self.stdout.write('Failed: %i (%i pruned)' % (stats.failed, stats.pruned))
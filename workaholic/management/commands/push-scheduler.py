@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ... import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Reminds users to go home once they have been at work for too long'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+            help='Remind the users who are due, then exit')
+
+    def handle(self, *args, **options):
+        while True:
+            notified = scheduler.notify_due()
+            if notified:
+                self.stdout.write('Reminded %i users' % notified)
+            if options['once']:
+                return
+            if notified < settings.PUSH_SCHEDULER_BATCH_SIZE:
+                self._sleep_until_due()
+
+    def _sleep_until_due(self):
+        # Someone may start work while we sleep, so don't sleep for too long.
+        delay = settings.PUSH_SCHEDULER_POLL_INTERVAL
+        next_due = scheduler.next_due()
+        if next_due is not None:
+            delay = min(delay, (next_due - timezone.now()).total_seconds())
+        if delay > 0:
+            time.sleep(delay)
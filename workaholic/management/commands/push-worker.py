@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ... import push
+
+
+class Command(BaseCommand):
+    help = 'Works through the outbox of push notifications which need retrying'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+            help='Process the deliveries which are due, then exit')
+
+    def handle(self, *args, **options):
+        while True:
+            attempted = push.process_outbox()
+            if attempted:
+                self.stdout.write('Attempted %i deliveries' % attempted)
+            if options['once']:
+                return
+            if attempted < settings.PUSH_OUTBOX_BATCH_SIZE:
+                self._sleep_until_due()
+
+    def _sleep_until_due(self):
+        delay = settings.PUSH_WORKER_POLL_INTERVAL
+        next_attempt = push.next_outbox_attempt()
+        if next_attempt is not None:
+            delay = min(delay, (next_attempt - timezone.now()).total_seconds())
+        if delay > 0:
+            time.sleep(delay)
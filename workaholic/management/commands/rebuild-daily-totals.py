@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ... import tracker
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily totals from periods'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+            help='Only rebuild this user id (may be given more than once)')
+        parser.add_argument('--batch-size', type=int,
+            default=settings.TRACKER_REBUILD_BATCH_SIZE,
+            help='Users rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        written = tracker.rebuild_daily_totals(
+            user_ids=options['user_ids'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write('Rebuilt %i daily totals' % written)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workaholic', '0002_period'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('last_id', models.IntegerField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Partial index over the start of on-going Periods
+
+    This keeps finding users who have been at work for too long cheap, as only
+    the few Periods which are on-going are in the index. Django can't express
+    partial indexes, so we create it ourselves. (Both SQLite and PostgreSQL
+    understand this syntax).
+    """
+
+    dependencies = [
+        ('workaholic', '0004_push_delivery'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            ['CREATE INDEX "workaholic_period_ongoing_start" '
+             'ON "workaholic_period" ("start") WHERE "end" IS NULL'],
+            ['DROP INDEX "workaholic_period_ongoing_start"'],
+        ),
+    ]
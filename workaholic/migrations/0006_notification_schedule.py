@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:37
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def schedule_ongoing_periods(apps, schema_editor):
+    """Schedules a reminder for each user's latest on-going Period
+
+    A user may still have more than one on-going Period at this point. All but
+    the latest are ended later on (see 0009_period_one_ongoing), so it's the
+    latest which they should be reminded about.
+    """
+    Period = apps.get_model('workaholic', 'Period')
+    NotificationSchedule = apps.get_model('workaholic', 'NotificationSchedule')
+    next_notify_at = {}
+    ongoing = Period.objects.filter(end=None).order_by('start', 'id')
+    for user_id, start in ongoing.values_list('user_id', 'start'):
+        next_notify_at[user_id] = start + settings.PUSH_OVERDUE_AFTER
+    NotificationSchedule.objects.bulk_create(
+        NotificationSchedule(user_id=user_id, next_notify_at=notify_at)
+        for user_id, notify_at in next_notify_at.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workaholic', '0005_period_ongoing_start_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationSchedule',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('next_notify_at', models.DateTimeField(db_index=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(schedule_ongoing_periods, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workaholic', '0006_notification_schedule'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pushsubscription',
+            name='identifier',
+            field=models.CharField(max_length=1024, unique=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workaholic', '0007_longer_identifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pushsubscription',
+            name='auth_secret',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='pushsubscription',
+            name='p256dh_key',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def end_duplicate_ongoing_periods(apps, schema_editor):
+    """Ends all but the latest on-going Period of each user
+
+    Each is ended when the next one started, as `tracker.start_period()`
+    would have done.
+    """
+    Period = apps.get_model('workaholic', 'Period')
+    ongoing = Period.objects.filter(end=None).order_by('user_id', '-start', '-id')
+    latest = None
+    for period in ongoing:
+        if latest is not None and latest.user_id == period.user_id:
+            period.end = latest.start
+            period.save(update_fields=['end'])
+        latest = period
+
+
+class Migration(migrations.Migration):
+    """Enforces that each user has at most one on-going Period
+
+    A partial unique index over `user_id` where `end IS NULL` does this, and
+    also makes looking up a user's on-going Period an index-only query.
+    Django can't express partial indexes, so we create it ourselves. (Both
+    SQLite and PostgreSQL understand this syntax).
+    """
+
+    dependencies = [
+        ('workaholic', '0008_subscription_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(end_duplicate_ongoing_periods, migrations.RunPython.noop),
+        migrations.RunSQL(
+            ['CREATE UNIQUE INDEX "workaholic_period_one_ongoing" '
+             'ON "workaholic_period" ("user_id") WHERE "end" IS NULL'],
+            ['DROP INDEX "workaholic_period_one_ongoing"'],
+        ),
+    ]
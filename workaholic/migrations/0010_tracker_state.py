@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:45
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def point_at_ongoing_periods(apps, schema_editor):
+    Period = apps.get_model('workaholic', 'Period')
+    TrackerState = apps.get_model('workaholic', 'TrackerState')
+    TrackerState.objects.bulk_create(
+        TrackerState(user_id=user_id, current_period_id=period_id)
+        for user_id, period_id in Period.objects.filter(end=None).values_list('user_id', 'id')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workaholic', '0009_period_one_ongoing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackerState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('current_period', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='workaholic.Period')),
+            ],
+        ),
+        migrations.RunPython(point_at_ongoing_periods, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:48
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def log_existing_periods(apps, schema_editor):
+    """Records a start (and end) event for each existing Period
+
+    Events are written in the order the Periods started, so that replaying the
+    log pairs them back up the same way.
+    """
+    Period = apps.get_model('workaholic', 'Period')
+    TrackerEvent = apps.get_model('workaholic', 'TrackerEvent')
+    periods = (
+        Period.objects
+            .order_by('user_id', 'start', 'id')
+            .values_list('user_id', 'start', 'end')
+            .iterator()
+    )
+    events = []
+    for user_id, start, end in periods:
+        events.append(TrackerEvent(user_id=user_id, kind='start', timestamp=start))
+        if end is not None:
+            events.append(TrackerEvent(user_id=user_id, kind='end', timestamp=end))
+        if len(events) >= 1000:
+            TrackerEvent.objects.bulk_create(events)
+            events = []
+    TrackerEvent.objects.bulk_create(events)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workaholic', '0010_tracker_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackerEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('start', 'Start'), ('end', 'End')], max_length=8)),
+                ('timestamp', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='trackerevent',
+            index_together=set([('user', 'timestamp')]),
+        ),
+        migrations.RunPython(log_existing_periods, migrations.RunPython.noop),
+    ]
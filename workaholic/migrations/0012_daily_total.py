@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:51
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+import datetime
+
+import pytz
+
+
+def split_by_day(start, end, tz):
+    """Yields `(date, seconds)` for each day in `tz` that [start, end) covers
+
+    A copy of `rollups.split_by_day()` as it was when this migration was
+    written, so that later changes to it don't change what this does.
+    """
+    start = start.astimezone(tz)
+    while True:
+        date = start.date()
+        midnight = tz.localize(datetime.datetime.combine(
+            date + datetime.timedelta(days=1), datetime.time()
+        ))
+        if end <= midnight:
+            yield date, (end - start).total_seconds()
+            return
+        yield date, (midnight - start).total_seconds()
+        start = midnight
+
+
+def total_ended_periods(apps, schema_editor):
+    Period = apps.get_model('workaholic', 'Period')
+    DailyTotal = apps.get_model('workaholic', 'DailyTotal')
+    tz = pytz.timezone(settings.TRACKER_ROLLUP_TIME_ZONE)
+    totals = {}
+    periods = Period.objects.filter(end__isnull=False).values_list('user_id', 'start', 'end')
+    for user_id, start, end in periods.iterator():
+        for date, seconds in split_by_day(start, end, tz):
+            totals[(user_id, date)] = totals.get((user_id, date), 0) + seconds
+    DailyTotal.objects.bulk_create(
+        (
+            DailyTotal(user_id=user_id, date=date, seconds=seconds)
+            for (user_id, date), seconds in totals.items()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workaholic', '0011_tracker_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('seconds', models.FloatField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailytotal',
+            unique_together=set([('user', 'date')]),
+        ),
+        migrations.RunPython(total_ended_periods, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 19:54
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Index over each user's Periods by start, for paging through history
+
+    On SQLite, Django adds an index_together by rebuilding the table, which
+    would lose our partial indexes over on-going Periods. So we create the
+    index Django would have (with the same name) ourselves.
+    """
+
+    dependencies = [
+        ('workaholic', '0012_daily_total'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    ['CREATE INDEX "workaholic_period_user_id_27362354_idx" '
+                     'ON "workaholic_period" ("user_id", "start")'],
+                    ['DROP INDEX "workaholic_period_user_id_27362354_idx"'],
+                ),
+            ],
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='period',
+                    index_together=set([('user', 'start')]),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 21:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workaholic', '0014_period_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackerevent',
+            name='superseded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -3,12 +3,83 @@
 
 from django.db import models
 from django.contrib import auth
+from django.utils import timezone
 
 
 class PushSubscription(models.Model):
     user = models.ForeignKey(auth.models.User)
 
-    identifier = models.CharField(max_length=255, unique=True)
+    # A GCM registration ID, or the endpoint URL for other push services.
+    identifier = models.CharField(max_length=1024, unique=True)
+
+    # The browser's keys for encrypting payloads (base64url encoded). These
+    # are blank for subscriptions which can't receive payloads.
+    p256dh_key = models.CharField(max_length=255, blank=True)
+    auth_secret = models.CharField(max_length=255, blank=True)
+
+
+class PushDelivery(models.Model):
+    """A notification which we failed to deliver, but which we'll try again
+
+    Deliveries are removed once they succeed. If we give up on a delivery,
+    it is kept with `status=DEAD` so that we can see what went wrong.
+    """
+    PENDING = 'pending'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DEAD, 'Dead'),
+    )
+
+    subscription = models.ForeignKey(PushSubscription)
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt')]
+
+
+class PushCheckpoint(models.Model):
+    """Records how far through the subscriptions a notification run has got
+
+    Subscriptions are notified in `id` order, so everything up to and including
+    `last_id` has been notified. This lets a crashed run resume where it left
+    off, rather than notifying everyone again.
+    """
+    name = models.CharField(max_length=255, unique=True)
+
+    last_id = models.IntegerField()
+    updated = models.DateTimeField(auto_now=True)
+
+
+class TrackerEvent(models.Model):
+    """A start/end tap, as recorded by `tracker`
+
+    This is an append-only log: rows are never deleted, and are only updated to
+    mark them `superseded` when `tracker.compact_periods()` merges the Periods
+    they made up. Periods are a projection of the events which aren't
+    superseded, so they can be rebuilt from the log if the rules for pairing
+    starts and ends change.
+    """
+    START = 'start'
+    END = 'end'
+    KIND_CHOICES = (
+        (START, 'Start'),
+        (END, 'End'),
+    )
+
+    user = models.ForeignKey(auth.models.User)
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    timestamp = models.DateTimeField()
+    superseded = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = [('user', 'timestamp')]
 
 
 class Period(models.Model):
@@ -16,3 +87,61 @@ class Period(models.Model):
 
     start = models.DateTimeField()
     end = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [('user', 'start')]
+
+
+class PeriodArchive(models.Model):
+    """A user's ended Periods which started in a month, packed and compressed
+
+    `month` is the first day of the month (in UTC). See `archive` for the
+    format of `data`.
+    """
+    user = models.ForeignKey(auth.models.User)
+
+    month = models.DateField()
+    count = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = [('user', 'month')]
+
+
+class DailyTotal(models.Model):
+    """Seconds a user worked on a date, summed from their ended Periods
+
+    Dates are in `settings.TRACKER_ROLLUP_TIME_ZONE`, and Periods which cross
+    midnight are split between the days. `tracker` adds to this as Periods end,
+    so reports can read a row per day rather than every Period.
+    """
+    user = models.ForeignKey(auth.models.User)
+
+    date = models.DateField()
+    seconds = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = [('user', 'date')]
+
+
+class TrackerState(models.Model):
+    """Denormalised pointer to each user's on-going Period
+
+    This is kept up to date by `tracker`, so that we can answer "is the user
+    at work?" from a single primary key lookup (or from the cache).
+    """
+    user = models.OneToOneField(auth.models.User, primary_key=True)
+
+    current_period = models.ForeignKey(Period, null=True, on_delete=models.SET_NULL)
+
+
+class NotificationSchedule(models.Model):
+    """When we should next remind a user to go home
+
+    `next_notify_at` is set when the user starts a Period and cleared when
+    they end it. It is indexed so that the scheduler can cheaply find the
+    users who are due a notification.
+    """
+    user = models.OneToOneField(auth.models.User, primary_key=True)
+
+    next_notify_at = models.DateTimeField(null=True, db_index=True)
@@ -1,13 +1,29 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import collections
+import concurrent.futures
+import datetime
+import email.utils
+import functools
+import itertools
 import json
+import logging
+import queue
+import time
+import urllib.parse
 
 from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, CharField, F, Value, When
+from django.utils import timezone
 
 import requests
+import requests.adapters
 
-from . import models
+from . import models, webpush
+
+logger = logging.getLogger(__name__)
 
 
 class BadIdentifierException(Exception):
@@ -15,29 +31,848 @@ class BadIdentifierException(Exception):
         self.msg = msg
 
 
+NotifyStats = collections.namedtuple('NotifyStats', [
+    'sent', 'failed', 'retrying', 'pruned', 'canonicalised', 'elapsed'
+])
+
+
+# Errors GCM gives for registration IDs which will never work again.
+DEAD_REGISTRATION_ERRORS = ('NotRegistered', 'InvalidRegistration')
+# Errors GCM gives when we should try again later.
+RETRYABLE_ERRORS = ('Unavailable', 'InternalServerError', 'DeviceMessageRateExceeded')
+
+# Max number of IDs we put in a single `IN (...)` clause. SQLite won't accept
+# more than 999 parameters in a query.
+_MAX_STATEMENT_IDS = 500
+
+
+def _origin(url):
+    parts = urllib.parse.urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+def get_provider_name(identifier):
+    """Returns the name of the entry in `settings.PUSH_PROVIDERS` for a subscription
+
+    GCM subscriptions are stored as bare registration IDs. All other
+    subscriptions are stored as their full endpoint URL, and the provider
+    is picked by the endpoint's origin. Returns None if we don't know of a
+    provider for the subscription.
+    """
+    is_url = '://' in identifier
+    origin = _origin(identifier) if is_url else None
+    for name, config in settings.PUSH_PROVIDERS.items():
+        if config['backend'] == 'gcm' and not is_url:
+            return name
+        if is_url and origin in config.get('origins', ()):
+            return name
+    return None
+
+
 def normalize_identifier(identifier):
     """Takes an Push Subscription identifier from the browser and normalizes it.
 
     Google Chrome will give a GCM URL. We want to strip the generic part away,
-    leaving just the identifier. If we don't get a GCM URL, raise an exception -
-    we don't support talking to other Push services.
+    leaving just the identifier. Other browsers give a Web Push endpoint, which
+    we keep as it is, provided it belongs to one of `settings.PUSH_PROVIDERS`.
+    If we don't recognise the push service, raise an exception - we don't want
+    to send requests to arbitrary URLs.
+    """
+    if identifier.startswith(settings.GCM_CHROME_IDENTIFIER_URL):
+        return identifier[len(settings.GCM_CHROME_IDENTIFIER_URL):]
+    if not identifier.startswith('https://') or get_provider_name(identifier) is None:
+        raise BadIdentifierException('Unsupported push service. Are you using Chrome or Firefox?')
+    return identifier
+
+
+def _supports_upsert():
+    """Whether the database understands `INSERT ... ON CONFLICT`
+
+    PostgreSQL has since 9.5, and SQLite since 3.24.
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def _update_or_create_subscriptions(user, batch):
+    """`upsert_subscriptions()` for databases without `ON CONFLICT`
+
+    Changed subscriptions are updated in place, and new ones inserted together
+    in a savepoint. If a concurrent request inserted one of them first, we
+    fall back to writing them one at a time.
     """
-    if not identifier.startswith(settings.GCM_CHROME_IDENTIFIER_URL):
-        raise BadIdentifierException('Expected Google Cloud Messaging push subscription. Are you using Chrome?')
-    return identifier[len(settings.GCM_CHROME_IDENTIFIER_URL):]
+    with transaction.atomic():
+        stored = {
+            identifier: (user_id, p256dh_key, auth_secret)
+            for identifier, user_id, p256dh_key, auth_secret in
+            models.PushSubscription.objects
+                .filter(identifier__in=[identifier for identifier, _, _ in batch])
+                .values_list('identifier', 'user_id', 'p256dh_key', 'auth_secret')
+        }
+        created = []
+        for identifier, p256dh_key, auth_secret in batch:
+            if identifier not in stored:
+                created.append(models.PushSubscription(
+                    user=user, identifier=identifier,
+                    p256dh_key=p256dh_key, auth_secret=auth_secret,
+                ))
+            elif stored[identifier] != (user.id, p256dh_key, auth_secret):
+                models.PushSubscription.objects.filter(identifier=identifier).update(
+                    user=user, p256dh_key=p256dh_key, auth_secret=auth_secret
+                )
+        if not created:
+            return
+        try:
+            with transaction.atomic():
+                models.PushSubscription.objects.bulk_create(created)
+        except IntegrityError:
+            for subscription in created:
+                models.PushSubscription.objects.update_or_create(
+                    identifier=subscription.identifier,
+                    defaults=dict(
+                        user=user,
+                        p256dh_key=subscription.p256dh_key,
+                        auth_secret=subscription.auth_secret,
+                    )
+                )
+
+
+def upsert_subscriptions(user, subscriptions):
+    """Creates or updates subscriptions for `user`, in a single atomic statement
+
+    `subscriptions` is a list of `(identifier, p256dh_key, auth_secret)`.
+
+    `get_or_create()` can race with a concurrent request for the same
+    `identifier` and fail the unique constraint. `INSERT ... ON CONFLICT`
+    can't. Subscriptions which are unchanged aren't written. Databases which
+    don't understand `ON CONFLICT` (e.g. SQLite before 3.24) use
+    `_update_or_create_subscriptions()` instead.
+    """
+    if not _supports_upsert():
+        for batch in _chunked(subscriptions, _MAX_STATEMENT_IDS):
+            _update_or_create_subscriptions(user, batch)
+        return
+
+    table = connection.ops.quote_name(models.PushSubscription._meta.db_table)
+    # Four parameters per row, and SQLite won't take more than 999.
+    for batch in _chunked(subscriptions, _MAX_STATEMENT_IDS // 4):
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+        params = []
+        for identifier, p256dh_key, auth_secret in batch:
+            params.extend([user.id, identifier, p256dh_key, auth_secret])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} AS t (user_id, identifier, p256dh_key, auth_secret) '
+                'VALUES {values} '
+                'ON CONFLICT (identifier) DO UPDATE SET '
+                'user_id = excluded.user_id, '
+                'p256dh_key = excluded.p256dh_key, '
+                'auth_secret = excluded.auth_secret '
+                'WHERE t.user_id <> excluded.user_id '
+                'OR t.p256dh_key <> excluded.p256dh_key '
+                'OR t.auth_secret <> excluded.auth_secret'.format(table=table, values=values),
+                params
+            )
+
+
+def upsert_subscription(user, identifier, p256dh_key='', auth_secret=''):
+    """Creates or updates a single subscription. See `upsert_subscriptions()`."""
+    upsert_subscriptions(user, [(identifier, p256dh_key, auth_secret)])
+
+
+def sync_subscriptions(user, subscriptions):
+    """Makes `user`'s stored subscriptions match `subscriptions`
+
+    `subscriptions` is the user's full list of `(identifier, p256dh_key,
+    auth_secret)`. We work out what has changed against what we have stored,
+    then apply it with one insert and one delete, in one transaction.
+
+    Returns `(changed, removed)` counts.
+    """
+    wanted = {identifier: (identifier, p256dh_key, auth_secret)
+              for identifier, p256dh_key, auth_secret in subscriptions}
+    with transaction.atomic():
+        stored = {
+            identifier: (identifier, p256dh_key, auth_secret)
+            for identifier, p256dh_key, auth_secret in
+            models.PushSubscription.objects
+                .filter(user=user)
+                .values_list('identifier', 'p256dh_key', 'auth_secret')
+        }
+        changed = [row for identifier, row in wanted.items() if stored.get(identifier) != row]
+        removed = len(stored.keys() - wanted.keys())
+        if removed:
+            models.PushSubscription.objects.filter(user=user).exclude(identifier__in=wanted).delete()
+        if changed:
+            upsert_subscriptions(user, changed)
+    return len(changed), removed
+
+
+def create_session(pool_size):
+    """Creates a `requests.Session` which keeps up to `pool_size` connections alive
+
+    Sharing one session between all of the requests in a run means we only
+    pay for the TCP/TLS handshake once per connection, rather than once per
+    notification.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def notify_subscription(subscription, session=requests, timeout=None):
+    """Notifies a single subscription. Returns its GCM result dict."""
+    [(_, result)] = notify_subscriptions([subscription], session=session, timeout=timeout)
+    return result
 
 
-def notify_subscription(subscription):
+def notify_subscriptions(subscriptions, session=requests, timeout=None, url=None):
+    """Notifies a batch of subscriptions with a single GCM multicast request
+
+    GCM accepts up to 1000 `registration_ids` per request. It replies with a
+    `results` array in the same order as the `registration_ids`, so we return
+    a list of `(subscription, result)` pairs. Each `result` is a dict which
+    will contain `message_id` on success, or `error` on failure. If GCM asked
+    us to back off with a `Retry-After` header, it is copied into the failed
+    results as `retry_after`. The request is sent to `url`, which defaults to
+    `settings.GCM_URL`.
+    """
     headers = {
         'Authorization': 'key=%s' % settings.GCM_API_KEY,
         'Content-Type': 'application/json'
     }
-    data = json.dumps(dict(to=subscription.identifier))
-    resp = requests.post(settings.GCM_URL, headers=headers, data=data)
+    data = json.dumps(dict(
+        registration_ids=[subscription.identifier for subscription in subscriptions]
+    ))
+    resp = session.post(url or settings.GCM_URL, headers=headers, data=data, timeout=timeout)
     resp.raise_for_status()
-    # TODO: Handle NotRegistered, which means we need to remove the subscription.
+    results = resp.json()['results']
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is not None:
+        for result in results:
+            if result.get('error') in RETRYABLE_ERRORS:
+                result['retry_after'] = retry_after
+    return list(zip(subscriptions, results))
+
+
+def build_payloads(subscriptions):
+    """Returns the payload to send to each user, as a dict keyed by user id
+
+    We only build payloads for subscriptions which can receive them (i.e.
+    that have keys). We tell the user how long they've been at work, which
+    saves the service worker asking us.
+    """
+    user_ids = {s.user_id for s in subscriptions if s.p256dh_key and s.auth_secret}
+    if not user_ids:
+        return {}
+    starts = dict(
+        models.Period.objects
+            .filter(user_id__in=user_ids, end=None)
+            .values_list('user_id', 'start')
+    )
+    now = timezone.now()
+    payloads = {}
+    for user_id in user_ids:
+        body = 'It is probably time to go home.'
+        if user_id in starts:
+            hours, minutes = divmod(int((now - starts[user_id]).total_seconds()) // 60, 60)
+            body = 'You have been at work for %i hours and %i minutes.' % (hours, minutes)
+        payloads[user_id] = json.dumps(dict(
+            title='What time is it?',
+            body=body,
+        )).encode('utf-8')
+    return payloads
+
+
+def notify_web_push_subscription(subscription, session=requests, timeout=None, payload=None):
+    """Notifies a subscription using the Web Push protocol. Returns a result dict
+
+    Web Push has no multicast, so this is one request per subscription. The
+    result uses the same keys as GCM's, so that callers can treat all push
+    services alike.
+
+    If `payload` is given and the subscription has keys, the payload is
+    encrypted and sent with the notification. If we have a VAPID key, we use
+    it to identify ourselves to the push service.
+    """
+    headers = {
+        'TTL': str(settings.PUSH_TTL),
+    }
+    data = b''
+    if payload is not None and subscription.p256dh_key and subscription.auth_secret:
+        try:
+            data = webpush.encrypt(payload, subscription.p256dh_key, subscription.auth_secret)
+        except webpush.BadKeyException as e:
+            return dict(error=e.msg)
+        headers['Content-Encoding'] = 'aes128gcm'
+        headers['Content-Type'] = 'application/octet-stream'
+    authorization = webpush.get_vapid_authorization(subscription.identifier)
+    if authorization is not None:
+        headers['Authorization'] = authorization
+    try:
+        resp = session.post(subscription.identifier, headers=headers, data=data, timeout=timeout)
+    except requests.RequestException as e:
+        logger.warning('Failed to notify subscription %i: %s', subscription.id, e)
+        return dict(error='Unavailable')
+    if 200 <= resp.status_code < 300:
+        return dict(message_id=resp.headers.get('Location', ''))
+    if resp.status_code in (404, 410):
+        return dict(error='NotRegistered')
+    if resp.status_code == 429 or resp.status_code >= 500:
+        result = dict(error='Unavailable')
+        if 'Retry-After' in resp.headers:
+            result['retry_after'] = resp.headers['Retry-After']
+        return result
+    return dict(error='HTTP %i' % resp.status_code)
+
+
+class Provider(object):
+    """A push service, with its own connection pool and limits
+
+    `url` overrides where notifications are sent, for push services which
+    have a single endpoint.
+    """
+
+    def __init__(self, name, session, concurrency, batch_size, url=None):
+        self.name = name
+        self.session = session
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.url = url
+
+    def send(self, batch, timeout, payloads):
+        """Notifies a batch of subscriptions. Returns `(subscription, result)` pairs.
+
+        `payloads` maps user ids to the payload to send them, if the push
+        service can deliver payloads.
+        """
+        raise NotImplementedError
+
+
+class GcmProvider(Provider):
+    """Sends notifications in multicast batches to Google Cloud Messaging
+
+    GCM's multicast requests can't carry per-recipient encrypted payloads, so
+    we don't send any.
+    """
+
+    def send(self, batch, timeout, payloads):
+        return notify_subscriptions(batch, session=self.session, timeout=timeout, url=self.url)
+
+
+class WebPushProvider(Provider):
+    """Sends notifications to a push service using the Web Push protocol"""
+
+    def send(self, batch, timeout, payloads):
+        return [
+            (subscription, notify_web_push_subscription(
+                subscription, self.session, timeout, payloads.get(subscription.user_id)
+            ))
+            for subscription in batch
+        ]
+
+
+_PROVIDER_BACKENDS = {
+    'gcm': GcmProvider,
+    'webpush': WebPushProvider,
+}
+
+
+def get_providers(concurrency=None, batch_size=None, session=None):
+    """Creates a provider for each entry in `settings.PUSH_PROVIDERS`
+
+    Each provider has its own connection pool, concurrency limit and batch
+    size, so that a slow push service can't use up the connections or
+    threads of a fast one. `concurrency`, `batch_size` and `session` override
+    the settings for every provider.
+
+    Returns a dict mapping the providers' names to the providers.
+    """
+    providers = {}
+    for name, config in settings.PUSH_PROVIDERS.items():
+        provider_concurrency = concurrency or config['concurrency']
+        providers[name] = _PROVIDER_BACKENDS[config['backend']](
+            name,
+            session=session or create_session(provider_concurrency),
+            concurrency=provider_concurrency,
+            batch_size=batch_size or config['batch_size'],
+        )
+    return providers
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def prune_subscriptions(dead_ids):
+    """Deletes the subscriptions with the given ids, in batches. Returns the count."""
+    deleted = 0
+    for batch in _chunked(dead_ids, _MAX_STATEMENT_IDS):
+        _, per_model = models.PushSubscription.objects.filter(id__in=batch).delete()
+        deleted += per_model.get(models.PushSubscription._meta.label, 0)
+    return deleted
+
+
+def canonicalise_subscriptions(canonical_ids):
+    """Replaces subscriptions' identifiers with the canonical IDs GCM gave us
+
+    `canonical_ids` maps subscription ids to their new identifier. GCM gives
+    us a canonical ID when a device has been registered more than once, so the
+    canonical ID may already belong to another subscription. As `identifier`
+    is unique, we delete these duplicates rather than updating them.
+
+    Returns the number of subscriptions which were updated or deleted.
+    """
+    changed = 0
+    for batch in _chunked(canonical_ids.items(), _MAX_STATEMENT_IDS):
+        existing = set(models.PushSubscription.objects.filter(
+            identifier__in=[identifier for _, identifier in batch]
+        ).values_list('identifier', flat=True))
+
+        duplicate_ids = []
+        updates = {}
+        for id, identifier in batch:
+            if identifier in existing:
+                duplicate_ids.append(id)
+            else:
+                updates[id] = identifier
+                existing.add(identifier)
+
+        changed += prune_subscriptions(duplicate_ids)
+        if updates:
+            changed += models.PushSubscription.objects.filter(id__in=updates).update(
+                identifier=Case(
+                    *[When(id=id, then=Value(identifier)) for id, identifier in updates.items()],
+                    output_field=CharField()
+                )
+            )
+    return changed
+
+
+def overdue_subscriptions(overdue_after):
+    """Returns a QuerySet of the subscriptions of users who should go home
+
+    These are the users whose on-going Period started more than `overdue_after`
+    (a `timedelta`) ago. This is a single join against the partial index on
+    on-going Periods' `start`, so it only looks at users who are at work.
+    """
+    cutoff = timezone.now() - overdue_after
+    return models.PushSubscription.objects.filter(
+        user__period__end=None,
+        user__period__start__lte=cutoff,
+    ).distinct()
+
+
+def iter_subscription_chunks(chunk_size, shard=None, after_id=0, queryset=None):
+    """Yields lists of up to `chunk_size` subscriptions, in `id` order
+
+    We page through the table using the `id` of the last subscription we saw,
+    rather than `OFFSET` or a single `.all()`, so that memory use stays flat
+    and each page is a cheap index range scan.
+
+    `shard` is an optional `(index, count)` tuple. If it is given, we only
+    yield subscriptions where `id % count == index`, so that `count` processes
+    can share the work between them.
+
+    `queryset` restricts which subscriptions we yield. By default, we yield
+    all of them.
+    """
+    if queryset is None:
+        queryset = models.PushSubscription.objects.all()
+    queryset = queryset.order_by('id')
+    if shard is not None:
+        index, count = shard
+        queryset = queryset.annotate(shard=F('id') % count).filter(shard=index)
+    while True:
+        chunk = list(queryset.filter(id__gt=after_id)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after_id = chunk[-1].id
+
+
+class _Outcomes(object):
+    """Collects what happened to each subscription in a chunk we tried to notify"""
+
+    def __init__(self):
+        self.sent = 0
+        self.dead_ids = []
+        self.canonical_ids = {}
+        # Maps subscription ids to the error, for failures we shouldn't retry.
+        self.failures = {}
+        # Maps subscription ids to `(retry_after, error)`.
+        self.retries = {}
+
+    @property
+    def failed(self):
+        return len(self.dead_ids) + len(self.failures) + len(self.retries)
+
+    def add_batch_error(self, batch, exception):
+        """Records a failure of the whole request for `batch`
+
+        Timeouts, connection errors and 5xx responses are worth retrying. Other
+        HTTP errors (e.g. a bad API key) will just happen again.
+        """
+        logger.warning('Failed to notify batch of %i subscriptions: %s', len(batch), exception)
+        retry_after = None
+        retryable = True
+        response = getattr(exception, 'response', None)
+        if isinstance(exception, requests.HTTPError) and response is not None:
+            retryable = response.status_code >= 500
+            retry_after = response.headers.get('Retry-After')
+        for subscription in batch:
+            if retryable:
+                self.retries[subscription.id] = (retry_after, str(exception))
+            else:
+                self.failures[subscription.id] = str(exception)
+
+    def add_results(self, results):
+        for subscription, result in results:
+            error = result.get('error')
+            if error is None:
+                if 'registration_id' in result:
+                    self.canonical_ids[subscription.id] = result['registration_id']
+                self.sent += 1
+            elif error in DEAD_REGISTRATION_ERRORS:
+                self.dead_ids.append(subscription.id)
+            else:
+                logger.warning('Failed to notify subscription %i: %s', subscription.id, error)
+                if error in RETRYABLE_ERRORS:
+                    self.retries[subscription.id] = (result.get('retry_after'), error)
+                else:
+                    self.failures[subscription.id] = error
+
+
+def _notify_chunks(chunks, providers, timeout, on_chunk, max_pending_chunks=None):
+    """Notifies each chunk of subscriptions in `chunks`
+
+    Each chunk is grouped by push service, and split into batches of up to
+    the provider's `batch_size`. Each provider works through its own queue of
+    batches with its own pool of worker threads. We don't wait for a chunk to
+    finish before queueing the next, so a slow provider doesn't hold up the
+    others at every chunk boundary. To keep memory use flat, we stop reading
+    chunks while `max_pending_chunks` are unfinished, so a provider which
+    falls that far behind does eventually hold up the rest.
+
+    Results are collected on this thread as requests complete, into an
+    `_Outcomes` per chunk. `on_chunk(chunk, outcomes)` is called, in order,
+    once every request for a chunk and the chunks before it has completed.
+    The outcomes are then dropped, so `on_chunk` should act on them.
+    """
+    if max_pending_chunks is None:
+        max_pending_chunks = settings.PUSH_MAX_PENDING_CHUNKS
+    # Requests put `(chunk index, batch, future)` here when they complete.
+    completed = queue.Queue()
+    # Maps the index of each unfinished chunk to
+    # `[chunk, unfinished batches, outcomes]`.
+    pending = collections.OrderedDict()
+    executors = {
+        name: concurrent.futures.ThreadPoolExecutor(max_workers=provider.concurrency)
+        for name, provider in providers.items()
+    }
+
+    def done(index, batch, future):
+        # Called on the provider's worker thread.
+        completed.put((index, batch, future))
+
+    def finish_chunks():
+        while pending:
+            index, (chunk, unfinished, outcomes) = next(iter(pending.items()))
+            if unfinished:
+                return
+            del pending[index]
+            on_chunk(chunk, outcomes)
+
+    def collect():
+        index, batch, future = completed.get()
+        outcomes = pending[index][2]
+        try:
+            results = future.result()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            outcomes.add_batch_error(batch, e)
+        else:
+            outcomes.add_results(results)
+        pending[index][1] -= 1
+        finish_chunks()
+
+    try:
+        for index, chunk in enumerate(chunks):
+            payloads = build_payloads(chunk)
+            by_provider = collections.defaultdict(list)
+            for subscription in chunk:
+                by_provider[get_provider_name(subscription.identifier)].append(subscription)
+
+            pending[index] = [chunk, 0, _Outcomes()]
+            for name, subscriptions in by_provider.items():
+                if name not in providers:
+                    for subscription in subscriptions:
+                        pending[index][2].failures[subscription.id] = 'Unsupported push service'
+                    continue
+                provider = providers[name]
+                for batch in _chunked(subscriptions, provider.batch_size):
+                    future = executors[name].submit(provider.send, batch, timeout, payloads)
+                    pending[index][1] += 1
+                    future.add_done_callback(functools.partial(done, index, batch))
+            finish_chunks()
+            while len(pending) >= max_pending_chunks:
+                collect()
+        while pending:
+            collect()
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+
+def _parse_retry_after(value):
+    """Parses a `Retry-After` header into seconds. Returns None if we can't."""
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - timezone.now()).total_seconds())
+
+
+def _retry_delay(attempts, retry_after=None):
+    """Seconds to wait before making another attempt at a delivery
+
+    We back off exponentially with each attempt, but wait for longer if the
+    push service has told us to with `Retry-After`.
+    """
+    delay = min(
+        settings.PUSH_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+        settings.PUSH_RETRY_MAX_DELAY
+    )
+    retry_after = _parse_retry_after(retry_after)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return datetime.timedelta(seconds=delay)
+
+
+def schedule_retries(retries):
+    """Adds a `PushDelivery` to the outbox for each subscription in `retries`
+
+    `retries` maps subscription ids to `(retry_after, error)`. Subscriptions
+    which already have a pending delivery are left alone, so that a long
+    outage doesn't queue up several notifications per subscription.
+
+    Returns the number of deliveries added.
+    """
+    now = timezone.now()
+    created = 0
+    for batch in _chunked(retries.items(), _MAX_STATEMENT_IDS):
+        pending = set(models.PushDelivery.objects.filter(
+            status=models.PushDelivery.PENDING,
+            subscription_id__in=[id for id, _ in batch],
+        ).values_list('subscription_id', flat=True))
+        deliveries = [
+            models.PushDelivery(
+                subscription_id=id,
+                attempts=1,
+                next_attempt=now + _retry_delay(1, retry_after),
+                last_error=error,
+            )
+            for id, (retry_after, error) in batch
+            if id not in pending
+        ]
+        models.PushDelivery.objects.bulk_create(deliveries)
+        created += len(deliveries)
+    return created
+
+
+def notify_all_subscriptions(concurrency=None, timeout=None, batch_size=None,
+                             chunk_size=None, shard=None, checkpoint=None, resume=False,
+                             overdue_after=None, user_ids=None, session=None,
+                             providers=None, retry=True):
+    """Notifies every subscription, using a pool of `concurrency` worker threads
+
+    Subscriptions are streamed from the database in chunks of `chunk_size`
+    and grouped by push service. Each push service has its own pool of
+    worker threads, and GCM subscriptions are grouped into multicast requests.
+    `concurrency`, `batch_size` and `session` override the settings for every
+    push service (see `get_providers()`), or `providers` replaces them
+    altogether. A failure to notify one batch (or one recipient within a
+    batch) is logged and counted, but doesn't stop us from notifying the
+    others. Failures which are worth retrying are added to the outbox for
+    `process_outbox()`, unless `retry` is False.
+
+    As each chunk is finished, subscriptions which GCM told us are dead are
+    deleted, and those which GCM gave a canonical ID for are updated. Only
+    counts are kept across chunks, so memory use doesn't grow with the number
+    of subscriptions.
+
+    If `checkpoint` is given, it names a `PushCheckpoint` which is updated
+    after each chunk (once its retries are in the outbox, so a run which dies
+    doesn't lose them), and removed once we've notified everyone. With `resume`,
+    if a previous run with the same name didn't finish in the last
+    `settings.PUSH_CHECKPOINT_MAX_AGE`, we carry on from where it got to.
+    Older checkpoints belong to an earlier round of notifications, so are
+    ignored.
+
+    `shard` is passed through to `iter_subscription_chunks()`.
+
+    If `overdue_after` is given, we only notify the subscriptions of users
+    who have been at work for longer than it. See `overdue_subscriptions()`.
+    If `user_ids` is given, we only notify those users' subscriptions.
+
+    Returns a `NotifyStats`.
+    """
+    if timeout is None:
+        timeout = settings.PUSH_TIMEOUT
+    if chunk_size is None:
+        chunk_size = settings.PUSH_CHUNK_SIZE
+    if providers is None:
+        providers = get_providers(concurrency, batch_size, session)
+
+    after_id = 0
+    if checkpoint is not None and resume:
+        saved = models.PushCheckpoint.objects.filter(name=checkpoint).first()
+        if saved is None:
+            pass
+        elif saved.updated < timezone.now() - settings.PUSH_CHECKPOINT_MAX_AGE:
+            logger.info('Ignoring stale checkpoint %s from %s', checkpoint, saved.updated)
+        else:
+            logger.info('Resuming %s after subscription %i', checkpoint, saved.last_id)
+            after_id = saved.last_id
+
+    totals = collections.Counter()
+
+    def finish_chunk(chunk, outcomes):
+        totals['sent'] += outcomes.sent
+        totals['failed'] += outcomes.failed
+        if retry:
+            totals['retrying'] += schedule_retries(outcomes.retries)
+        totals['pruned'] += prune_subscriptions(outcomes.dead_ids)
+        totals['canonicalised'] += canonicalise_subscriptions(outcomes.canonical_ids)
+        if checkpoint is not None:
+            models.PushCheckpoint.objects.update_or_create(
+                name=checkpoint, defaults=dict(last_id=chunk[-1].id)
+            )
+
+    queryset = models.PushSubscription.objects.all()
+    if overdue_after is not None:
+        queryset = overdue_subscriptions(overdue_after)
+    if user_ids is not None:
+        queryset = queryset.filter(user_id__in=user_ids)
+
+    start = time.monotonic()
+    chunks = iter_subscription_chunks(
+        chunk_size, shard=shard, after_id=after_id, queryset=queryset
+    )
+    _notify_chunks(chunks, providers, timeout, on_chunk=finish_chunk)
+    if checkpoint is not None:
+        models.PushCheckpoint.objects.filter(name=checkpoint).delete()
+    return NotifyStats(
+        sent=totals['sent'],
+        failed=totals['failed'],
+        retrying=totals['retrying'],
+        pruned=totals['pruned'],
+        canonicalised=totals['canonicalised'],
+        elapsed=time.monotonic() - start
+    )
+
+
+def _update_deliveries(groups, **fields):
+    """Applies `.update(**fields, **key)` to the deliveries in each group
+
+    `groups` maps a tuple of `(field, value)` pairs to a list of delivery ids.
+    Grouping deliveries which need the same update lets us make one `UPDATE`
+    per group, rather than one per delivery.
+    """
+    for key, ids in groups.items():
+        for batch in _chunked(ids, _MAX_STATEMENT_IDS):
+            models.PushDelivery.objects.filter(id__in=batch).update(**dict(key, **fields))
+
+
+def process_outbox(limit=None, concurrency=None, timeout=None, batch_size=None, session=None):
+    """Makes another attempt at the deliveries in the outbox which are due
+
+    Successful deliveries are removed from the outbox. Failed deliveries are
+    rescheduled with exponential backoff, or marked as dead once they've been
+    tried `PUSH_MAX_ATTEMPTS` times (or failed in a way that won't get better).
+
+    Only one process should work through the outbox at a time.
+
+    Returns the number of deliveries attempted.
+    """
+    if limit is None:
+        limit = settings.PUSH_OUTBOX_BATCH_SIZE
+    if timeout is None:
+        timeout = settings.PUSH_TIMEOUT
+    providers = get_providers(concurrency, batch_size, session)
+
+    now = timezone.now()
+    deliveries = list(
+        models.PushDelivery.objects
+            .filter(status=models.PushDelivery.PENDING, next_attempt__lte=now)
+            .select_related('subscription')
+            .order_by('next_attempt')[:limit]
+    )
+    if not deliveries:
+        return 0
+    by_subscription = {delivery.subscription_id: delivery for delivery in deliveries}
+
+    subscriptions = [delivery.subscription for delivery in deliveries]
+    finished = []
+    _notify_chunks(
+        [subscriptions], providers, timeout,
+        on_chunk=lambda chunk, outcomes: finished.append(outcomes)
+    )
+    outcomes = finished[0]
+
+    # Dead subscriptions take their deliveries with them.
+    prune_subscriptions(outcomes.dead_ids)
+    canonicalise_subscriptions(outcomes.canonical_ids)
+    unsent = set(outcomes.dead_ids) | set(outcomes.failures) | set(outcomes.retries)
+    sent_ids = [delivery.id for id, delivery in by_subscription.items() if id not in unsent]
+    for batch in _chunked(sent_ids, _MAX_STATEMENT_IDS):
+        models.PushDelivery.objects.filter(id__in=batch).delete()
+
+    dead = collections.defaultdict(list)
+    retry = collections.defaultdict(list)
+    for id, error in outcomes.failures.items():
+        dead[(('last_error', error),)].append(by_subscription[id].id)
+    for id, (retry_after, error) in outcomes.retries.items():
+        delivery = by_subscription[id]
+        attempts = delivery.attempts + 1
+        if attempts >= settings.PUSH_MAX_ATTEMPTS:
+            dead[(('last_error', error),)].append(delivery.id)
+        else:
+            next_attempt = now + _retry_delay(attempts, retry_after)
+            key = (('attempts', attempts), ('next_attempt', next_attempt), ('last_error', error))
+            retry[key].append(delivery.id)
+    _update_deliveries(dead, status=models.PushDelivery.DEAD, attempts=F('attempts') + 1)
+    _update_deliveries(retry)
+
+    return len(deliveries)
 
 
-def notify_all_subscriptions():
-    for subscription in models.PushSubscription.objects.all():
-        notify_subscription(subscription)
+def next_outbox_attempt():
+    """Returns when the next pending delivery is due, or None if there isn't one"""
+    delivery = (
+        models.PushDelivery.objects
+            .filter(status=models.PushDelivery.PENDING)
+            .order_by('next_attempt')
+            .first()
+    )
+    if delivery is None:
+        return None
+    return delivery.next_attempt
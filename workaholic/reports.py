@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import collections
+import datetime
+import itertools
+import logging
+
+from django.conf import settings
+from django.db.models import DateField, DateTimeField, F, FloatField, Func, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import dateparse, timezone
+
+import pytz
+
+from . import archive, models, rollups
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = ('day', 'week', 'month')
+
+
+class BadReportException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class _LocalDate(Func):
+    """The date of a datetime expression, in the time zone `tzname`"""
+
+    def __init__(self, expression, tzname):
+        super().__init__(expression, output_field=DateField())
+        self.tzname = tzname
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        sql, tz_params = connection.ops.datetime_cast_date_sql(sql, self.tzname)
+        return sql, params + tz_params
+
+
+class _Seconds(Func):
+    """Seconds from the `start` datetime expression to `end`"""
+
+    def __init__(self, start, end):
+        super().__init__(start, end, output_field=FloatField())
+
+    def as_sql(self, compiler, connection):
+        (start, start_params), (end, end_params) = [
+            compiler.compile(expression) for expression in self.source_expressions
+        ]
+        sql = 'EXTRACT(EPOCH FROM (%s - %s))' % (end, start)
+        return sql, end_params + start_params
+
+    def as_sqlite(self, compiler, connection):
+        (start, start_params), (end, end_params) = [
+            compiler.compile(expression) for expression in self.source_expressions
+        ]
+        # julianday() is only accurate to around a millisecond.
+        sql = 'ROUND((julianday(%s) - julianday(%s)) * 86400.0, 3)' % (end, start)
+        return sql, end_params + start_params
+
+
+def get_timezone(tzname):
+    try:
+        return pytz.timezone(tzname)
+    except pytz.UnknownTimeZoneError:
+        raise BadReportException('Unknown time zone: %s' % tzname)
+
+
+def parse_date(value):
+    """Parses a `YYYY-MM-DD` date from a request parameter (or None)"""
+    if value is None:
+        return None
+    try:
+        date = dateparse.parse_date(value)
+    except ValueError:
+        date = None
+    if date is None:
+        raise BadReportException('Expected a date (YYYY-MM-DD): %s' % value)
+    return date
+
+
+def daily_seconds(user, tz, start_date=None, end_date=None):
+    """Seconds worked by `user` on each day, in the time zone `tz`
+
+    Returns an ordered dict of `date => seconds`, only including days on which
+    the user worked. `start_date` is inclusive and `end_date` exclusive.
+
+    Periods which cross midnight in `tz` are split between the days they
+    cover, and on-going periods count up to now. In the rollup's time zone,
+    this reads the user's DailyTotals, which are already split this way. In
+    other time zones, the database sums the periods which start and end on
+    the same day (almost all of them) and returns one row per day. The few
+    which cross midnight, and any archived periods in the range, are split
+    here.
+    """
+    if tz.zone == settings.TRACKER_ROLLUP_TIME_ZONE:
+        return rollups.daily_seconds(user, start_date, end_date)
+
+    start = local_midnight(start_date, tz) if start_date is not None else None
+    end = local_midnight(end_date, tz) if end_date is not None else None
+    now = timezone.now()
+    periods = models.Period.objects.filter(user=user)
+    if start is not None:
+        periods = periods.filter(Q(end__gt=start) | Q(end=None))
+    if end is not None:
+        periods = periods.filter(start__lt=end)
+    end_or_now = Coalesce('end', Value(now, output_field=DateTimeField()))
+    periods = periods.annotate(
+        start_date=_LocalDate('start', tz.zone),
+        end_date=_LocalDate(end_or_now, tz.zone),
+    )
+
+    rows = (
+        periods
+            .filter(start_date=F('end_date'))
+            .values('start_date')
+            .annotate(seconds=Sum(_Seconds(F('start'), end_or_now)))
+            .order_by('start_date')
+            .values_list('start_date', 'seconds')
+    )
+    days = collections.defaultdict(float, rows)
+
+    crossing = periods.exclude(start_date=F('end_date')).values_list('start', 'end')
+    # Archived periods which started up to a month before `start` may still
+    # overlap it.
+    archived = archive.iter_periods(
+        [user.id], start - datetime.timedelta(days=31) if start is not None else None, end
+    )
+    split = itertools.chain(crossing, ((s, e) for _, s, e in archived))
+    for period_start, period_end in split:
+        for date, seconds in rollups.split_by_day(period_start, period_end or now, tz):
+            if start_date is not None and date < start_date:
+                continue
+            if end_date is not None and date >= end_date:
+                continue
+            days[date] += seconds
+    return collections.OrderedDict(sorted(days.items()))
+
+
+def local_midnight(date, tz):
+    return tz.localize(datetime.datetime.combine(date, datetime.time()))
+
+
+def _week(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def _month(date):
+    return date.replace(day=1)
+
+
+def worked_hours(user, interval, tz, start_date=None, end_date=None):
+    """Hours worked by `user` in each day, week or month
+
+    Weeks (starting on Monday) and months are rolled up from the per-day
+    totals, so at most one row per day comes back from the database. Returns
+    a list of `(first date in interval, hours)`.
+    """
+    if interval not in INTERVALS:
+        raise BadReportException('Unknown interval: %s' % interval)
+    days = daily_seconds(user, tz, start_date, end_date)
+    if interval == 'day':
+        totals = days
+    else:
+        bucket = _week if interval == 'week' else _month
+        totals = collections.OrderedDict()
+        for date, seconds in days.items():
+            key = bucket(date)
+            totals[key] = totals.get(key, 0) + seconds
+    return [(date, seconds / 3600) for date, seconds in totals.items()]
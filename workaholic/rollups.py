@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import collections
+import datetime
+import itertools
+import logging
+
+from django.conf import settings
+from django.db.models import Case, F, FloatField, Value, When
+from django.utils import timezone
+
+import pytz
+
+from . import archive, models
+
+logger = logging.getLogger(__name__)
+
+# Up to three parameters per row, and SQLite won't take more than 999.
+_MAX_STATEMENT_ROWS = 300
+
+
+def get_timezone():
+    return pytz.timezone(settings.TRACKER_ROLLUP_TIME_ZONE)
+
+
+def split_by_day(start, end, tz):
+    """Yields `(date, seconds)` for each day in `tz` that [start, end) covers"""
+    start = start.astimezone(tz)
+    while True:
+        date = start.date()
+        midnight = tz.localize(datetime.datetime.combine(
+            date + datetime.timedelta(days=1), datetime.time()
+        ))
+        if end <= midnight:
+            yield date, (end - start).total_seconds()
+            return
+        yield date, (midnight - start).total_seconds()
+        start = midnight
+
+
+def _totals(periods, tz):
+    totals = collections.defaultdict(float)
+    for user_id, start, end in periods:
+        for date, seconds in split_by_day(start, end, tz):
+            totals[(user_id, date)] += seconds
+    return totals
+
+
+def add_periods(periods):
+    """Adds ended `periods` to their users' DailyTotals
+
+    The caller should hold the users' TrackerState locks (see
+    `tracker.lock_state()`), so that nothing else writes their DailyTotals
+    meanwhile. Days which already have a total are incremented by one UPDATE,
+    and the rest are inserted by one INSERT, per `_MAX_STATEMENT_ROWS` days.
+    """
+    totals = list(_totals(
+        ((period.user_id, period.start, period.end) for period in periods),
+        get_timezone()
+    ).items())
+    for i in range(0, len(totals), _MAX_STATEMENT_ROWS):
+        batch = dict(totals[i:i + _MAX_STATEMENT_ROWS])
+        existing = {
+            (user_id, date): id
+            for id, user_id, date in
+            models.DailyTotal.objects
+                .filter(
+                    user_id__in={user_id for user_id, _ in batch},
+                    date__in={date for _, date in batch},
+                )
+                .values_list('id', 'user_id', 'date')
+            # The filter also matches other days of the same users.
+            if (user_id, date) in batch
+        }
+        if existing:
+            models.DailyTotal.objects.filter(id__in=existing.values()).update(seconds=Case(
+                *[
+                    When(id=id, then=F('seconds') + Value(batch[key]))
+                    for key, id in existing.items()
+                ],
+                output_field=FloatField()
+            ))
+        models.DailyTotal.objects.bulk_create(
+            models.DailyTotal(user_id=user_id, date=date, seconds=seconds)
+            for (user_id, date), seconds in batch.items()
+            if (user_id, date) not in existing
+        )
+
+
+def rebuild(user_ids):
+    """Recomputes the DailyTotals of `user_ids` from their ended Periods
+
+    This includes their archived Periods. The caller should hold the users'
+    TrackerState locks (see `tracker.rebuild_daily_totals()`), so that no
+    Periods end meanwhile.
+    """
+    periods = itertools.chain(
+        archive.iter_periods(user_ids),
+        models.Period.objects
+            .filter(user_id__in=user_ids, end__isnull=False)
+            .values_list('user_id', 'start', 'end')
+            .iterator()
+    )
+    totals = _totals(periods, get_timezone())
+    models.DailyTotal.objects.filter(user_id__in=user_ids).delete()
+    models.DailyTotal.objects.bulk_create(
+        (
+            models.DailyTotal(user_id=user_id, date=date, seconds=seconds)
+            for (user_id, date), seconds in totals.items()
+        ),
+        batch_size=1000
+    )
+    return len(totals)
+
+
+def daily_seconds(user, start_date=None, end_date=None):
+    """Seconds worked by `user` on each day, read from their DailyTotals
+
+    Like `reports.daily_seconds()`, but in the rollup's time zone and with
+    Periods split at midnight. The on-going Period isn't in the rollup yet, so
+    it is added up to now.
+    """
+    tz = get_timezone()
+    totals = models.DailyTotal.objects.filter(user=user)
+    if start_date is not None:
+        totals = totals.filter(date__gte=start_date)
+    if end_date is not None:
+        totals = totals.filter(date__lt=end_date)
+    days = collections.defaultdict(float, totals.values_list('date', 'seconds'))
+
+    ongoing = models.Period.objects.filter(user=user, end=None).first()
+    if ongoing is not None:
+        for date, seconds in split_by_day(ongoing.start, timezone.now(), tz):
+            if start_date is not None and date < start_date:
+                continue
+            if end_date is not None and date >= end_date:
+                continue
+            days[date] += seconds
+    return collections.OrderedDict(sorted(days.items()))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import models, push
+
+logger = logging.getLogger(__name__)
+
+
+def schedule(user, start):
+    """Schedules a reminder to go home for a user who started work at `start`"""
+    models.NotificationSchedule.objects.update_or_create(
+        user=user,
+        defaults=dict(next_notify_at=start + settings.PUSH_OVERDUE_AFTER),
+    )
+
+
+def clear(user):
+    """Cancels any reminder we had scheduled for the user"""
+    models.NotificationSchedule.objects.filter(user=user).update(next_notify_at=None)
+
+
+def clear_users(user_ids):
+    """Cancels any reminders we had scheduled for the users"""
+    models.NotificationSchedule.objects.filter(user_id__in=user_ids).update(next_notify_at=None)
+
+
+def next_due():
+    """Returns when the next reminder is due, or None if none are scheduled"""
+    schedule = (
+        models.NotificationSchedule.objects
+            .filter(next_notify_at__isnull=False)
+            .order_by('next_notify_at')
+            .first()
+    )
+    if schedule is None:
+        return None
+    return schedule.next_notify_at
+
+
+def notify_due(limit=None, session=None):
+    """Notifies the users whose reminder is due, and clears their schedule
+
+    This only looks at the rows in the `next_notify_at` index which are due,
+    so it's cheap to call often. Returns the number of users notified.
+    """
+    if limit is None:
+        limit = settings.PUSH_SCHEDULER_BATCH_SIZE
+
+    now = timezone.now()
+    user_ids = list(
+        models.NotificationSchedule.objects
+            .filter(next_notify_at__lte=now)
+            .order_by('next_notify_at')
+            .values_list('user_id', flat=True)[:limit]
+    )
+    if not user_ids:
+        return 0
+
+    # Clear the schedule before notifying, so that we don't remind anyone
+    # twice if something goes wrong part way through. Failed notifications
+    # are retried through the outbox.
+    models.NotificationSchedule.objects.filter(
+        user_id__in=user_ids, next_notify_at__lte=now
+    ).update(next_notify_at=None)
+    stats = push.notify_all_subscriptions(user_ids=user_ids, session=session)
+    logger.info('Reminded %i users: %s', len(user_ids), stats)
+    return len(user_ids)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import datetime
 import os
 
 import dj_database_url
@@ -35,6 +36,55 @@ GCM_URL = 'https://gcm-http.googleapis.com/gcm/send'
 GCM_CHROME_IDENTIFIER_URL = 'https://android.googleapis.com/gcm/send/' # sent by browsers
 GCM_API_KEY = os.environ['GCM_API_KEY']
 GCM_PROJECT_ID = os.environ['GCM_PROJECT_ID']
+GCM_BATCH_SIZE = 1000 # max registration_ids GCM accepts per multicast request
+
+# Identifies us to Web Push services (RFC 8292). The private key is the raw
+# P-256 private value, base64url encoded. Without it, we can't deliver to
+# push services which require VAPID (e.g. FCM).
+VAPID_PRIVATE_KEY = os.environ.get('VAPID_PRIVATE_KEY', '')
+VAPID_SUBJECT = 'https://workaholic.zvxrl.co.uk/'
+
+PUSH_CONCURRENCY = int(os.environ.get('PUSH_CONCURRENCY', 16)) # parallel requests, per provider
+PUSH_TIMEOUT = float(os.environ.get('PUSH_TIMEOUT', 10)) # seconds, per request
+PUSH_CHUNK_SIZE = 10000 # subscriptions loaded from the database at a time
+PUSH_MAX_PENDING_CHUNKS = 4 # chunks providers may be working through at once
+PUSH_CHECKPOINT_MAX_AGE = datetime.timedelta(hours=6) # older checkpoints aren't resumed
+PUSH_OUTBOX_BATCH_SIZE = 1000 # deliveries retried at a time by push-worker
+PUSH_WORKER_POLL_INTERVAL = 60 # max seconds push-worker sleeps between checks
+PUSH_RETRY_BASE_DELAY = 30 # seconds before the first retry, doubled each time
+PUSH_RETRY_MAX_DELAY = 60 * 60 # seconds
+PUSH_MAX_ATTEMPTS = 8
+# Browsers only tell us about their subscription when it changes. Bump this
+# to make every browser tell us again.
+PUSH_SUBSCRIPTION_VERSION = 1
+PUSH_TTL = 24 * 60 * 60 # seconds a push service should hold on to a notification
+PUSH_OVERDUE_AFTER = datetime.timedelta(hours=9) # at work for this long => go home!
+PUSH_SCHEDULER_BATCH_SIZE = 500 # users reminded at a time by push-scheduler
+PUSH_SCHEDULER_POLL_INTERVAL = 60 # max seconds push-scheduler sleeps between checks
+
+# The push services we deliver to. GCM subscriptions are stored as bare
+# registration IDs. Subscriptions with other services are stored as their
+# endpoint URL, and are matched to a provider by the endpoint's origin.
+PUSH_PROVIDERS = {
+    'gcm': dict(
+        backend='gcm',
+        concurrency=PUSH_CONCURRENCY,
+        batch_size=GCM_BATCH_SIZE,
+    ),
+    'mozilla': dict(
+        backend='webpush',
+        origins=['https://updates.push.services.mozilla.com'],
+        concurrency=PUSH_CONCURRENCY,
+        batch_size=1, # Web Push has no multicast
+    ),
+    # Chrome gives FCM endpoints when subscribing with our VAPID key.
+    'fcm': dict(
+        backend='webpush',
+        origins=['https://fcm.googleapis.com'],
+        concurrency=PUSH_CONCURRENCY,
+        batch_size=1,
+    ),
+}
 
 
 LOGIN_URL = '/auth/login/'
@@ -47,7 +97,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.contenttypes',
 
-    'workaholic',
+    'workaholic.apps.WorkaholicConfig',
 ]
 
 
@@ -86,6 +136,35 @@ DATABASES = {
 }
 
 
+# The web processes, push processes and management commands all change users'
+# state, so anything cached across requests must be in a cache they all share
+# (e.g. memcached, set through CACHE_BACKEND/CACHE_LOCATION). The default cache
+# is private to each process, so only SHARED_CACHE turns such caching on: in
+# the default configuration, nothing is cached across requests.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+SHARED_CACHE = CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+TRACKER_STATE_CACHE_TIMEOUT = 60 * 60 if SHARED_CACHE else 0 # seconds a user's tracker state is cached (needs SHARED_CACHE)
+TRACKER_REBUILD_BATCH_SIZE = 100 # users whose periods are rebuilt per transaction
+TRACKER_ROLLUP_TIME_ZONE = TIME_ZONE # zone of the dates in DailyTotal
+TRACKER_COMPACT_GAP = datetime.timedelta(minutes=1) # periods closer than this are merged
+ARCHIVE_AFTER_MONTHS = 12 # ended periods older than this many months are archived
+HISTORY_PAGE_SIZE = 50 # default periods per page of history
+HISTORY_MAX_PAGE_SIZE = 500 # most periods a client may ask for in a page
+EXPORT_CHUNK_SIZE = 2000 # periods read per query when exporting
+IMPORT_BATCH_SIZE = 1000 # periods validated and inserted per transaction
+IMPORT_MAX_ERRORS = 100 # rejected rows described in an import's results
+API_KEY_CACHE_SIZE = 1024 # verified API keys remembered by each process
+API_KEY_CACHE_TIMEOUT = 5 * 60 if SHARED_CACHE else 5 # seconds a verified API key is remembered
+
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -1,10 +1,16 @@
 'use strict';
 
+const SYNCED_STORAGE_KEY = 'workaholic.push-subscription';
+const RESYNC_INTERVAL = 7 * 24 * 60 * 60 * 1000; // ms
+
 
 class NotificationManager {
 
-    constructor(serviceWorkerUrl) {
+    // `applicationServerKey` is our base64url encoded VAPID public key, or
+    // an empty string if we don't have one.
+    constructor(serviceWorkerUrl, applicationServerKey) {
         this.serviceWorkerUrl = serviceWorkerUrl;
+        this.applicationServerKey = applicationServerKey;
         this._installServiceWorker();
     }
 
@@ -36,8 +42,14 @@ class NotificationManager {
 
     // Returns a Promise that resolves to a PushSubscription.
     subscribe() {
+        const options = {userVisibleOnly: true};
+        if (this.applicationServerKey) {
+            options.applicationServerKey = NotificationManager._decodeBase64Url(
+                this.applicationServerKey
+            );
+        }
         return this.serviceWorkerPromise.then(serviceWorker => {
-            return serviceWorker.pushManager.subscribe({userVisibleOnly: true})
+            return serviceWorker.pushManager.subscribe(options)
                 .catch(error => {
                     console.log('pushManager.subscribe() gave error:', error);
                     throw error;
@@ -62,4 +74,46 @@ class NotificationManager {
             });
     }
 
+    // Returns a Promise that resolves to a fingerprint of the subscription, as
+    // we'd store it on the server. `version` is bumped by the server when it
+    // wants every browser to send its subscription again.
+    static fingerprint(version, userId, subscription) {
+        const json = subscription.toJSON();
+        const keys = json.keys || {};
+        const text = [version, userId, json.endpoint, keys.p256dh || '', keys.auth || ''].join('\n');
+        return crypto.subtle.digest('SHA-256', new TextEncoder().encode(text))
+            .then(digest => {
+                const bytes = Array.from(new Uint8Array(digest));
+                return version + ':' + bytes.map(b => ('0' + b.toString(16)).slice(-2)).join('');
+            });
+    }
+
+    // Whether we've already told the server about the subscription with this
+    // fingerprint. We tell it again occasionally, in case it has lost it.
+    static isSynced(fingerprint) {
+        let synced;
+        try {
+            synced = JSON.parse(localStorage.getItem(SYNCED_STORAGE_KEY));
+        } catch (error) {
+            return false;
+        }
+        return synced !== null
+            && synced.fingerprint === fingerprint
+            && Date.now() - synced.at < RESYNC_INTERVAL;
+    }
+
+    static markSynced(fingerprint) {
+        localStorage.setItem(SYNCED_STORAGE_KEY, JSON.stringify({
+            fingerprint: fingerprint,
+            at: Date.now()
+        }));
+    }
+
+    static _decodeBase64Url(string) {
+        const padding = '='.repeat((4 - string.length % 4) % 4);
+        const base64 = (string + padding).replace(/-/g, '+').replace(/_/g, '/');
+        const raw = atob(base64);
+        return Uint8Array.from(raw, c => c.charCodeAt(0));
+    }
+
 }
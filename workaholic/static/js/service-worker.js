@@ -1,9 +1,15 @@
 'use strict';
 
 // A very simple service worker that displays a notification whenever
-// it receives a push event from the server.
+// it receives a push event from the server. Browsers which can receive
+// payloads are sent the title and body, otherwise we show a generic message.
 this.addEventListener('push', event => {
-    const title = 'What time is it?';
-    const body = 'It is probably time to go home.';
+    let title = 'What time is it?';
+    let body = 'It is probably time to go home.';
+    if (event.data) {
+        const data = event.data.json();
+        title = data.title;
+        body = data.body;
+    }
     event.waitUntil(this.registration.showNotification(title, {body: body}));
 });
@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import datetime
 import json
 import unittest
 
 from django import http
 import django.test
 from django.contrib import auth
+from django.core.cache import cache
+
+import freezegun
 
 from .. import api
 
@@ -15,6 +19,7 @@ class ApiKeyTestCase(django.test.TestCase):
 
     def setUp(self):
         super().setUp()
+        api.clear_api_key_cache()
         self.user = auth.models.User.objects.create_user('username', 'password')
 
     def test_api_key_stable(self):
@@ -47,6 +52,59 @@ class ApiKeyTestCase(django.test.TestCase):
         user = api.get_user_for_api_key(token2)
         self.assertEqual(user, self.user)
 
+    def test_verified_key_cached(self):
+        """Verifying a key again shouldn't hit the database"""
+        token = api.get_api_key_for_user(self.user)
+        api.get_user_for_api_key(token)
+        with self.assertNumQueries(0):
+            user = api.get_user_for_api_key(token)
+        self.assertEqual(user, self.user)
+        # Each caller gets its own copy.
+        user.first_name = 'changed'
+        self.assertEqual(api.get_user_for_api_key(token).first_name, '')
+
+    def test_changing_password_invalidates_cached_key(self):
+        token = api.get_api_key_for_user(self.user)
+        api.get_user_for_api_key(token)
+        self.user.set_password('password2')
+        self.user.save()
+        with self.assertRaises(api.ExpiredApiKey):
+            api.get_user_for_api_key(token)
+
+    def test_saved_elsewhere_invalidates_cached_key(self):
+        """Another process saving the user drops their version in the shared cache"""
+        token = api.get_api_key_for_user(self.user)
+        api.get_user_for_api_key(token)
+        auth.models.User.objects.filter(id=self.user.id).update(first_name='changed')
+        cache.delete('api-key:version:%i' % self.user.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(api.get_user_for_api_key(token).first_name, 'changed')
+        with self.assertNumQueries(0):
+            api.get_user_for_api_key(token)
+
+    def test_cached_key_expires(self):
+        token = api.get_api_key_for_user(self.user)
+        with freezegun.freeze_time(datetime.datetime(2016, 6, 1)):
+            api.get_user_for_api_key(token)
+        with freezegun.freeze_time(datetime.datetime(2016, 6, 1, 0, 10)):
+            with self.assertNumQueries(1):
+                api.get_user_for_api_key(token)
+
+    @django.test.override_settings(API_KEY_CACHE_SIZE=2)
+    def test_cache_bounded(self):
+        users = [self.user] + [
+            auth.models.User.objects.create_user('user%i' % i) for i in range(2)
+        ]
+        tokens = [api.get_api_key_for_user(user) for user in users]
+        for token in tokens:
+            api.get_user_for_api_key(token)
+        # The least recently used key was forgotten.
+        with self.assertNumQueries(0):
+            api.get_user_for_api_key(tokens[2])
+            api.get_user_for_api_key(tokens[1])
+        with self.assertNumQueries(1):
+            api.get_user_for_api_key(tokens[0])
+
 
 class ApiEndpointTestCase(django.test.TestCase):
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+import io
+
+import django.test
+from django.contrib import auth
+from django.core.cache import cache
+from django.core.management import call_command
+
+import freezegun
+import pytz
+
+from .. import archive, exports, imports, models, reports, rollups, tracker
+from .utils import utc
+
+
+class PackTestCase(django.test.SimpleTestCase):
+
+    def test_round_trip(self):
+        periods = [
+            (utc(2016, 1, 2, 9, 0, 0, 1), utc(2016, 1, 2, 17, 30)),
+            (utc(2016, 1, 1, 9), utc(2016, 1, 1, 17)),
+            (utc(1969, 12, 31, 23), utc(1970, 1, 1, 1)),
+        ]
+        self.assertEqual(archive.unpack(archive.pack(periods)), sorted(periods))
+        self.assertEqual(archive.unpack(archive.pack([])), [])
+
+    def test_compact(self):
+        # A month of working days packs into a few bytes per period.
+        periods = [
+            (utc(2016, 1, day, 9), utc(2016, 1, day, 17, 30))
+            for day in range(1, 32)
+        ]
+        self.assertLess(len(archive.pack(periods)), 4 * len(periods))
+
+
+@freezegun.freeze_time(utc(2016, 6, 15, 12))
+class ArchiveTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = auth.models.User.objects.create_user('username')
+        # Two periods in February, one in March and one in June.
+        for start in [utc(2016, 2, 1, 9), utc(2016, 2, 29, 23), utc(2016, 3, 1, 9), utc(2016, 6, 1, 9)]:
+            models.Period.objects.create(user=self.user, start=start, end=start + datetime.timedelta(hours=2))
+        tracker.rebuild_daily_totals()
+
+    def _archive(self, **kwargs):
+        stdout = io.StringIO()
+        call_command('archive-periods', stdout=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_archive(self):
+        self.assertEqual(self._archive(months=2), 'Archived 3 periods from 1 users into 2 monthly archives\n')
+        self.assertEqual(
+            list(models.Period.objects.values_list('start', flat=True)),
+            [utc(2016, 6, 1, 9)]
+        )
+        archives = models.PeriodArchive.objects.order_by('month')
+        self.assertEqual(
+            [(archive.month, archive.count) for archive in archives],
+            [(datetime.date(2016, 2, 1), 2), (datetime.date(2016, 3, 1), 1)]
+        )
+        self.assertEqual(archive.horizon(self.user.id), utc(2016, 4, 1))
+        # Archiving again, with a shorter retention, adds to the archive.
+        models.Period.objects.create(user=self.user, start=utc(2016, 3, 5, 9), end=utc(2016, 3, 5, 10))
+        self._archive(months=0)
+        self.assertEqual(models.Period.objects.get().start, utc(2016, 6, 1, 9))
+        self.assertEqual(models.PeriodArchive.objects.get(month=datetime.date(2016, 3, 1)).count, 2)
+
+    def test_dry_run(self):
+        self.assertEqual(
+            self._archive(months=2, dry_run=True),
+            'Would archive 3 periods from 1 users into 2 monthly archives\n'
+        )
+        self.assertEqual(models.Period.objects.count(), 4)
+        self.assertFalse(models.PeriodArchive.objects.exists())
+
+    def test_ongoing_not_archived(self):
+        models.Period.objects.filter(start=utc(2016, 6, 1, 9)).delete()
+        models.Period.objects.create(user=self.user, start=utc(2016, 1, 1, 9))
+        tracker.archive_periods(months=2)
+        self.assertEqual(models.Period.objects.get().start, utc(2016, 1, 1, 9))
+
+    def test_reads_see_archive(self):
+        before = reports.daily_seconds(self.user, pytz.timezone('Europe/London'))
+        exported = list(exports.iter_user_periods(self.user.id, pytz.utc))
+        tracker.archive_periods(months=2)
+        self.assertEqual(reports.daily_seconds(self.user, pytz.timezone('Europe/London')), before)
+        self.assertEqual(
+            [row[1:] for row in exports.iter_user_periods(self.user.id, pytz.utc)],
+            [row[1:] for row in exported]
+        )
+        rows = list(exports.iter_user_periods(
+            self.user.id, pytz.utc, datetime.date(2016, 2, 15), datetime.date(2016, 6, 1)
+        ))
+        self.assertEqual([(id, start) for id, start, _ in rows], [
+            (None, utc(2016, 2, 29, 23)), (None, utc(2016, 3, 1, 9))
+        ])
+        # The rollup keeps counting archived periods, even when rebuilt.
+        totals = rollups.daily_seconds(self.user)
+        tracker.rebuild_daily_totals()
+        self.assertEqual(rollups.daily_seconds(self.user), totals)
+        self.assertEqual(totals[datetime.date(2016, 3, 1)], 3 * 3600)
+
+    def test_import_rejects_archived_months(self):
+        tracker.archive_periods(months=2)
+        rows = imports.parse(io.StringIO(
+            'start,end\n'
+            '2016-03-10T09:00:00Z,2016-03-10T10:00:00Z\n'
+            '2016-04-10T09:00:00Z,2016-04-10T10:00:00Z\n'
+        ), 'csv')
+        stats = imports.import_periods(self.user, rows, pytz.utc)
+        self.assertEqual(stats, imports.ImportStats(1, 1, [(2, 'Period is in an archived month')]))
+
+    def test_rebuild_skips_archived_months(self):
+        models.Period.objects.all().delete()
+        for start in [utc(2016, 2, 1, 9), utc(2016, 6, 1, 9)]:
+            models.TrackerEvent.objects.create(user=self.user, kind=models.TrackerEvent.START, timestamp=start)
+            models.TrackerEvent.objects.create(
+                user=self.user, kind=models.TrackerEvent.END, timestamp=start + datetime.timedelta(hours=1)
+            )
+        tracker.rebuild_periods()
+        tracker.archive_periods(months=2)
+        self.assertEqual(tracker.rebuild_periods().periods, 1)
+        self.assertEqual(models.Period.objects.get().start, utc(2016, 6, 1, 9))
+
+    def test_rebuild_keeps_unarchived_periods(self):
+        # A period which was still going when February was archived.
+        models.Period.objects.all().delete()
+        for kind, timestamp in [
+            (models.TrackerEvent.START, utc(2016, 2, 1, 9)),
+            (models.TrackerEvent.END, utc(2016, 2, 1, 10)),
+            (models.TrackerEvent.START, utc(2016, 2, 20, 9)),
+        ]:
+            models.TrackerEvent.objects.create(user=self.user, kind=kind, timestamp=timestamp)
+        tracker.rebuild_periods()
+        self.assertEqual(tracker.archive_periods(months=2).periods, 1)
+        tracker.end_ongoing_periods(self.user)
+        self.assertEqual(tracker.rebuild_periods(), tracker.RebuildStats(1, 0, 0, 0))
+        period = models.Period.objects.get()
+        self.assertEqual((period.start, period.end), (utc(2016, 2, 20, 9), utc(2016, 6, 15, 12)))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+import io
+import json
+
+import django.test
+from django.contrib import auth
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+
+import pytz
+
+from .. import exports, models
+from .utils import utc
+
+
+class ExportsTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+
+    def test_iter_periods_chunks(self):
+        """Every period is read exactly once, a chunk per query"""
+        start = utc(2016, 6, 1, 9)
+        periods = [
+            # Some share a start, so the id breaks the tie.
+            models.Period.objects.create(
+                user=self.user, start=start + datetime.timedelta(hours=i // 2), end=start
+            )
+            for i in range(7)
+        ]
+        queryset = models.Period.objects.filter(user=self.user)
+        with self.assertNumQueries(3):
+            rows = list(exports.iter_periods(queryset, chunk_size=3))
+        self.assertEqual([row[0] for row in rows], [period.id for period in periods])
+
+    def test_serialize(self):
+        rows = [(1, utc(2016, 6, 1, 9), utc(2016, 6, 1, 17)), (2, utc(2016, 6, 2, 9), None)]
+        london = pytz.timezone('Europe/London')
+        self.assertEqual(''.join(exports.serialize(rows, ['id', 'start', 'end'], 'csv', london)), (
+            'id,start,end\r\n'
+            '1,2016-06-01T10:00:00+01:00,2016-06-01T18:00:00+01:00\r\n'
+            '2,2016-06-02T10:00:00+01:00,\r\n'
+        ))
+        lines = list(exports.serialize(rows, ['id', 'start', 'end'], 'jsonl', pytz.utc))
+        self.assertEqual([json.loads(line) for line in lines], [
+            dict(id=1, start='2016-06-01T09:00:00+00:00', end='2016-06-01T17:00:00+00:00'),
+            dict(id=2, start='2016-06-02T09:00:00+00:00', end=None),
+        ])
+        with self.assertRaises(exports.BadExportException):
+            list(exports.serialize(rows, ['id', 'start', 'end'], 'xml', pytz.utc))
+
+    def test_command_exports_all_users(self):
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=self.user, start=utc(2016, 6, 1, 9))
+        models.Period.objects.create(user=other_user, start=utc(2016, 6, 2, 9), end=utc(2016, 6, 2, 17))
+        models.Period.objects.create(user=other_user, start=utc(2016, 6, 3, 9))
+        stdout = io.StringIO()
+        call_command('export-periods', format='jsonl', end_date='2016-06-03', stdout=stdout)
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([(row['user'], row['start']) for row in rows], [
+            ('username', '2016-06-01T09:00:00+00:00'),
+            ('other', '2016-06-02T09:00:00+00:00'),
+        ])
+
+
+class ExportViewTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.client = django.test.Client()
+        self.client.force_login(self.user)
+
+    def test_export(self):
+        models.Period.objects.create(user=self.user, start=utc(2016, 5, 31, 9), end=utc(2016, 5, 31, 10))
+        period = models.Period.objects.create(user=self.user, start=utc(2016, 6, 1, 9))
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=other_user, start=utc(2016, 6, 1, 9))
+        resp = self.client.get(reverse('export', args=['csv']), {'from': '2016-06-01'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertEqual(b''.join(resp.streaming_content).decode('utf-8'), (
+            'id,start,end\r\n'
+            '%i,2016-06-01T09:00:00+00:00,\r\n' % period.id
+        ))
+
+    def test_export_bad_date(self):
+        resp = self.client.get(reverse('export', args=['jsonl']), {'to': 'tomorrow'})
+        self.assertEqual(resp.status_code, 400)
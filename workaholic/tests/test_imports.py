@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+import io
+import json
+import os
+import tempfile
+
+import django.test
+from django.contrib import auth
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+
+import freezegun
+import pytz
+
+from .. import imports, models
+from .utils import utc
+
+
+class ImportsTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+
+    def _import(self, text, format='csv', **kwargs):
+        rows = imports.parse(io.StringIO(text), format)
+        return imports.import_periods(self.user, rows, pytz.utc, **kwargs)
+
+    def _periods(self):
+        return list(
+            models.Period.objects.filter(user=self.user)
+                .order_by('start')
+                .values_list('start', 'end')
+        )
+
+    def test_import_csv(self):
+        stats = self._import(
+            'start,end\n'
+            '2016-06-01T09:00:00+01:00,2016-06-01T17:00:00+01:00\n'
+            '2016-06-02 09:00,2016-06-02 17:30\n'
+        )
+        self.assertEqual(stats, imports.ImportStats(2, 0, []))
+        self.assertEqual(self._periods(), [
+            (utc(2016, 6, 1, 8), utc(2016, 6, 1, 16)),
+            (utc(2016, 6, 2, 9), utc(2016, 6, 2, 17, 30)),
+        ])
+        # Imported periods are in the event log and the rollup, like any other.
+        self.assertEqual(models.TrackerEvent.objects.filter(user=self.user).count(), 4)
+        self.assertEqual(
+            models.DailyTotal.objects.get(user=self.user, date=datetime.date(2016, 6, 2)).seconds,
+            8.5 * 3600
+        )
+
+    def test_import_jsonl(self):
+        stats = self._import('\n'.join([
+            json.dumps(dict(start='2016-06-01T09:00:00Z', end='2016-06-01T10:00:00Z')),
+            '',
+            'not json',
+            json.dumps(dict(start='2016-06-02T09:00:00Z')),
+            json.dumps(['2016-06-03T09:00:00Z', '2016-06-03T10:00:00Z']),
+        ]), format='jsonl')
+        self.assertEqual(stats, imports.ImportStats(1, 3, [
+            (3, 'Could not read row'),
+            (4, 'Expected an ISO 8601 `end`'),
+            (5, 'Could not read row'),
+        ]))
+
+    def test_invalid_rows(self):
+        with freezegun.freeze_time(utc(2016, 7, 1)):
+            stats = self._import(
+                'start,end\n'
+                '2016-06-01T10:00:00Z,2016-06-01T09:00:00Z\n'
+                '2016-06-31T09:00:00Z,2016-07-01T09:00:00Z\n'
+                '2016-06-30T09:00:00Z,2016-07-01T09:00:00Z\n'
+            )
+        self.assertEqual(stats, imports.ImportStats(0, 3, [
+            (2, 'Period must end after it starts'),
+            (3, 'Expected an ISO 8601 `start`'),
+            (4, 'Period must have ended'),
+        ]))
+
+    def test_overlaps(self):
+        models.Period.objects.create(user=self.user, start=utc(2016, 6, 1, 9), end=utc(2016, 6, 1, 12))
+        models.Period.objects.create(user=self.user, start=utc(2016, 6, 3, 9))
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=other_user, start=utc(2016, 6, 2, 9), end=utc(2016, 6, 2, 17))
+        text = (
+            'start,end\n'
+            '2016-06-01T11:00:00Z,2016-06-01T13:00:00Z\n'  # overlaps existing
+            '2016-06-01T12:00:00Z,2016-06-01T13:00:00Z\n'  # fine
+            '2016-06-02T09:00:00Z,2016-06-02T17:00:00Z\n'  # fine
+            '2016-06-02T16:00:00Z,2016-06-02T18:00:00Z\n'  # overlaps the above (same batch)
+            '2016-06-03T10:00:00Z,2016-06-03T11:00:00Z\n'  # overlaps on-going
+        )
+        stats = self._import(text, batch_size=2)
+        self.assertEqual((stats.imported, stats.rejected), (2, 3))
+        self.assertEqual(sorted(stats.errors), [
+            (2, 'Overlaps an existing period'),
+            (5, 'Overlaps another imported period'),
+            (6, 'Overlaps an existing period'),
+        ])
+        # Within a batch, the later row is rejected.
+        stats = self._import(
+            'start,end\n'
+            '2016-05-01T09:00:00Z,2016-05-01T17:00:00Z\n'
+            '2016-05-01T16:00:00Z,2016-05-01T18:00:00Z\n'
+        )
+        self.assertEqual(stats.errors, [(3, 'Overlaps another imported period')])
+
+    def test_dry_run(self):
+        progress = []
+        stats = self._import(
+            'start,end\n'
+            '2016-06-01T09:00:00Z,2016-06-01T10:00:00Z\n'
+            '2016-06-01T09:30:00Z,2016-06-01T10:00:00Z\n'
+            '2016-06-02T09:00:00Z,2016-06-02T10:00:00Z\n',
+            batch_size=1, dry_run=True, on_batch=progress.append,
+        )
+        self.assertEqual((stats.imported, stats.rejected), (2, 1))
+        self.assertEqual([(p.imported, p.rejected) for p in progress], [(1, 0), (1, 1), (2, 1), (2, 1)])
+        self.assertEqual(self._periods(), [])
+        self.assertFalse(models.TrackerEvent.objects.exists())
+
+    def test_undecodable_lines(self):
+        for format, lines in [
+            ('csv', [b'start,end\n'] + [
+                b'2016-06-0%iT09:00:00Z,2016-06-0%iT10:00:00Z\n' % (day, day) for day in (1, 2, 3)
+            ]),
+            ('jsonl', [
+                b'{"start": "2016-06-0%iT09:00:00Z", "end": "2016-06-0%iT10:00:00Z"}\n' % (day, day)
+                for day in (1, 2, 3)
+            ]),
+        ]:
+            models.Period.objects.all().delete()
+            lines = lines + [b'\xff\n'] + [line.replace(b'-06-', b'-07-') for line in lines[-2:]]
+            rows = imports.parse(imports.decode(lines), format)
+            stats = imports.import_periods(self.user, rows, pytz.utc, batch_size=2)
+            bad_line = 5 if format == 'csv' else 4
+            self.assertEqual(stats, imports.ImportStats(5, 1, [(bad_line, 'Could not read row')]))
+            self.assertEqual(len(self._periods()), 5)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'periods.csv')
+            with open(path, 'w') as f:
+                f.write('start,end\n2016-06-01 09:00,2016-06-01 17:00\n')
+            stdout = io.StringIO()
+            call_command('import-periods', path, user='username', tz='Europe/London', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Imported 1, rejected 0\n')
+        self.assertEqual(self._periods(), [(utc(2016, 6, 1, 8), utc(2016, 6, 1, 16))])
+
+
+class ImportViewTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.client = django.test.Client()
+        self.client.force_login(self.user)
+
+    def test_import(self):
+        body = '\n'.join([
+            json.dumps(dict(start='2016-06-01T09:00:00', end='2016-06-01T17:00:00')),
+            json.dumps(dict(start='2016-06-01T09:00:00')),
+        ])
+        resp = self.client.post(
+            reverse('import', args=['jsonl']) + '?tz=Europe/London',
+            body, content_type='application/x-ndjson'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content.decode('utf-8')), dict(
+            success=True, imported=1, rejected=1,
+            errors=[dict(line=2, error='Expected an ISO 8601 `end`')],
+        ))
+        period = models.Period.objects.get(user=self.user)
+        self.assertEqual(period.start, utc(2016, 6, 1, 8))
+
+    def test_dry_run(self):
+        resp = self.client.post(
+            reverse('import', args=['csv']) + '?dry_run=1',
+            'start,end\n2016-06-01T09:00:00Z,2016-06-01T17:00:00Z\n', content_type='text/csv'
+        )
+        self.assertEqual(json.loads(resp.content.decode('utf-8'))['imported'], 1)
+        self.assertFalse(models.Period.objects.exists())
+
+    def test_undecodable_line(self):
+        body = b'start,end\n' + b''.join(
+            b'2016-06-0%iT09:00:00Z,2016-06-0%iT10:00:00Z\n' % (day, day) for day in (1, 2, 3)
+        ) + b'caf\xe9\n2016-06-04T09:00:00Z,2016-06-04T10:00:00Z\n'
+        with self.settings(IMPORT_BATCH_SIZE=2):
+            resp = self.client.post(reverse('import', args=['csv']), body, content_type='text/csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content.decode('utf-8')), dict(
+            success=True, imported=4, rejected=1,
+            errors=[dict(line=5, error='Could not read row')],
+        ))
+        self.assertEqual(models.Period.objects.filter(user=self.user).count(), 4)
@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import datetime
+import io
 import json
+import threading
+import unittest.mock
 
 import django.test
 from django.conf import settings
 from django.contrib import auth
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from .. import views, models
+import freezegun
+import requests
+
+from .. import fakegcm, views, models, push
 
 
 class PushViewTests(django.test.TestCase):
@@ -83,3 +95,757 @@ class PushViewTests(django.test.TestCase):
     def test_unsubscribes_enforces_post(self):
         resp = views.unsubscribe(self._get_request(dict()))
         self.assertNotEqual(resp.status_code, 200)
+
+    def test_subscribes_web_push(self):
+        identifier = 'https://updates.push.services.mozilla.com/wpush/v1/blah'
+        resp = views.subscribe(self._post_request(dict(identifier=identifier)))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(models.PushSubscription.objects.get().identifier, identifier)
+
+    def test_subscribes_with_keys(self):
+        identifier = 'https://updates.push.services.mozilla.com/wpush/v1/blah'
+        keys = dict(p256dh=_P256DH_KEY, auth=_AUTH_SECRET)
+        resp = views.subscribe(self._post_request(dict(identifier=identifier, keys=keys)))
+        self.assertEqual(resp.status_code, 200)
+        subscription = models.PushSubscription.objects.get()
+        self.assertEqual(subscription.p256dh_key, _P256DH_KEY)
+        self.assertEqual(subscription.auth_secret, _AUTH_SECRET)
+
+    def test_subscribe_rejects_bad_keys(self):
+        identifier = 'https://updates.push.services.mozilla.com/wpush/v1/blah'
+        keys = dict(p256dh='bad', auth=_AUTH_SECRET)
+        resp = views.subscribe(self._post_request(dict(identifier=identifier, keys=keys)))
+        self.assertNotEqual(resp.status_code, 200)
+        self.assertEqual(models.PushSubscription.objects.count(), 0)
+
+    def test_resubscribe_updates_keys(self):
+        identifier = 'https://updates.push.services.mozilla.com/wpush/v1/blah'
+        views.subscribe(self._post_request(dict(identifier=identifier)))
+        keys = dict(p256dh=_P256DH_KEY, auth=_AUTH_SECRET)
+        views.subscribe(self._post_request(dict(identifier=identifier, keys=keys)))
+        subscription = models.PushSubscription.objects.get()
+        self.assertEqual(subscription.p256dh_key, _P256DH_KEY)
+
+    def test_resubscribe_as_another_user(self):
+        """A browser's subscription moves to whoever last logged in with it"""
+        views.subscribe(self._post_request(dict(identifier=self.identifier)))
+        request = self._post_request(dict(identifier=self.identifier))
+        request.user = auth.models.User.objects.create_user('other')
+        resp = views.subscribe(request)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(models.PushSubscription.objects.get().user, request.user)
+
+    def test_subscribe_rejects_unknown_push_service(self):
+        identifier = 'https://push.example.com/blah'
+        resp = views.subscribe(self._post_request(dict(identifier=identifier)))
+        self.assertNotEqual(resp.status_code, 200)
+        self.assertEqual(models.PushSubscription.objects.count(), 0)
+
+
+class UpsertSubscriptionTests(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+
+    def test_creates(self):
+        with self.assertNumQueries(1):
+            push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        subscription = models.PushSubscription.objects.get()
+        self.assertEqual(
+            (subscription.user, subscription.identifier, subscription.p256dh_key, subscription.auth_secret),
+            (self.user, 'id', 'key', 'secret')
+        )
+
+    def test_unchanged_subscription_is_not_written(self):
+        push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        with self.assertNumQueries(1):
+            push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        self.assertEqual(models.PushSubscription.objects.count(), 1)
+
+    def test_updates(self):
+        push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        push.upsert_subscription(self.user, 'id', 'key2', 'secret2')
+        subscription = models.PushSubscription.objects.get()
+        self.assertEqual((subscription.p256dh_key, subscription.auth_secret), ('key2', 'secret2'))
+
+    def test_moves_to_another_user(self):
+        other_user = auth.models.User.objects.create_user('other')
+        push.upsert_subscription(other_user, 'id', 'key', 'secret')
+        push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        self.assertEqual(models.PushSubscription.objects.get().user, self.user)
+
+
+@unittest.mock.patch.object(push, '_supports_upsert', return_value=False)
+class UpdateOrCreateSubscriptionTests(django.test.TestCase):
+    """As UpsertSubscriptionTests, for databases without `ON CONFLICT`"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+
+    def test_creates_and_updates(self, _):
+        push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        with CaptureQueriesContext(connection) as queries:
+            push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        # Unchanged subscriptions are only read.
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('SELECT'))
+        other_user = auth.models.User.objects.create_user('other')
+        push.upsert_subscriptions(other_user, [('id', 'key2', 'secret2'), ('id2', '', '')])
+        self.assertEqual(
+            sorted(models.PushSubscription.objects.values_list('identifier', 'user', 'p256dh_key')),
+            [('id', other_user.id, 'key2'), ('id2', other_user.id, '')]
+        )
+
+    def test_concurrent_insert(self, _):
+        """A subscription inserted by someone else meanwhile is updated instead"""
+        other_user = auth.models.User.objects.create_user('other')
+        bulk_create = models.PushSubscription.objects.bulk_create
+        def racing_bulk_create(objs):
+            models.PushSubscription.objects.create(user=other_user, identifier='id')
+            return bulk_create(objs)
+        with unittest.mock.patch.object(
+            models.PushSubscription.objects, 'bulk_create', side_effect=racing_bulk_create
+        ):
+            push.upsert_subscription(self.user, 'id', 'key', 'secret')
+        subscription = models.PushSubscription.objects.get()
+        self.assertEqual((subscription.user, subscription.p256dh_key), (self.user, 'key'))
+
+
+class SyncSubscriptionsTests(django.test.TestCase):
+
+    mozilla = 'https://updates.push.services.mozilla.com/wpush/v1/'
+
+    def setUp(self):
+        super().setUp()
+        self.factory = django.test.RequestFactory()
+        self.user = auth.models.User.objects.create_user('username')
+        for identifier in ['keep', 'remove', 'update']:
+            models.PushSubscription.objects.create(user=self.user, identifier=identifier)
+
+    def _sync(self, subscriptions):
+        request = self.factory.post(
+            path='',
+            data=json.dumps(dict(subscriptions=subscriptions)),
+            content_type='application/json'
+        )
+        request.user = self.user
+        return views.sync_subscriptions(request)
+
+    def _stored(self):
+        return dict(
+            models.PushSubscription.objects
+                .filter(user=self.user)
+                .values_list('identifier', 'p256dh_key')
+        )
+
+    def test_sync(self):
+        resp = self._sync([
+            dict(identifier=settings.GCM_CHROME_IDENTIFIER_URL + 'keep'),
+            dict(
+                identifier=settings.GCM_CHROME_IDENTIFIER_URL + 'update',
+                keys=dict(p256dh=_P256DH_KEY, auth=_AUTH_SECRET)
+            ),
+            dict(identifier=self.mozilla + 'new'),
+        ])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.content.decode('utf-8')),
+            dict(success=True, changed=2, removed=1)
+        )
+        self.assertEqual(self._stored(), {
+            'keep': '',
+            'update': _P256DH_KEY,
+            self.mozilla + 'new': '',
+        })
+
+    def test_sync_leaves_other_users_alone(self):
+        other_user = auth.models.User.objects.create_user('other')
+        models.PushSubscription.objects.create(user=other_user, identifier='other')
+        self._sync([])
+        self.assertEqual(self._stored(), {})
+        self.assertTrue(models.PushSubscription.objects.filter(identifier='other').exists())
+
+    def test_sync_query_count(self):
+        """One read, one delete and one upsert, however many subscriptions change"""
+        subscriptions = [
+            dict(identifier=self.mozilla + str(i)) for i in range(20)
+        ]
+        # The transaction's savepoint and release make up two more, and Django
+        # collects and deletes the related deliveries as part of the delete.
+        with self.assertNumQueries(7):
+            push.sync_subscriptions(self.user, [
+                views._parse_subscription(**subscription) for subscription in subscriptions
+            ])
+
+    def test_sync_rejects_bad_subscriptions(self):
+        resp = self._sync([dict(identifier='https://push.example.com/')])
+        self.assertEqual(resp.status_code, 400)
+        resp = self._sync(['not a subscription'])
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(len(self._stored()), 3)
+
+
+class ProviderTests(django.test.TestCase):
+
+    mozilla = 'https://updates.push.services.mozilla.com/wpush/v1/'
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+
+    def _web_push_response(self, status_code, headers=None):
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp.headers.update(headers or {})
+        return resp
+
+    def test_get_provider_name(self):
+        self.assertEqual(push.get_provider_name('registration-id'), 'gcm')
+        self.assertEqual(push.get_provider_name(self.mozilla + 'blah'), 'mozilla')
+        self.assertEqual(push.get_provider_name('https://push.example.com/blah'), None)
+
+    def test_web_push_results(self):
+        subscription = models.PushSubscription(id=1, identifier=self.mozilla + 'blah')
+        expected = [
+            (201, {}, dict(message_id='')),
+            (410, {}, dict(error='NotRegistered')),
+            (404, {}, dict(error='NotRegistered')),
+            (503, {'Retry-After': '30'}, dict(error='Unavailable', retry_after='30')),
+            (429, {}, dict(error='Unavailable')),
+            (400, {}, dict(error='HTTP 400')),
+        ]
+        for status_code, headers, result in expected:
+            session = unittest.mock.Mock()
+            session.post.return_value = self._web_push_response(status_code, headers)
+            self.assertEqual(push.notify_web_push_subscription(subscription, session), result)
+
+    def test_web_push_payload_is_encrypted(self):
+        subscription = models.PushSubscription(
+            id=1,
+            identifier=self.mozilla + 'blah',
+            p256dh_key=_P256DH_KEY,
+            auth_secret=_AUTH_SECRET,
+        )
+        session = unittest.mock.Mock()
+        session.post.return_value = self._web_push_response(201)
+        push.notify_web_push_subscription(subscription, session, payload=b'hello')
+        headers = session.post.call_args[1]['headers']
+        self.assertEqual(headers['Content-Encoding'], 'aes128gcm')
+        self.assertGreater(len(session.post.call_args[1]['data']), len(b'hello'))
+
+    def test_web_push_without_keys_has_no_payload(self):
+        subscription = models.PushSubscription(id=1, identifier=self.mozilla + 'blah')
+        session = unittest.mock.Mock()
+        session.post.return_value = self._web_push_response(201)
+        push.notify_web_push_subscription(subscription, session, payload=b'hello')
+        self.assertEqual(session.post.call_args[1]['data'], b'')
+        self.assertNotIn('Content-Encoding', session.post.call_args[1]['headers'])
+
+    def test_build_payloads(self):
+        now = timezone.now()
+        models.Period.objects.create(user=self.user, start=now - datetime.timedelta(minutes=150))
+        with_keys = models.PushSubscription(
+            user=self.user, p256dh_key=_P256DH_KEY, auth_secret=_AUTH_SECRET
+        )
+        other_user = auth.models.User.objects.create_user('other')
+        without_keys = models.PushSubscription(user=other_user)
+        with freezegun.freeze_time(now):
+            payloads = push.build_payloads([with_keys, without_keys])
+        self.assertEqual(list(payloads), [self.user.id])
+        self.assertEqual(
+            json.loads(payloads[self.user.id].decode('utf-8'))['body'],
+            'You have been at work for 2 hours and 30 minutes.'
+        )
+
+    def test_web_push_connection_error_is_retried(self):
+        subscription = models.PushSubscription(id=1, identifier=self.mozilla + 'blah')
+        session = unittest.mock.Mock()
+        session.post.side_effect = requests.ConnectionError()
+        result = push.notify_web_push_subscription(subscription, session)
+        self.assertEqual(result, dict(error='Unavailable'))
+
+    def test_providers_have_their_own_sessions(self):
+        providers = push.get_providers()
+        self.assertIsNot(providers['gcm'].session, providers['mozilla'].session)
+        self.assertEqual(providers['mozilla'].batch_size, 1)
+
+    def test_notify_all_groups_by_provider(self):
+        for i in range(3):
+            models.PushSubscription.objects.create(user=self.user, identifier=str(i))
+            models.PushSubscription.objects.create(
+                user=self.user, identifier=self.mozilla + str(i)
+            )
+        gcm = _gcm_session()
+        def post(url, **kwargs):
+            if url == settings.GCM_URL:
+                return gcm.post(url, **kwargs)
+            return self._web_push_response(410 if url.endswith('1') else 201)
+        session = unittest.mock.Mock()
+        session.post.side_effect = post
+        stats = push.notify_all_subscriptions(session=session)
+        urls = [call[0][0] for call in session.post.call_args_list]
+        # One multicast request for GCM, and a request per Web Push subscription.
+        self.assertEqual(urls.count(settings.GCM_URL), 1)
+        web_push_urls = sorted(url for url in urls if url != settings.GCM_URL)
+        self.assertEqual(web_push_urls, [self.mozilla + str(i) for i in range(3)])
+        self.assertEqual((stats.sent, stats.pruned), (5, 1))
+
+    def test_slow_provider_does_not_hold_up_others(self):
+        """A fast provider carries on into later chunks while a slow one is busy"""
+        for i in range(3):
+            models.PushSubscription.objects.create(user=self.user, identifier=str(i))
+            models.PushSubscription.objects.create(
+                user=self.user, identifier=self.mozilla + str(i)
+            )
+        fast_finished = threading.Event()
+        released = []
+
+        class SlowProvider(push.Provider):
+            def send(self, batch, timeout, payloads):
+                # Stuck until the fast provider has got through every chunk.
+                released.append(fast_finished.wait(timeout=5))
+                return [(subscription, dict(message_id='')) for subscription in batch]
+
+        class FastProvider(push.Provider):
+            sent = 0
+            def send(self, batch, timeout, payloads):
+                FastProvider.sent += len(batch)
+                if FastProvider.sent == 3:
+                    fast_finished.set()
+                return [(subscription, dict(message_id='')) for subscription in batch]
+
+        providers = dict(
+            gcm=SlowProvider('gcm', None, concurrency=1, batch_size=1),
+            mozilla=FastProvider('mozilla', None, concurrency=1, batch_size=1),
+        )
+        with self.settings(PUSH_MAX_PENDING_CHUNKS=6):
+            stats = push.notify_all_subscriptions(chunk_size=1, providers=providers)
+        self.assertEqual(stats.sent, 6)
+        self.assertEqual(released, [True] * 3)
+
+
+# Keys as a browser would give them to us.
+_P256DH_KEY = (
+    'BCVxsr7N_eNgVRqvHtD0zTZsEc6-VV-JvLexhqUzORcxaOzi6-AYWXvTBHm4bjyPjs7Vd8pZGH6SRpkNtoIAiw4'
+)
+_AUTH_SECRET = 'BTBZMqHH6r4Tts7J_aSIgg'
+
+
+def _gcm_session(errors=None, canonical_ids=None, headers=None):
+    """Mock `requests.Session` which replies to multicast requests like GCM
+
+    `errors` maps identifiers to the error GCM should give for them.
+    `canonical_ids` maps identifiers to the canonical ID GCM should give.
+    `headers` are the response headers.
+    """
+    errors = errors or {}
+    canonical_ids = canonical_ids or {}
+    def post(url, data, **kwargs):
+        results = []
+        for identifier in json.loads(data)['registration_ids']:
+            if identifier in errors:
+                results.append(dict(error=errors[identifier]))
+            elif identifier in canonical_ids:
+                results.append(dict(
+                    message_id='message:' + identifier,
+                    registration_id=canonical_ids[identifier]
+                ))
+            else:
+                results.append(dict(message_id='message:' + identifier))
+        resp = unittest.mock.Mock()
+        resp.json.return_value = dict(results=results)
+        resp.headers = headers or {}
+        return resp
+    session = unittest.mock.Mock()
+    session.post.side_effect = post
+    return session
+
+
+class NotifySubscriptionsTests(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.subscriptions = [
+            models.PushSubscription.objects.create(user=self.user, identifier=str(i))
+            for i in range(3)
+        ]
+
+    def test_sends_one_multicast_request(self):
+        session = _gcm_session()
+        push.notify_subscriptions(self.subscriptions, session=session)
+        session.post.assert_called_once_with(
+            settings.GCM_URL,
+            headers=unittest.mock.ANY,
+            data=unittest.mock.ANY,
+            timeout=None,
+        )
+        data = json.loads(session.post.call_args[1]['data'])
+        self.assertEqual(data['registration_ids'], ['0', '1', '2'])
+
+    def test_maps_results_to_subscriptions(self):
+        session = _gcm_session(errors={'1': 'NotRegistered'})
+        results = push.notify_subscriptions(self.subscriptions, session=session)
+        self.assertEqual(results, [
+            (self.subscriptions[0], dict(message_id='message:0')),
+            (self.subscriptions[1], dict(error='NotRegistered')),
+            (self.subscriptions[2], dict(message_id='message:2')),
+        ])
+
+
+class NotifyAllSubscriptionsTests(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        for i in range(5):
+            models.PushSubscription.objects.create(user=self.user, identifier=str(i))
+
+    def _recipients(self, session):
+        return sorted(
+            identifier
+            for call in session.post.call_args_list
+            for identifier in json.loads(call[1]['data'])['registration_ids']
+        )
+
+    def test_notifies_every_subscription(self):
+        session = _gcm_session()
+        stats = push.notify_all_subscriptions(concurrency=2, timeout=1, session=session)
+        self.assertEqual(self._recipients(session), ['0', '1', '2', '3', '4'])
+        self.assertEqual((stats.sent, stats.failed), (5, 0))
+
+    def test_batches_requests(self):
+        session = _gcm_session()
+        push.notify_all_subscriptions(concurrency=2, batch_size=2, session=session)
+        self.assertEqual(session.post.call_count, 3)
+        self.assertEqual(self._recipients(session), ['0', '1', '2', '3', '4'])
+
+    def test_passes_timeout(self):
+        session = _gcm_session()
+        push.notify_all_subscriptions(concurrency=2, timeout=3, batch_size=2, session=session)
+        for call in session.post.call_args_list:
+            self.assertEqual(call[1]['timeout'], 3)
+
+    def test_counts_errors_in_results(self):
+        session = _gcm_session(errors={'3': 'Unavailable', '4': 'MismatchSenderId'})
+        stats = push.notify_all_subscriptions(concurrency=2, session=session)
+        self.assertEqual((stats.sent, stats.failed, stats.retrying), (3, 2, 1))
+        self.assertEqual(models.PushSubscription.objects.count(), 5)
+
+    def test_retryable_errors_go_to_outbox(self):
+        session = _gcm_session(errors={'3': 'Unavailable'})
+        push.notify_all_subscriptions(concurrency=2, session=session)
+        delivery = models.PushDelivery.objects.get()
+        self.assertEqual(delivery.subscription.identifier, '3')
+        self.assertEqual(delivery.status, models.PushDelivery.PENDING)
+        self.assertEqual(delivery.attempts, 1)
+        self.assertEqual(delivery.last_error, 'Unavailable')
+
+    def test_server_errors_go_to_outbox(self):
+        error_resp = requests.Response()
+        error_resp.status_code = 503
+        error_resp.headers['Retry-After'] = '600'
+        session = unittest.mock.Mock()
+        session.post.return_value = error_resp
+        now = timezone.now()
+        with freezegun.freeze_time(now):
+            stats = push.notify_all_subscriptions(concurrency=2, session=session)
+        self.assertEqual((stats.failed, stats.retrying), (5, 5))
+        next_attempts = set(models.PushDelivery.objects.values_list('next_attempt', flat=True))
+        self.assertEqual(next_attempts, {now + datetime.timedelta(seconds=600)})
+
+    def test_client_errors_are_not_retried(self):
+        error_resp = requests.Response()
+        error_resp.status_code = 401
+        session = unittest.mock.Mock()
+        session.post.return_value = error_resp
+        stats = push.notify_all_subscriptions(concurrency=2, session=session)
+        self.assertEqual((stats.failed, stats.retrying), (5, 0))
+        self.assertFalse(models.PushDelivery.objects.exists())
+
+    def test_prunes_dead_subscriptions(self):
+        session = _gcm_session(errors={'1': 'NotRegistered', '3': 'InvalidRegistration'})
+        stats = push.notify_all_subscriptions(concurrency=2, batch_size=2, session=session)
+        self.assertEqual((stats.sent, stats.failed, stats.pruned), (3, 2, 2))
+        identifiers = models.PushSubscription.objects.values_list('identifier', flat=True)
+        self.assertEqual(sorted(identifiers), ['0', '2', '4'])
+
+    def test_canonicalises_subscriptions(self):
+        session = _gcm_session(canonical_ids={'1': 'new1', '2': 'new2'})
+        stats = push.notify_all_subscriptions(concurrency=2, session=session)
+        self.assertEqual(stats.canonicalised, 2)
+        identifiers = models.PushSubscription.objects.values_list('identifier', flat=True)
+        self.assertEqual(sorted(identifiers), ['0', '3', '4', 'new1', 'new2'])
+
+    def test_canonical_id_already_subscribed(self):
+        """A subscription whose canonical ID we already have is removed as a duplicate"""
+        session = _gcm_session(canonical_ids={'1': '0', '2': 'new', '3': 'new'})
+        stats = push.notify_all_subscriptions(concurrency=2, session=session)
+        self.assertEqual(stats.canonicalised, 3)
+        identifiers = models.PushSubscription.objects.values_list('identifier', flat=True)
+        self.assertEqual(sorted(identifiers), ['0', '4', 'new'])
+
+    def test_failure_does_not_stop_others(self):
+        """One failing request is counted, but the rest are still sent"""
+        gcm = _gcm_session()
+        def post(url, data, **kwargs):
+            if '2' in json.loads(data)['registration_ids']:
+                raise requests.ConnectionError()
+            return gcm.post(url, data, **kwargs)
+        session = unittest.mock.Mock()
+        session.post.side_effect = post
+        stats = push.notify_all_subscriptions(concurrency=2, batch_size=1, session=session)
+        self.assertEqual(session.post.call_count, 5)
+        self.assertEqual((stats.sent, stats.failed, stats.retrying), (4, 1, 1))
+
+    def test_chunks(self):
+        session = _gcm_session()
+        stats = push.notify_all_subscriptions(concurrency=2, chunk_size=2, session=session)
+        self.assertEqual(self._recipients(session), ['0', '1', '2', '3', '4'])
+        self.assertEqual((stats.sent, stats.failed), (5, 0))
+
+    def test_shards_cover_all_subscriptions_once(self):
+        session = _gcm_session()
+        for index in range(3):
+            push.notify_all_subscriptions(concurrency=2, shard=(index, 3), session=session)
+        self.assertEqual(self._recipients(session), ['0', '1', '2', '3', '4'])
+
+    def test_resumes_from_checkpoint(self):
+        third = models.PushSubscription.objects.get(identifier='2')
+        models.PushCheckpoint.objects.create(name='test', last_id=third.id)
+        session = _gcm_session()
+        push.notify_all_subscriptions(concurrency=2, checkpoint='test', resume=True, session=session)
+        self.assertEqual(self._recipients(session), ['3', '4'])
+
+    def test_checkpoint_ignored_without_resume(self):
+        """Runs start from the beginning unless asked to resume"""
+        third = models.PushSubscription.objects.get(identifier='2')
+        models.PushCheckpoint.objects.create(name='test', last_id=third.id)
+        session = _gcm_session()
+        push.notify_all_subscriptions(concurrency=2, checkpoint='test', session=session)
+        self.assertEqual(self._recipients(session), ['0', '1', '2', '3', '4'])
+
+    def test_stale_checkpoint_ignored(self):
+        """A checkpoint from an earlier round of notifications isn't resumed"""
+        third = models.PushSubscription.objects.get(identifier='2')
+        with freezegun.freeze_time(timezone.now() - settings.PUSH_CHECKPOINT_MAX_AGE * 2):
+            models.PushCheckpoint.objects.create(name='test', last_id=third.id)
+        session = _gcm_session()
+        push.notify_all_subscriptions(concurrency=2, checkpoint='test', resume=True, session=session)
+        self.assertEqual(self._recipients(session), ['0', '1', '2', '3', '4'])
+
+    def test_removes_checkpoint_when_finished(self):
+        session = _gcm_session()
+        push.notify_all_subscriptions(
+            concurrency=2, chunk_size=2, checkpoint='test', session=session
+        )
+        self.assertFalse(models.PushCheckpoint.objects.exists())
+
+    def test_checkpoint_left_by_crash(self):
+        """A run which dies part way through leaves a checkpoint after the last complete chunk"""
+        gcm = _gcm_session()
+        def post(url, data, **kwargs):
+            if '2' in json.loads(data)['registration_ids']:
+                raise KeyboardInterrupt()
+            return gcm.post(url, data, **kwargs)
+        session = unittest.mock.Mock()
+        session.post.side_effect = post
+        with self.assertRaises(KeyboardInterrupt):
+            push.notify_all_subscriptions(
+                concurrency=1, chunk_size=2, checkpoint='test', session=session
+            )
+        checkpoint = models.PushCheckpoint.objects.get(name='test')
+        self.assertEqual(checkpoint.last_id, models.PushSubscription.objects.get(identifier='1').id)
+
+    def test_outcomes_kept_per_chunk(self):
+        """Only counts are kept across chunks, so memory use stays flat"""
+        session = _gcm_session(errors={'3': 'Unavailable'})
+        providers = push.get_providers(2, None, session)
+        chunks = push.iter_subscription_chunks(2)
+        finished = []
+        push._notify_chunks(
+            chunks, providers, 1,
+            on_chunk=lambda chunk, outcomes: finished.append((len(chunk), outcomes))
+        )
+        self.assertEqual(
+            [(size, outcomes.sent, sorted(outcomes.retries)) for size, outcomes in finished],
+            [(2, 2, []), (2, 1, [models.PushSubscription.objects.get(identifier='3').id]), (1, 1, [])]
+        )
+
+    def test_crash_keeps_retries_from_finished_chunks(self):
+        """Chunks are only checkpointed once their failures are in the outbox"""
+        gcm = _gcm_session(errors={'0': 'Unavailable', '1': 'NotRegistered'})
+        def post(url, data, **kwargs):
+            if '2' in json.loads(data)['registration_ids']:
+                raise KeyboardInterrupt()
+            return gcm.post(url, data, **kwargs)
+        session = unittest.mock.Mock()
+        session.post.side_effect = post
+        with self.assertRaises(KeyboardInterrupt):
+            push.notify_all_subscriptions(
+                concurrency=1, chunk_size=2, checkpoint='test', session=session
+            )
+        self.assertEqual(models.PushDelivery.objects.get().subscription.identifier, '0')
+        self.assertFalse(models.PushSubscription.objects.filter(identifier='1').exists())
+
+
+class FakeGcmServerTests(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        for i in range(10):
+            models.PushSubscription.objects.create(user=self.user, identifier=str(i))
+
+    def test_notifies_through_fake_server(self):
+        with fakegcm.FakeGcmServer() as server, self.settings(GCM_URL=server.url):
+            stats = push.notify_all_subscriptions(concurrency=2, batch_size=3)
+        self.assertEqual((stats.sent, stats.failed), (10, 0))
+
+    def test_not_registered(self):
+        with fakegcm.FakeGcmServer(not_registered_rate=1) as server, self.settings(GCM_URL=server.url):
+            stats = push.notify_all_subscriptions(concurrency=2, batch_size=3)
+        self.assertEqual(stats.pruned, 10)
+        self.assertFalse(models.PushSubscription.objects.exists())
+
+    def test_errors_with_retry_after(self):
+        now = timezone.now()
+        fake = fakegcm.FakeGcmServer(error_rate=1, retry_after=120)
+        with fake as server, self.settings(GCM_URL=server.url), freezegun.freeze_time(now):
+            stats = push.notify_all_subscriptions(concurrency=2, batch_size=3)
+        self.assertEqual(stats.retrying, 10)
+        next_attempts = set(models.PushDelivery.objects.values_list('next_attempt', flat=True))
+        self.assertEqual(next_attempts, {now + datetime.timedelta(seconds=120)})
+
+    def test_benchmark(self):
+        """The benchmark talks only to its own server, and cleans up after itself"""
+        stdout = io.StringIO()
+        call_command(
+            'push-benchmark', subscriptions=20, latency=0, error_rate=0.5, yes=True,
+            stdout=stdout
+        )
+        self.assertIn('Notified 20 subscriptions', stdout.getvalue())
+        self.assertFalse(models.PushDelivery.objects.exists())
+        self.assertEqual(models.PushSubscription.objects.count(), 10)
+        self.assertFalse(auth.models.User.objects.filter(username='push-benchmark').exists())
+
+    def test_benchmark_refuses(self):
+        with self.assertRaises(CommandError):
+            call_command('push-benchmark', subscriptions=1, stdout=io.StringIO())
+        subscription = models.PushSubscription.objects.first()
+        models.PushDelivery.objects.create(subscription=subscription, next_attempt=timezone.now())
+        with self.assertRaises(CommandError):
+            call_command('push-benchmark', subscriptions=1, yes=True, stdout=io.StringIO())
+
+
+class OverdueSubscriptionsTests(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        self.users = {}
+        for name, started in [('overdue', 10), ('recent', 1), ('home', None), ('idle', None)]:
+            user = auth.models.User.objects.create_user(name)
+            models.PushSubscription.objects.create(user=user, identifier=name)
+            if name == 'home':
+                models.Period.objects.create(
+                    user=user,
+                    start=self.now - datetime.timedelta(hours=12),
+                    end=self.now - datetime.timedelta(hours=2),
+                )
+            elif started is not None:
+                models.Period.objects.create(
+                    user=user, start=self.now - datetime.timedelta(hours=started)
+                )
+            self.users[name] = user
+
+    def test_selects_users_at_work_too_long(self):
+        with freezegun.freeze_time(self.now):
+            subscriptions = push.overdue_subscriptions(datetime.timedelta(hours=9))
+        self.assertEqual([s.identifier for s in subscriptions], ['overdue'])
+
+    def test_one_row_per_subscription(self):
+        """Each subscription is only selected once, even with several on-going periods"""
+        models.PushSubscription.objects.create(user=self.users['overdue'], identifier='second')
+        with freezegun.freeze_time(self.now):
+            subscriptions = push.overdue_subscriptions(datetime.timedelta(hours=9))
+        self.assertEqual(sorted(s.identifier for s in subscriptions), ['overdue', 'second'])
+
+    def test_notify_all_only_overdue(self):
+        session = _gcm_session()
+        with freezegun.freeze_time(self.now):
+            stats = push.notify_all_subscriptions(
+                overdue_after=datetime.timedelta(minutes=30), session=session
+            )
+        recipients = json.loads(session.post.call_args[1]['data'])['registration_ids']
+        self.assertEqual(sorted(recipients), ['overdue', 'recent'])
+        self.assertEqual(stats.sent, 2)
+
+
+class OutboxTests(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.now = timezone.now()
+        self.deliveries = [
+            models.PushDelivery.objects.create(
+                subscription=models.PushSubscription.objects.create(
+                    user=self.user, identifier=str(i)
+                ),
+                attempts=1,
+                next_attempt=self.now,
+            )
+            for i in range(3)
+        ]
+
+    def _process(self, session, at=None):
+        with freezegun.freeze_time(at or self.now):
+            return push.process_outbox(concurrency=2, session=session)
+
+    def test_only_attempts_due_deliveries(self):
+        models.PushDelivery.objects.filter(id=self.deliveries[0].id).update(
+            next_attempt=self.now + datetime.timedelta(minutes=1)
+        )
+        session = _gcm_session()
+        self.assertEqual(self._process(session), 2)
+        recipients = json.loads(session.post.call_args[1]['data'])['registration_ids']
+        self.assertEqual(sorted(recipients), ['1', '2'])
+
+    def test_removes_successful_deliveries(self):
+        self._process(_gcm_session())
+        self.assertFalse(models.PushDelivery.objects.exists())
+
+    def test_backs_off_exponentially(self):
+        self._process(_gcm_session(errors={'0': 'Unavailable'}))
+        delivery = models.PushDelivery.objects.get()
+        self.assertEqual(delivery.attempts, 2)
+        self.assertEqual(
+            delivery.next_attempt,
+            self.now + datetime.timedelta(seconds=settings.PUSH_RETRY_BASE_DELAY * 2)
+        )
+
+    def test_honours_retry_after(self):
+        session = _gcm_session(errors={'0': 'Unavailable'}, headers={'Retry-After': '3600'})
+        self._process(session)
+        delivery = models.PushDelivery.objects.get()
+        self.assertEqual(delivery.next_attempt, self.now + datetime.timedelta(seconds=3600))
+
+    def test_gives_up_after_max_attempts(self):
+        models.PushDelivery.objects.update(attempts=settings.PUSH_MAX_ATTEMPTS - 1)
+        self._process(_gcm_session(errors={'0': 'Unavailable'}))
+        delivery = models.PushDelivery.objects.get()
+        self.assertEqual(delivery.status, models.PushDelivery.DEAD)
+        self.assertEqual(delivery.attempts, settings.PUSH_MAX_ATTEMPTS)
+        # Dead deliveries aren't attempted again.
+        session = _gcm_session()
+        self.assertEqual(self._process(session, at=self.now + datetime.timedelta(days=1)), 0)
+        session.post.assert_not_called()
+
+    def test_dead_subscriptions_are_pruned(self):
+        self._process(_gcm_session(errors={'1': 'NotRegistered'}))
+        self.assertFalse(models.PushSubscription.objects.filter(identifier='1').exists())
+        self.assertFalse(models.PushDelivery.objects.exists())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+import json
+
+import django.test
+from django.contrib import auth
+from django.core.urlresolvers import reverse
+
+import freezegun
+import pytz
+
+from .. import models, reports, rollups
+from .utils import utc
+
+
+class ReportsTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.london = pytz.timezone('Europe/London')
+
+    def _period(self, start, hours=None, user=None):
+        end = None
+        if hours is not None:
+            end = start + datetime.timedelta(hours=hours)
+        period = models.Period.objects.create(user=user or self.user, start=start, end=end)
+        # As the tracker would have done when it ended.
+        if end is not None:
+            rollups.add_periods([period])
+        return period
+
+    def test_daily_seconds(self):
+        self._period(utc(2016, 6, 1, 9), hours=2)
+        self._period(utc(2016, 6, 1, 13), hours=4.5)
+        self._period(utc(2016, 6, 3, 9), hours=1)
+        self._period(utc(2016, 6, 1, 9), hours=8, user=auth.models.User.objects.create_user('other'))
+        # One query for the totals, one for periods which cross midnight, and
+        # one for any archived periods.
+        with self.assertNumQueries(3):
+            days = reports.daily_seconds(self.user, self.london)
+        self.assertEqual(list(days.items()), [
+            (datetime.date(2016, 6, 1), 6.5 * 3600),
+            (datetime.date(2016, 6, 3), 3600),
+        ])
+
+    def test_daily_seconds_local_time(self):
+        """Periods are split at midnight in the user's time zone"""
+        # 00:30 to 01:30 on the 2nd in London (BST).
+        self._period(utc(2016, 6, 1, 23, 30), hours=1)
+        days = reports.daily_seconds(self.user, self.london)
+        self.assertEqual(list(days.items()), [(datetime.date(2016, 6, 2), 3600)])
+        # The rollup is kept in UTC.
+        days = reports.daily_seconds(self.user, pytz.utc)
+        self.assertEqual(list(days.items()), [
+            (datetime.date(2016, 6, 1), 1800),
+            (datetime.date(2016, 6, 2), 1800),
+        ])
+
+    @freezegun.freeze_time(utc(2016, 6, 3, 0, 30))
+    def test_daily_seconds_matches_rollup(self):
+        """Reports give the same days whether or not they come from the rollup"""
+        self._period(utc(2016, 6, 1, 9), hours=2)
+        # Crosses midnight in London, but not in UTC.
+        self._period(utc(2016, 6, 1, 22), hours=1.5)
+        self._period(utc(2016, 5, 30, 20), hours=30)
+        # On-going since before midnight in London.
+        self._period(utc(2016, 6, 2, 22, 30))
+        ranges = [(None, None), (datetime.date(2016, 6, 1), datetime.date(2016, 6, 2))]
+        computed = [reports.daily_seconds(self.user, self.london, *r) for r in ranges]
+        with self.settings(TRACKER_ROLLUP_TIME_ZONE='Europe/London'):
+            rollups.rebuild([self.user.id])
+            from_rollup = [reports.daily_seconds(self.user, self.london, *r) for r in ranges]
+        self.assertEqual(computed, from_rollup)
+        self.assertEqual(list(computed[1].items()), [(datetime.date(2016, 6, 1), 6 * 3600)])
+
+    def test_daily_seconds_reads_rollup(self):
+        self._period(utc(2016, 6, 1, 9), hours=2)
+        models.DailyTotal.objects.filter(user=self.user).update(seconds=60)
+        with self.assertNumQueries(2):
+            days = reports.daily_seconds(self.user, pytz.utc)
+        self.assertEqual(list(days.items()), [(datetime.date(2016, 6, 1), 60)])
+
+    def test_daily_seconds_range(self):
+        self._period(utc(2016, 5, 31, 23, 30), hours=1)
+        self._period(utc(2016, 6, 1, 9), hours=1)
+        self._period(utc(2016, 6, 2, 9), hours=1)
+        days = reports.daily_seconds(
+            self.user, self.london, datetime.date(2016, 6, 1), datetime.date(2016, 6, 2)
+        )
+        self.assertEqual(list(days.items()), [(datetime.date(2016, 6, 1), 2 * 3600)])
+
+    def test_ongoing_period_counts_until_now(self):
+        self._period(utc(2016, 6, 1, 9))
+        with freezegun.freeze_time(utc(2016, 6, 1, 12, 15)):
+            days = reports.daily_seconds(self.user, pytz.utc)
+        self.assertAlmostEqual(days[datetime.date(2016, 6, 1)], 3.25 * 3600, places=1)
+
+    def test_worked_hours_rolls_up(self):
+        # Wednesday, Sunday and the following Monday.
+        self._period(utc(2016, 6, 1, 9), hours=1)
+        self._period(utc(2016, 6, 5, 9), hours=2)
+        self._period(utc(2016, 6, 6, 9), hours=4)
+        self._period(utc(2016, 7, 1, 9), hours=8)
+        self.assertEqual(reports.worked_hours(self.user, 'week', pytz.utc), [
+            (datetime.date(2016, 5, 30), 3),
+            (datetime.date(2016, 6, 6), 4),
+            (datetime.date(2016, 6, 27), 8),
+        ])
+        self.assertEqual(reports.worked_hours(self.user, 'month', pytz.utc), [
+            (datetime.date(2016, 6, 1), 7),
+            (datetime.date(2016, 7, 1), 8),
+        ])
+
+    def test_bad_parameters(self):
+        with self.assertRaises(reports.BadReportException):
+            reports.get_timezone('Mars/Olympus_Mons')
+        with self.assertRaises(reports.BadReportException):
+            reports.parse_date('2016-02-30')
+        with self.assertRaises(reports.BadReportException):
+            reports.parse_date('yesterday')
+        with self.assertRaises(reports.BadReportException):
+            reports.worked_hours(self.user, 'fortnight', pytz.utc)
+
+
+class ReportViewTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.client = django.test.Client()
+        self.client.force_login(self.user)
+
+    def test_report(self):
+        start = utc(2016, 6, 1, 23, 30)
+        models.Period.objects.create(user=self.user, start=start, end=start + datetime.timedelta(hours=3))
+        resp = self.client.get(reverse('report', args=['day']), dict(
+            tz='Europe/London', to='2016-06-03'
+        ))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content.decode('utf-8')), dict(
+            success=True, interval='day', tz='Europe/London',
+            hours=[dict(date='2016-06-02', hours=3)],
+        ))
+
+    def test_report_bad_timezone(self):
+        resp = self.client.get(reverse('report', args=['month']), dict(tz='Nowhere'))
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.content.decode('utf-8'))['success'], False)
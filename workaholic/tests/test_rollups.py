@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+import io
+
+import django.test
+from django.contrib import auth
+from django.core.cache import cache
+from django.core.management import call_command
+
+import freezegun
+import pytz
+
+from .. import models, rollups, tracker
+from .utils import utc
+
+
+class SplitByDayTestCase(django.test.SimpleTestCase):
+
+    def test_same_day(self):
+        self.assertEqual(
+            list(rollups.split_by_day(utc(2016, 6, 1, 9), utc(2016, 6, 1, 17), pytz.utc)),
+            [(datetime.date(2016, 6, 1), 8 * 3600)]
+        )
+
+    def test_crosses_midnight(self):
+        self.assertEqual(
+            list(rollups.split_by_day(utc(2016, 6, 1, 22), utc(2016, 6, 3, 1), pytz.utc)),
+            [
+                (datetime.date(2016, 6, 1), 2 * 3600),
+                (datetime.date(2016, 6, 2), 24 * 3600),
+                (datetime.date(2016, 6, 3), 1 * 3600),
+            ]
+        )
+
+    def test_local_midnight(self):
+        # The clocks went forward in London on 27th March 2016.
+        london = pytz.timezone('Europe/London')
+        self.assertEqual(
+            list(rollups.split_by_day(utc(2016, 3, 26, 23), utc(2016, 3, 28, 0), london)),
+            [
+                (datetime.date(2016, 3, 26), 1 * 3600),
+                (datetime.date(2016, 3, 27), 23 * 3600),
+                (datetime.date(2016, 3, 28), 1 * 3600),
+            ]
+        )
+
+
+class RollupsTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = auth.models.User.objects.create_user('username')
+
+    def _totals(self):
+        return list(
+            models.DailyTotal.objects.filter(user=self.user)
+                .order_by('date')
+                .values_list('date', 'seconds')
+        )
+
+    def test_ending_period_adds_to_totals(self):
+        with freezegun.freeze_time(utc(2016, 6, 1, 22)):
+            tracker.start_period(self.user)
+        self.assertEqual(self._totals(), [])
+        with freezegun.freeze_time(utc(2016, 6, 2, 3)):
+            tracker.start_period(self.user)
+        with freezegun.freeze_time(utc(2016, 6, 2, 4)):
+            tracker.end_ongoing_periods(self.user)
+        self.assertEqual(self._totals(), [
+            (datetime.date(2016, 6, 1), 2 * 3600),
+            (datetime.date(2016, 6, 2), 4 * 3600),
+        ])
+
+    def test_add_periods(self):
+        other_user = auth.models.User.objects.create_user('other')
+        models.DailyTotal.objects.create(user=self.user, date=datetime.date(2016, 6, 1), seconds=60)
+        models.DailyTotal.objects.create(user=self.user, date=datetime.date(2016, 6, 2), seconds=60)
+        models.DailyTotal.objects.create(user=other_user, date=datetime.date(2016, 6, 3), seconds=60)
+        with self.assertNumQueries(3):
+            rollups.add_periods([
+                models.Period(user=self.user, start=utc(2016, 6, 1, 23), end=utc(2016, 6, 2, 1)),
+                models.Period(user=self.user, start=utc(2016, 6, 3, 9), end=utc(2016, 6, 3, 10)),
+                models.Period(user=other_user, start=utc(2016, 6, 1, 9), end=utc(2016, 6, 1, 10)),
+            ])
+        self.assertEqual(self._totals(), [
+            (datetime.date(2016, 6, 1), 3660),
+            (datetime.date(2016, 6, 2), 3660),
+            (datetime.date(2016, 6, 3), 3600),
+        ])
+        self.assertEqual(
+            sorted(models.DailyTotal.objects.filter(user=other_user).values_list('date', 'seconds')),
+            [(datetime.date(2016, 6, 1), 3600), (datetime.date(2016, 6, 3), 60)]
+        )
+
+    def test_ongoing_period_is_counted(self):
+        with freezegun.freeze_time(utc(2016, 6, 1, 9)):
+            tracker.start_period(self.user)
+        with freezegun.freeze_time(utc(2016, 6, 1, 10)):
+            tracker.end_ongoing_periods(self.user)
+        with freezegun.freeze_time(utc(2016, 6, 1, 23)):
+            tracker.start_period(self.user)
+        with freezegun.freeze_time(utc(2016, 6, 2, 1)):
+            days = rollups.daily_seconds(self.user)
+            self.assertEqual(list(days.items()), [
+                (datetime.date(2016, 6, 1), 2 * 3600),
+                (datetime.date(2016, 6, 2), 1 * 3600),
+            ])
+            days = rollups.daily_seconds(self.user, end_date=datetime.date(2016, 6, 2))
+            self.assertEqual(list(days), [datetime.date(2016, 6, 1)])
+
+    def test_rebuild_daily_totals(self):
+        for day in (1, 2, 3):
+            models.Period.objects.create(
+                user=self.user, start=utc(2016, 6, day, 9), end=utc(2016, 6, day, 17)
+            )
+        models.Period.objects.create(user=self.user, start=utc(2016, 6, 4, 9))
+        models.DailyTotal.objects.create(user=self.user, date=datetime.date(2016, 1, 1), seconds=1)
+        stdout = io.StringIO()
+        call_command('rebuild-daily-totals', batch_size=1, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Rebuilt 3 daily totals\n')
+        self.assertEqual(self._totals(), [
+            (datetime.date(2016, 6, day), 8 * 3600) for day in (1, 2, 3)
+        ])
+
+    def test_rebuild_periods_rebuilds_totals(self):
+        models.TrackerEvent.objects.create(
+            user=self.user, kind=models.TrackerEvent.START, timestamp=utc(2016, 6, 1, 9)
+        )
+        models.TrackerEvent.objects.create(
+            user=self.user, kind=models.TrackerEvent.END, timestamp=utc(2016, 6, 1, 10)
+        )
+        tracker.rebuild_periods()
+        self.assertEqual(self._totals(), [(datetime.date(2016, 6, 1), 3600)])
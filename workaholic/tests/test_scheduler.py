@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+import unittest.mock
+
+import django.test
+from django.conf import settings
+from django.contrib import auth
+from django.utils import timezone
+
+import freezegun
+
+from .. import models, push, scheduler, tracker
+
+
+class SchedulerTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.now = timezone.now()
+
+    def _next_notify_at(self, user=None):
+        return models.NotificationSchedule.objects.get(user=user or self.user).next_notify_at
+
+    def test_start_period_schedules_notification(self):
+        with freezegun.freeze_time(self.now):
+            tracker.start_period(self.user)
+        self.assertEqual(self._next_notify_at(), self.now + settings.PUSH_OVERDUE_AFTER)
+
+    def test_end_period_clears_notification(self):
+        with freezegun.freeze_time(self.now):
+            tracker.start_period(self.user)
+            tracker.end_ongoing_periods(self.user)
+        self.assertEqual(self._next_notify_at(), None)
+
+    def test_next_due(self):
+        self.assertEqual(scheduler.next_due(), None)
+        with freezegun.freeze_time(self.now):
+            tracker.start_period(self.user)
+        self.assertEqual(scheduler.next_due(), self.now + settings.PUSH_OVERDUE_AFTER)
+
+    def test_notify_due_only_notifies_due_users(self):
+        other_user = auth.models.User.objects.create_user('other')
+        with freezegun.freeze_time(self.now):
+            tracker.start_period(self.user)
+        with freezegun.freeze_time(self.now + datetime.timedelta(hours=1)):
+            tracker.start_period(other_user)
+
+        with unittest.mock.patch.object(push, 'notify_all_subscriptions') as mocked:
+            with freezegun.freeze_time(self.now + settings.PUSH_OVERDUE_AFTER):
+                self.assertEqual(scheduler.notify_due(), 1)
+        self.assertEqual(mocked.call_args[1]['user_ids'], [self.user.id])
+        self.assertEqual(self._next_notify_at(), None)
+        self.assertNotEqual(self._next_notify_at(other_user), None)
+
+    def test_notify_due_nothing_due(self):
+        with freezegun.freeze_time(self.now):
+            tracker.start_period(self.user)
+        with unittest.mock.patch.object(push, 'notify_all_subscriptions') as mocked:
+            with freezegun.freeze_time(self.now):
+                self.assertEqual(scheduler.notify_due(), 0)
+        mocked.assert_not_called()
@@ -2,11 +2,18 @@
 # encoding: utf-8
 
 import datetime
+import io
+import json
 import unittest
 
 import django.test
 from django.contrib import auth
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
 from django.core.urlresolvers import reverse
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 import freezegun
@@ -18,6 +25,7 @@ class TrackerTestCase(django.test.TestCase):
 
     def setUp(self):
         super().setUp()
+        cache.clear()
         self.user = auth.models.User.objects.create_user('username')
 
     def test_start_period(self):
@@ -39,17 +47,79 @@ class TrackerTestCase(django.test.TestCase):
         period = models.Period.objects.get()
         self.assertEqual(period.end, end_datetime)
 
-    def test_end_multiple_periods(self):
+    def test_end_period_returns_ended(self):
         start_datetime = timezone.now()
-        models.Period.objects.create(user=self.user, start=start_datetime)
-        models.Period.objects.create(user=self.user, start=start_datetime)
-        models.Period.objects.create(user=self.user, start=start_datetime)
-        end_datetime = start_datetime + datetime.timedelta(days=1)
+        period = models.Period.objects.create(user=self.user, start=start_datetime)
+        end_datetime = start_datetime + datetime.timedelta(hours=1)
         with freezegun.freeze_time(end_datetime):
+            ended = tracker.end_ongoing_periods(self.user)
+        self.assertEqual(ended, [period])
+        self.assertEqual(ended[0].start, start_datetime)
+        self.assertEqual(ended[0].end, end_datetime)
+        self.assertEqual(tracker.end_ongoing_periods(self.user), [])
+
+    def test_end_period_single_update(self):
+        """Periods are ended by one UPDATE, rather than saved one at a time"""
+        tracker.start_period(self.user)
+        with CaptureQueriesContext(connection) as queries:
             tracker.end_ongoing_periods(self.user)
-        periods = models.Period.objects.all()
-        end_datetimes = [period.end for period in periods]
-        self.assertEqual(end_datetimes, [end_datetime] * 3)
+        period_queries = [
+            query['sql'].split()[0] for query in queries
+            if 'workaholic_period' in query['sql']
+        ]
+        self.assertEqual(period_queries, ['SELECT', 'UPDATE'])
+
+    def _tap_writes(self, tap):
+        with CaptureQueriesContext(connection) as queries:
+            tap(self.user)
+        return [
+            ' '.join(query['sql'].split()[:3]) for query in queries
+            if not query['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE'))
+        ]
+
+    def test_taps_only_write_what_changed(self):
+        """A tap only writes its event and what it changes"""
+        self.assertEqual(self._tap_writes(tracker.end_ongoing_periods), [
+            'INSERT INTO "workaholic_trackerstate"',
+            'INSERT INTO "workaholic_trackerevent"',
+        ])
+        # Nothing was on-going, so no Period was read or DailyTotal touched.
+        with CaptureQueriesContext(connection) as queries:
+            tracker.start_period(self.user)
+        self.assertFalse(any(
+            'workaholic_dailytotal' in query['sql'] or query['sql'].startswith('SELECT "workaholic_period"')
+            for query in queries
+        ))
+        self.assertEqual(self._tap_writes(tracker.end_ongoing_periods), [
+            'INSERT INTO "workaholic_trackerevent"',
+            'UPDATE "workaholic_period" SET',
+            'INSERT INTO "workaholic_dailytotal"',
+            'UPDATE "workaholic_trackerstate" SET',
+            'UPDATE "workaholic_notificationschedule" SET',
+        ])
+        self.assertEqual(self._tap_writes(tracker.end_ongoing_periods), [
+            'INSERT INTO "workaholic_trackerevent"',
+        ])
+
+    def test_at_most_one_ongoing_period(self):
+        """The database won't let a user have more than one on-going period"""
+        start_datetime = timezone.now()
+        models.Period.objects.create(user=self.user, start=start_datetime)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.Period.objects.create(user=self.user, start=start_datetime)
+        # Other users and ended periods aren't affected.
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=other_user, start=start_datetime)
+        models.Period.objects.create(user=self.user, start=start_datetime, end=start_datetime)
+
+    def test_end_period_leaves_other_users_alone(self):
+        other_user = auth.models.User.objects.create_user('other')
+        tracker.start_period(self.user)
+        other_period = tracker.start_period(other_user)
+        tracker.end_ongoing_periods(self.user)
+        self.assertEqual(models.Period.objects.get(pk=other_period.pk).end, None)
+        self.assertTrue(tracker.has_ongoing_period(other_user))
+        self.assertFalse(tracker.has_ongoing_period(self.user))
 
     def test_start_period_stops_ongoing(self):
         start_datetime1 = timezone.now()
@@ -62,9 +132,394 @@ class TrackerTestCase(django.test.TestCase):
         self.assertEqual(period1.end, start_datetime2)
 
     def test_has_ongoing_period(self):
-        start_datetime1 = timezone.now()
-        period1 = models.Period.objects.create(user=self.user, start=start_datetime1)
+        self.assertFalse(tracker.has_ongoing_period(self.user))
+        tracker.start_period(self.user)
+        self.assertTrue(tracker.has_ongoing_period(self.user))
+        tracker.end_ongoing_periods(self.user)
+        self.assertFalse(tracker.has_ongoing_period(self.user))
+
+    def test_state_not_cached_by_default(self):
+        """Without a shared cache, every lookup reads the user's TrackerState"""
+        period = tracker.start_period(self.user)
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+        self.assertIsNone(cache.get(tracker._state_cache_key(self.user.id)))
+
+    @django.test.override_settings(TRACKER_STATE_CACHE_TIMEOUT=3600)
+    def test_has_ongoing_period_is_cached(self):
+        period = tracker.start_period(self.user)
+        cache.clear()
+        # A cold cache costs a primary key lookup of the user's TrackerState...
+        with self.assertNumQueries(1):
+            self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+        # ... after which we don't need the database at all.
+        with self.assertNumQueries(0):
+            self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+            self.assertTrue(tracker.has_ongoing_period(self.user))
+
+    @django.test.override_settings(TRACKER_STATE_CACHE_TIMEOUT=3600)
+    def test_state_cached_on_commit(self):
+        """Writes replace the cached state once their transaction commits"""
+        # TestCase never commits, so run the callbacks it would have run.
+        with unittest.mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            period = tracker.start_period(self.user)
+            with self.assertNumQueries(0):
+                self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+            tracker.end_ongoing_periods(self.user)
+            with self.assertNumQueries(0):
+                self.assertFalse(tracker.has_ongoing_period(self.user))
+
+    @django.test.override_settings(TRACKER_STATE_CACHE_TIMEOUT=3600)
+    def test_stale_read_does_not_overwrite_commit(self):
+        """A read which started before a write commits can't cache the old state"""
+        # The reader misses the cache and reads the old, committed state...
+        with unittest.mock.patch.object(tracker, 'cache') as reader_cache:
+            reader_cache.get.return_value = None
+            self.assertIsNone(tracker.get_current_period_id(self.user))
+        # ... then the write commits...
+        committed = []
+        with unittest.mock.patch.object(transaction, 'on_commit', committed.append):
+            period = tracker.start_period(self.user)
+        for callback in committed:
+            callback()
+        # ... before the reader gets round to caching what it read.
+        for name, args, kwargs in reader_cache.method_calls:
+            if name in ('add', 'set'):
+                getattr(cache, name)(*args, **kwargs)
+        with self.assertNumQueries(0):
+            self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+
+    @django.test.override_settings(TRACKER_STATE_CACHE_TIMEOUT=3600)
+    def test_rebuild_caches_state_on_commit(self):
+        with unittest.mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            period = tracker.start_period(self.user)
+            tracker.rebuild_periods()
+        with self.assertNumQueries(0):
+            self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+
+
+class TrackerEventTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = auth.models.User.objects.create_user('username')
+        self.start = timezone.now()
+
+    def _event(self, kind, hours):
+        return models.TrackerEvent.objects.create(
+            user=self.user,
+            kind=kind,
+            timestamp=self.start + datetime.timedelta(hours=hours)
+        )
+
+    def _periods(self):
+        return list(
+            models.Period.objects.filter(user=self.user)
+                .order_by('start')
+                .values_list('start', 'end')
+        )
+
+    def test_taps_are_logged(self):
+        with freezegun.freeze_time(self.start):
+            tracker.start_period(self.user)
+        with freezegun.freeze_time(self.start + datetime.timedelta(hours=1)):
+            tracker.end_ongoing_periods(self.user)
+        events = models.TrackerEvent.objects.order_by('id').values_list('kind', 'timestamp')
+        self.assertEqual(list(events), [
+            (models.TrackerEvent.START, self.start),
+            (models.TrackerEvent.END, self.start + datetime.timedelta(hours=1)),
+        ])
+
+    def test_rebuild_matches_projection(self):
+        for hours in range(3):
+            with freezegun.freeze_time(self.start + datetime.timedelta(hours=hours)):
+                tracker.start_period(self.user)
+        with freezegun.freeze_time(self.start + datetime.timedelta(hours=4)):
+            tracker.end_ongoing_periods(self.user)
+            tracker.start_period(self.user)
+        projected = self._periods()
+        ids = list(models.Period.objects.order_by('start').values_list('id', flat=True))
+        self.assertEqual(tracker.rebuild_periods(), tracker.RebuildStats(4, 0, 0, 0))
+        self.assertEqual(self._periods(), projected)
+        # Nothing changed, so the Periods keep their ids.
+        self.assertEqual(list(models.Period.objects.order_by('start').values_list('id', flat=True)), ids)
+        self.assertTrue(tracker.has_ongoing_period(self.user))
+
+    def test_rebuild_only_writes_differences(self):
+        self._event(models.TrackerEvent.START, 0)
+        self._event(models.TrackerEvent.END, 1)
+        self._event(models.TrackerEvent.START, 2)
+        self._event(models.TrackerEvent.END, 3)
+        tracker.rebuild_periods()
+        kept = models.Period.objects.get(start=self.start)
+        # A Period with the wrong end, and one which no events account for.
+        models.Period.objects.filter(start=self.start + datetime.timedelta(hours=2)).update(end=None)
+        models.Period.objects.create(
+            user=self.user,
+            start=self.start + datetime.timedelta(hours=5),
+            end=self.start + datetime.timedelta(hours=6),
+        )
+        self.assertEqual(tracker.rebuild_periods(), tracker.RebuildStats(2, 0, 1, 1))
+        hours = lambda n: self.start + datetime.timedelta(hours=n)
+        self.assertEqual(self._periods(), [(hours(0), hours(1)), (hours(2), hours(3))])
+        self.assertEqual(models.Period.objects.get(start=self.start).id, kept.id)
+
+    def test_rebuild_pairs_events(self):
+        self._event(models.TrackerEvent.END, 0)
+        self._event(models.TrackerEvent.START, 1)
+        self._event(models.TrackerEvent.START, 2)
+        self._event(models.TrackerEvent.END, 3)
+        self._event(models.TrackerEvent.END, 4)
+        self.assertEqual(tracker.rebuild_periods(batch_size=1), tracker.RebuildStats(2, 2, 0, 0))
+        hours = lambda n: self.start + datetime.timedelta(hours=n)
+        self.assertEqual(self._periods(), [(hours(1), hours(2)), (hours(2), hours(3))])
+        self.assertFalse(tracker.has_ongoing_period(self.user))
+
+    def test_rebuild_updates_state(self):
+        # The cached state is replaced, as the rebuild may change it.
+        self.assertFalse(tracker.has_ongoing_period(self.user))
+        self._event(models.TrackerEvent.START, 0)
+        call_command('rebuild-periods', user_ids=[self.user.id], stdout=io.StringIO())
+        period = models.Period.objects.get()
+        self.assertEqual(period.start, self.start)
+        self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+
+
+class HistoryTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        start = timezone.now()
+        # Created out of order, with some sharing a start.
+        self.periods = [
+            models.Period.objects.create(
+                user=self.user,
+                start=start - datetime.timedelta(hours=hours),
+                end=start,
+            )
+            for hours in [3, 1, 2, 1, 0, 2, 3]
+        ]
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=other_user, start=start)
+
+    def test_pages(self):
+        expected = sorted(self.periods, key=lambda period: (period.start, period.id), reverse=True)
+        pages = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                periods, cursor = tracker.get_history(self.user, cursor, limit=3)
+            pages.append([period.id for period in periods])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [
+            [period.id for period in expected[0:3]],
+            [period.id for period in expected[3:6]],
+            [period.id for period in expected[6:7]],
+        ])
+
+    def test_bad_cursor(self):
+        for cursor in ['!', 'bm90IGEgY3Vyc29y', tracker.encode_cursor(self.periods[0])[:-4]]:
+            with self.assertRaises(tracker.BadCursorException):
+                tracker.get_history(self.user, cursor)
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite query plan')
+    def test_uses_index(self):
+        """Pages are read in order from the (user, start) index, without sorting"""
+        _, cursor = tracker.get_history(self.user, limit=3)
+        start, id = tracker._decode_cursor(cursor)
+        periods = (
+            models.Period.objects.filter(user=self.user, start__lte=start)
+                .filter(Q(start__lt=start) | Q(id__lt=id))
+                .order_by('-start', '-id')[:4]
+        )
+        sql, params = periods.query.sql_with_params()
+        with connection.cursor() as db:
+            db.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row) for row in db.fetchall())
+        self.assertIn('user_id=? AND start<?', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_view(self):
+        client = django.test.Client()
+        client.force_login(self.user)
+        resp = client.get(reverse('history'), dict(limit=5))
+        data = json.loads(resp.content.decode('utf-8'))
+        self.assertEqual(len(data['periods']), 5)
+        resp = client.get(reverse('history'), dict(limit=5, cursor=data['next']))
+        data = json.loads(resp.content.decode('utf-8'))
+        self.assertEqual(len(data['periods']), 2)
+        self.assertEqual(data['next'], None)
+        self.assertEqual(set(data['periods'][0]), {'id', 'start', 'end'})
+        for params in [dict(limit=0), dict(limit='ten'), dict(cursor='!')]:
+            resp = client.get(reverse('history'), params)
+            self.assertEqual(resp.status_code, 400)
+
+
+class OverlappingPeriodsTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = auth.models.User.objects.create_user('username')
+        self.day = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.periods = [
+            models.Period.objects.create(user=self.user, start=self._at(0, 9), end=self._at(0, 17)),
+            models.Period.objects.create(user=self.user, start=self._at(1, 9), end=self._at(1, 17)),
+            models.Period.objects.create(user=self.user, start=self._at(2, 9)),
+        ]
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=other_user, start=self._at(0, 0))
+
+    def _at(self, days, hours):
+        return self.day + datetime.timedelta(days=days, hours=hours)
+
+    def _overlapping(self, start, end):
+        with self.assertNumQueries(1):
+            periods = tracker.get_overlapping_periods(self.user, start, end)
+        return [self.periods.index(period) for period in periods]
+
+    def test_overlapping(self):
+        self.assertEqual(self._overlapping(self._at(0, 12), self._at(1, 12)), [0, 1])
+        self.assertEqual(self._overlapping(self._at(0, 0), self._at(1, 0)), [0])
+        self.assertEqual(self._overlapping(self._at(1, 18), self._at(2, 8)), [])
+        # Ranges are half-open.
+        self.assertEqual(self._overlapping(self._at(0, 17), self._at(1, 9)), [])
+
+    def test_ongoing(self):
+        self.assertEqual(self._overlapping(self._at(1, 12), None), [1, 2])
+        self.assertEqual(self._overlapping(self._at(5, 0), self._at(6, 0)), [2])
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite query plan')
+    def test_bounded_scan(self):
+        """Only Periods from `start` on are scanned, not the user's whole history"""
+        for end in [self._at(2, 0), None]:
+            with CaptureQueriesContext(connection) as queries:
+                tracker.get_overlapping_periods(self.user, self._at(1, 12), end)
+            with connection.cursor() as db:
+                db.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+                plan = ' '.join(str(row) for row in db.fetchall())
+            self.assertIn('user_id=? AND start>?', plan)
+            # The earlier Periods are only probed for the latest one.
+            self.assertNotIn('SCAN', plan)
+
+    def test_view(self):
+        client = django.test.Client()
+        client.force_login(self.user)
+        resp = client.get(reverse('periods'), {
+            'from': self.day.date().isoformat(),
+            'to': (self.day + datetime.timedelta(days=1)).date().isoformat(),
+        })
+        data = json.loads(resp.content.decode('utf-8'))
+        self.assertEqual([period['id'] for period in data['periods']], [self.periods[0].id])
+        resp = client.get(reverse('periods'), {'to': self.day.date().isoformat()})
+        self.assertEqual(resp.status_code, 400)
+
+
+class CompactPeriodsTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = auth.models.User.objects.create_user('username')
+        self.day = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def _at(self, hours):
+        return self.day + datetime.timedelta(hours=hours)
+
+    def _period(self, start, end=None):
+        return models.Period.objects.create(
+            user=self.user, start=self._at(start), end=self._at(end) if end is not None else None
+        )
+
+    def _periods(self):
+        return [
+            (start, end)
+            for start, end in models.Period.objects.filter(user=self.user)
+                .order_by('start').values_list('start', 'end')
+        ]
+
+    def test_merges_fragments(self):
+        self._period(9, 10)
+        self._period(10, 11)
+        self._period(11 + 1 / 120, 12)  # 30 seconds later
+        self._period(13, 14)
+        self._period(13.5, 13.75)  # overlaps
+        other_user = auth.models.User.objects.create_user('other')
+        models.Period.objects.create(user=other_user, start=self._at(9), end=self._at(10))
+        models.Period.objects.create(user=other_user, start=self._at(10), end=self._at(11))
+        stats = tracker.compact_periods(user_ids=[self.user.id], batch_size=1)
+        self.assertEqual(stats, tracker.CompactStats(users=1, updated=2, merged=3, ended=0))
+        self.assertEqual(self._periods(), [(self._at(9), self._at(12)), (self._at(13), self._at(14))])
+        self.assertEqual(
+            models.DailyTotal.objects.get(user=self.user, date=self.day.date()).seconds,
+            4 * 3600
+        )
+        self.assertEqual(models.Period.objects.filter(user=other_user).count(), 2)
+
+    def test_gap(self):
+        self._period(9, 10)
+        self._period(10.25, 11)
+        tracker.compact_periods()
+        self.assertEqual(len(self._periods()), 2)
+        tracker.compact_periods(gap=datetime.timedelta(minutes=15))
+        self.assertEqual(self._periods(), [(self._at(9), self._at(11))])
+
+    def test_merges_into_ongoing(self):
+        tracker.start_period(self.user)
+        earlier = self._period(-2, -1)
+        models.Period.objects.filter(pk=earlier.pk).update(end=timezone.now())
+        tracker.compact_periods(gap=datetime.timedelta(hours=1))
+        period = models.Period.objects.get(user=self.user)
+        self.assertEqual((period.start, period.end), (self._at(-2), None))
+        self.assertEqual(tracker.get_current_period_id(self.user), period.id)
+
+    def test_ends_stray_ongoing(self):
+        self._period(9)
+        self._period(11, 12)
+        stats = tracker.compact_periods()
+        self.assertEqual(stats.ended, 1)
+        self.assertEqual(self._periods(), [(self._at(9), self._at(12))])
+
+    def test_close_after(self):
+        with freezegun.freeze_time(self._at(-30)):
+            tracker.start_period(self.user)
         self.assertTrue(tracker.has_ongoing_period(self.user))
+        with freezegun.freeze_time(self._at(0)):
+            tracker.compact_periods(close_after=datetime.timedelta(hours=48))
+            self.assertEqual(self._periods(), [(self._at(-30), None)])
+            tracker.compact_periods(close_after=datetime.timedelta(hours=24))
+        self.assertEqual(self._periods(), [(self._at(-30), self._at(-6))])
+        self.assertFalse(tracker.has_ongoing_period(self.user))
+        self.assertIsNone(models.NotificationSchedule.objects.get(user=self.user).next_notify_at)
+
+    def test_survives_rebuild(self):
+        for start, end in [(-30, -29), (-29, -28), (-28 + 1 / 120, -27), (-26, None)]:
+            with freezegun.freeze_time(self._at(start)):
+                tracker.start_period(self.user)
+            if end is not None:
+                with freezegun.freeze_time(self._at(end)):
+                    tracker.end_ongoing_periods(self.user)
+        with freezegun.freeze_time(self._at(0)):
+            tracker.compact_periods(close_after=datetime.timedelta(hours=24))
+        compacted = [(self._at(-30), self._at(-27)), (self._at(-26), self._at(-2))]
+        self.assertEqual(self._periods(), compacted)
+        self.assertEqual(tracker.rebuild_periods(), tracker.RebuildStats(2, 0, 0, 0))
+        self.assertEqual(self._periods(), compacted)
+        self.assertFalse(tracker.has_ongoing_period(self.user))
+
+    def test_dry_run(self):
+        self._period(9, 10)
+        self._period(10, 11)
+        stdout = io.StringIO()
+        call_command('compact-periods', dry_run=True, stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue(),
+            'Would compact 1 users: 1 periods updated, 1 merged away, 0 on-going ended\n'
+        )
+        self.assertEqual(len(self._periods()), 2)
 
 
 class TrackerViewsTestCase(django.test.TestCase):
@@ -74,6 +529,33 @@ class TrackerViewsTestCase(django.test.TestCase):
         self.factory = django.test.RequestFactory()
         self.user = auth.models.User.objects.create_user('username')
 
+    def _index_queries(self):
+        cache.clear()
+        tracker.start_period(self.user)
+        client = django.test.Client()
+        client.force_login(self.user)
+        client.get(reverse('index'))
+        with CaptureQueriesContext(connection) as queries:
+            client.get(reverse('index'))
+        return [query['sql'] for query in queries]
+
+    def test_index_queries(self):
+        """The index page tells whether there's an on-going Period from the recent ones"""
+        queries = self._index_queries()
+        # The session, the user and their recent Periods: one fewer than
+        # checking for an on-going Period separately took before.
+        self.assertEqual(len(queries), 3)
+        self.assertFalse(any('workaholic_trackerstate' in sql for sql in queries))
+
+    def test_index_ongoing_period(self):
+        client = django.test.Client()
+        client.force_login(self.user)
+        self.assertFalse(client.get(reverse('index')).context['has_ongoing_period'])
+        tracker.start_period(self.user)
+        self.assertTrue(client.get(reverse('index')).context['has_ongoing_period'])
+        tracker.end_ongoing_periods(self.user)
+        self.assertFalse(client.get(reverse('index')).context['has_ongoing_period'])
+
     def test_start(self):
         request = self.factory.post(reverse('start'))
         request.user = self.user
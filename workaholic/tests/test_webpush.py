@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import os
+import struct
+import unittest.mock
+
+import django.test
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from .. import webpush
+
+
+def _generate_key():
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+def _public_bytes(key):
+    return key.public_key().public_bytes(
+        serialization.Encoding.X962,
+        serialization.PublicFormat.UncompressedPoint
+    )
+
+
+class EncryptTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ua_private_key = _generate_key()
+        self.auth = os.urandom(16)
+        self.p256dh_key = webpush.b64_encode(_public_bytes(self.ua_private_key))
+        self.auth_secret = webpush.b64_encode(self.auth)
+
+    def _decrypt(self, body):
+        """Decrypts a message as the browser would (RFC 8291)"""
+        salt = body[:16]
+        record_size, key_length = struct.unpack('!LB', body[16:21])
+        as_public = body[21:21 + key_length]
+        ciphertext = body[21 + key_length:]
+        self.assertEqual(record_size, webpush.RECORD_SIZE)
+
+        as_public_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), as_public)
+        shared_secret = self.ua_private_key.exchange(ec.ECDH(), as_public_key)
+        ua_public = _public_bytes(self.ua_private_key)
+        ikm = webpush._hkdf(self.auth, b'WebPush: info\x00' + ua_public + as_public, 32, shared_secret)
+        key = webpush._hkdf(salt, b'Content-Encoding: aes128gcm\x00', 16, ikm)
+        nonce = webpush._hkdf(salt, b'Content-Encoding: nonce\x00', 12, ikm)
+        plaintext = AESGCM(key).decrypt(nonce, ciphertext, None)
+        self.assertEqual(plaintext[-1:], b'\x02')
+        return plaintext[:-1]
+
+    def test_round_trip(self):
+        body = webpush.encrypt(b'hello', self.p256dh_key, self.auth_secret)
+        self.assertEqual(self._decrypt(body), b'hello')
+
+    def test_each_message_has_its_own_key_and_salt(self):
+        body1 = webpush.encrypt(b'hello', self.p256dh_key, self.auth_secret)
+        body2 = webpush.encrypt(b'hello', self.p256dh_key, self.auth_secret)
+        self.assertNotEqual(body1[:16], body2[:16])
+        self.assertNotEqual(body1[21:86], body2[21:86])
+
+    def test_invalid_keys(self):
+        with self.assertRaises(webpush.BadKeyException):
+            webpush.validate_subscription_keys('not a key', self.auth_secret)
+        with self.assertRaises(webpush.BadKeyException):
+            webpush.validate_subscription_keys(self.p256dh_key, webpush.b64_encode(b'short'))
+
+
+class VapidTestCase(django.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.private_key = _generate_key()
+        private_value = self.private_key.private_numbers().private_value
+        self.settings_override = self.settings(
+            VAPID_PRIVATE_KEY=webpush.b64_encode(private_value.to_bytes(32, 'big'))
+        )
+        self.settings_override.enable()
+        webpush._vapid_headers.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        super().tearDown()
+
+    def test_public_key(self):
+        public_key = webpush.get_vapid_public_key()
+        self.assertEqual(webpush.b64_decode(public_key), _public_bytes(self.private_key))
+
+    def test_signed_jwt(self):
+        authorization = webpush.get_vapid_authorization('https://push.example.com/abc')
+        token = authorization.split(' ')[1][len('t='):].rstrip(',')
+        header, claims, signature = token.split('.')
+        self.assertEqual(json.loads(webpush.b64_decode(claims).decode('utf-8'))['aud'],
+            'https://push.example.com')
+        signature = webpush.b64_decode(signature)
+        der_signature = utils.encode_dss_signature(
+            int.from_bytes(signature[:32], 'big'), int.from_bytes(signature[32:], 'big')
+        )
+        # Raises if the signature is invalid.
+        self.private_key.public_key().verify(
+            der_signature,
+            ('%s.%s' % (header, claims)).encode('ascii'),
+            ec.ECDSA(hashes.SHA256())
+        )
+
+    def test_jwt_cached_per_origin(self):
+        with unittest.mock.patch.object(webpush, '_sign_vapid_jwt', return_value='jwt') as mocked:
+            webpush.get_vapid_authorization('https://push.example.com/abc')
+            webpush.get_vapid_authorization('https://push.example.com/def')
+            webpush.get_vapid_authorization('https://other.example.com/abc')
+        self.assertEqual(mocked.call_count, 2)
+
+    def test_no_key(self):
+        with self.settings(VAPID_PRIVATE_KEY=''):
+            self.assertEqual(webpush.get_vapid_public_key(), None)
+            self.assertEqual(webpush.get_vapid_authorization('https://push.example.com/'), None)
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import datetime
+
+import pytz
+
+
+def utc(*args):
+    """A UTC datetime, taking the same arguments as `datetime.datetime`"""
+    return datetime.datetime(*args, tzinfo=pytz.utc)
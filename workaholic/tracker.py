@@ -1,44 +1,609 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import base64
+import binascii
+import collections
+import datetime
+import itertools
 import logging
+import operator
 
-from django.utils import timezone
+from django.conf import settings
+from django.contrib import auth
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Q, Value, When
+from django.utils import dateparse, timezone
 
-from . import models
+from . import archive, models, rollups, scheduler
 
 logger = logging.getLogger(__name__)
 
+class BadCursorException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+ArchiveStats = collections.namedtuple('ArchiveStats', ['users', 'months', 'periods'])
+
+CompactStats = collections.namedtuple('CompactStats', ['users', 'updated', 'merged', 'ended'])
+
+RebuildStats = collections.namedtuple('RebuildStats', ['periods', 'created', 'updated', 'deleted'])
+
+# SQLite won't take more than 999 parameters in a statement.
+_MAX_STATEMENT_IDS = 500
+
+# Cached in place of a Period id when the user has no on-going Period, so that
+# it can be told apart from a cache miss.
+_NO_PERIOD = 0
+
+
+def _state_cache_key(user_id):
+    return 'tracker:current-period:%i' % user_id
+
+
+def _state_cached():
+    """Whether users' TrackerStates are cached (in a cache shared by all processes)"""
+    return settings.TRACKER_STATE_CACHE_TIMEOUT > 0
+
+
+def lock_state(user):
+    """Returns the user's TrackerState, locked until the transaction ends
+
+    Every write to a user's Periods takes this lock first, so that concurrent
+    start/end requests for the same user are applied one after the other.
+    A user's first TrackerState is pointed at their on-going Period, if any.
+    """
+    state, created = models.TrackerState.objects.select_for_update().get_or_create(user=user)
+    if created:
+        period = get_ongoing_periods(user).first()
+        if period is not None:
+            _set_current_period(state, period)
+    return state
+
+
+def _set_current_period(state, period):
+    """Point the (locked) TrackerState at `period` (or None)
+
+    The cached copy is dropped straight away, so that nothing in this
+    transaction reads it, and replaced once the transaction commits. Readers in
+    between fall back to the (old, committed) column, which is still correct
+    until we commit. They only `add()` what they read to the cache, so one which
+    finishes after we commit can't overwrite our value with the old one.
+    """
+    period_id = period.id if period is not None else None
+    if state.current_period_id != period_id:
+        state.current_period_id = period_id
+        state.save(update_fields=['current_period'])
+    if not _state_cached():
+        return
+    key = _state_cache_key(state.user_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.set(
+        key, period_id or _NO_PERIOD, settings.TRACKER_STATE_CACHE_TIMEOUT
+    ))
+
+
+def _end_ongoing_periods(state, end):
+    """Ends the (locked) user's on-going Periods, returning them
+
+    The TrackerState says whether there is one, so a user with nothing on-going
+    costs no queries. Otherwise it's read, then ended with a single UPDATE. As
+    the caller holds the user's lock, nothing can start or end a Period in
+    between.
+    """
+    if state.current_period_id is None:
+        return []
+    periods = list(models.Period.objects.filter(user_id=state.user_id, end=None))
+    if periods:
+        models.Period.objects.filter(id__in=[period.id for period in periods]).update(end=end)
+        for period in periods:
+            period.end = end
+    return periods
+
+
+def _pair_events(events):
+    """Pairs up one user's TrackerEvents (in order) into unsaved Periods
+
+    These are the rules `_project()` applies one event at a time: a start ends
+    any on-going Period and begins a new one, and an end ends any on-going
+    Period. Ends with nothing to end are ignored.
+    """
+    period = None
+    for event in events:
+        if period is not None:
+            period.end = event.timestamp
+            yield period
+            period = None
+        if event.kind == models.TrackerEvent.START:
+            period = models.Period(user_id=event.user_id, start=event.timestamp)
+    if period is not None:
+        yield period
+
+
+def _record(state, kind):
+    """Appends an event to the log for the (locked) user
+
+    The log is the source of truth, but the Periods aren't projected from it
+    asynchronously: the caller applies the event with `_project()` in the same
+    transaction. A tap is answered by a redirect to the index page (or, for
+    the API, is often followed within seconds by the opposite tap), which has
+    to show the Period it started or ended, and a start's reminder is
+    scheduled from the new Period. So the projection has to be visible as
+    soon as the tap commits. `_project()` only writes what the tap changed.
+    """
+    return models.TrackerEvent.objects.create(
+        user_id=state.user_id,
+        kind=kind,
+        timestamp=timezone.now()
+    )
+
+
+def _project(state, event):
+    """Applies the latest event in the log to the user's Periods
+
+    Only what the event changes is written: an end with nothing on-going
+    writes nothing, and a start with nothing on-going doesn't touch the
+    DailyTotals. Returns the Periods it ended and the Period it started (or
+    None).
+    """
+    ended = _end_ongoing_periods(state, event.timestamp)
+    if ended:
+        rollups.add_periods(ended)
+    period = None
+    if event.kind == models.TrackerEvent.START:
+        period = models.Period.objects.create(user_id=event.user_id, start=event.timestamp)
+    _set_current_period(state, period)
+    return ended, period
+
+
+def encode_cursor(period):
+    """Opaque cursor for a page of history which ends with `period`"""
+    position = '%s,%i' % (period.start.isoformat(), period.id)
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        start, id = position.split(',')
+        start, id = dateparse.parse_datetime(start), int(id)
+    except (binascii.Error, UnicodeError, ValueError):
+        start = None
+    if start is None:
+        raise BadCursorException('Invalid cursor')
+    return start, id
+
+
+def get_history(user, cursor=None, limit=None):
+    """A page of the user's Periods, most recently started first
+
+    Returns `(periods, cursor)`, where `cursor` gets the next page (or is None
+    if there are no more). Pages pick up from the (start, id) of the previous
+    page's last Period rather than using OFFSET, so each is a short scan of the
+    (user, start) index, however far back it is.
+    """
+    if limit is None:
+        limit = settings.HISTORY_PAGE_SIZE
+
+    periods = models.Period.objects.filter(user=user)
+    if cursor is not None:
+        start, id = _decode_cursor(cursor)
+        # `start__lte` bounds the index scan; the Q breaks ties on `start`.
+        periods = periods.filter(start__lte=start).filter(Q(start__lt=start) | Q(id__lt=id))
+    periods = list(periods.order_by('-start', '-id')[:limit + 1])
+    if len(periods) <= limit:
+        return periods, None
+    periods = periods[:limit]
+    return periods, encode_cursor(periods[-1])
+
+
+def get_overlapping_periods(user, start, end=None):
+    """The user's Periods which overlap [start, end), in (start, id) order
+
+    This includes the on-going Period if it started before `end`. It's one
+    query, whose cost depends on the number of results, not on how much
+    history the user has: Periods which started in the range are a range scan
+    of the (user, start) index. A user's Periods don't overlap (taps are
+    serialised by `lock_state()`, and imports and compaction check for it), so
+    at most one which started earlier can still be going at `start`: the last
+    one to start before it, which a subquery finds with one more index probe.
+    """
+    periods = models.Period.objects.filter(user=user)
+    latest_earlier = periods.filter(start__lt=start).order_by('-start', '-id').values('id')[:1]
+    within = Q(user=user, start__gte=start)
+    if end is not None:
+        within &= Q(start__lt=end)
+    return list(
+        models.Period.objects
+            .filter(within | Q(id__in=latest_earlier))
+            .filter(Q(end__gt=start) | Q(end=None))
+            .order_by('start', 'id')
+    )
+
 
 def get_ongoing_periods(user):
-    ongoing_qs = models.Period.objects.filter(end=None)
-    # There should be at most one Period in the QS. If something goes
-    # really wrong, we might end up with multiple. It'd be nice if
-    # we can add a constraint in the database to avoid this, but it
-    # isn't obvious how we could do that.
-    if ongoing_qs.count() > 1:
-        logger.warn('User %s has %i on-going periods.', user, ongoing_qs.count())
-    return ongoing_qs
+    # There is at most one Period in the QS. The partial unique index over
+    # on-going Periods' `user_id` enforces this, and makes this query cheap.
+    return models.Period.objects.filter(user=user, end=None)
+
+
+def get_current_period_id(user):
+    """Id of the user's on-going Period, or None
+
+    This is a primary key lookup of the user's TrackerState, which never has to
+    look at the Period table. With a shared cache (see `settings.SHARED_CACHE`)
+    it is answered from the cache where possible.
+    """
+    key = _state_cache_key(user.id)
+    period_id = cache.get(key) if _state_cached() else None
+    if period_id is None:
+        period_id = models.TrackerState.objects.filter(user=user).values_list(
+            'current_period_id', flat=True
+        ).first() or _NO_PERIOD
+        if _state_cached():
+            # Doesn't replace a value set by a write which committed meanwhile.
+            cache.add(key, period_id, settings.TRACKER_STATE_CACHE_TIMEOUT)
+    return period_id or None
 
 
 def has_ongoing_period(user):
-    return get_ongoing_periods(user).exists()
+    return get_current_period_id(user) is not None
 
 
+@transaction.atomic
 def end_ongoing_periods(user):
-    ongoing_periods = get_ongoing_periods(user)
-    for ongoing_period in ongoing_periods:
-        ongoing_period.end = timezone.now()
-        ongoing_period.save()
+    """Ends the user's on-going Period (if any) and returns what was ended"""
+    state = lock_state(user)
+    ended, _ = _project(state, _record(state, models.TrackerEvent.END))
+    if ended:
+        scheduler.clear(user)
+    return ended
 
 
+@transaction.atomic
 def start_period(user):
     # If the user already has an on-going period, end it now before starting a
     # new one. We do this because we probably missed the end of the previous
     # period. Recording them as two periods means the first can be edited to
     # have the correct end time.
-    end_ongoing_periods(user)
-    return models.Period.objects.create(
-        user=user,
-        start=timezone.now()
+    state = lock_state(user)
+    _, period = _project(state, _record(state, models.TrackerEvent.START))
+    scheduler.schedule(user, period.start)
+    return period
+
+
+def locked_batches(user_ids, batch_size):
+    """Yields `user_ids` in batches, each in a transaction holding their locks
+
+    This lets maintenance commands rewrite users' Periods and rollups while the
+    tracker keeps running.
+    """
+    if user_ids is None:
+        user_ids = auth.models.User.objects.order_by('id').values_list('id', flat=True)
+    if batch_size is None:
+        batch_size = settings.TRACKER_REBUILD_BATCH_SIZE
+
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        with transaction.atomic():
+            list(models.TrackerState.objects.select_for_update().filter(user_id__in=batch))
+            yield batch
+        logger.info('Processed %i of %i users', i + len(batch), len(user_ids))
+
+
+def _refresh_states(user_ids):
+    """Re-points the (locked) users' TrackerStates after rewriting their Periods
+
+    Returns the ids of the users who no longer have an on-going Period.
+    """
+    current = dict(
+        models.Period.objects
+            .filter(user_id__in=user_ids, end=None)
+            .values_list('user_id', 'id')
+    )
+    models.TrackerState.objects.filter(user_id__in=user_ids).delete()
+    models.TrackerState.objects.bulk_create(
+        models.TrackerState(user_id=user_id, current_period_id=current.get(user_id))
+        for user_id in user_ids
+    )
+    if _state_cached():
+        # As in `_set_current_period()`: drop the cached copies now, and
+        # replace them once we commit.
+        cached = {
+            _state_cache_key(user_id): current.get(user_id) or _NO_PERIOD
+            for user_id in user_ids
+        }
+        cache.delete_many(list(cached))
+        transaction.on_commit(lambda: cache.set_many(cached, settings.TRACKER_STATE_CACHE_TIMEOUT))
+    return [user_id for user_id in user_ids if user_id not in current]
+
+
+def _update_ends(ends):
+    """Sets the `end` of each Period in `ends`, a dict of `id => end`
+
+    This takes one UPDATE per `_MAX_STATEMENT_IDS // 3` Periods. Periods being
+    ended are updated before those being made on-going, so that no user has
+    two on-going Periods at once as far as the unique index is concerned.
+    """
+    ended = [(id, end) for id, end in ends.items() if end is not None]
+    # Three parameters per Period updated.
+    for i in range(0, len(ended), _MAX_STATEMENT_IDS // 3):
+        chunk = ended[i:i + _MAX_STATEMENT_IDS // 3]
+        models.Period.objects.filter(id__in=[id for id, _ in chunk]).update(end=Case(
+            *[
+                When(id=id, then=Value(end, output_field=DateTimeField()))
+                for id, end in chunk
+            ],
+            output_field=DateTimeField()
+        ))
+    ongoing = [id for id, end in ends.items() if end is None]
+    for i in range(0, len(ongoing), _MAX_STATEMENT_IDS):
+        models.Period.objects.filter(id__in=ongoing[i:i + _MAX_STATEMENT_IDS]).update(end=None)
+
+
+def _diff_periods(existing, rebuilt):
+    """Works out how to turn one user's Periods into the `rebuilt` ones
+
+    `existing` is a list of `(id, start, end)`, and `rebuilt` of unsaved
+    Periods. Existing Periods are matched to rebuilt ones by `start`, and kept
+    (with their ids) where they match. Returns `(ids to delete, dict of id =>
+    new end, Periods to create)`.
+    """
+    by_start = collections.defaultdict(list)
+    for id, start, end in existing:
+        by_start[start].append((id, end))
+    ends, created = {}, []
+    for period in rebuilt:
+        matches = by_start.get(period.start)
+        if not matches:
+            created.append(period)
+            continue
+        id, end = matches.pop(0)
+        if end != period.end:
+            ends[id] = period.end
+    deleted = [id for matches in by_start.values() for id, _ in matches]
+    return deleted, ends, created
+
+
+def rebuild_periods(user_ids=None, batch_size=None):
+    """Recomputes users' Periods (and TrackerState) by replaying their events
+
+    Users are rebuilt `batch_size` at a time, see `locked_batches()`. The
+    replayed Periods are compared with the stored ones, and only those which
+    differ are written, so unchanged Periods keep their ids (and history
+    cursors stay valid). Their DailyTotals are rebuilt to match. Reminders of
+    users left with nothing on-going are cancelled, but others aren't
+    rescheduled. Archived Periods are left alone: those replayed from
+    the log are dropped, but Periods which weren't archived (such as one
+    which was still on-going) are rebuilt even if they started in an archived
+    month.
+
+    Returns RebuildStats.
+    """
+    stats = RebuildStats(periods=0, created=0, updated=0, deleted=0)
+    for batch in locked_batches(user_ids, batch_size):
+        events = (
+            models.TrackerEvent.objects
+                .filter(user_id__in=batch, superseded=False)
+                .order_by('user_id', 'timestamp', 'id')
+                .iterator()
+        )
+        archived = collections.defaultdict(set)
+        for user_id, start, _ in archive.iter_periods(batch):
+            archived[user_id].add(start)
+        rebuilt = {}
+        for user_id, user_events in itertools.groupby(events, key=operator.attrgetter('user_id')):
+            rebuilt[user_id] = [
+                period for period in _pair_events(user_events)
+                if period.start not in archived[user_id]
+            ]
+
+        existing = collections.defaultdict(list)
+        periods = (
+            models.Period.objects
+                .filter(user_id__in=batch)
+                .values_list('user_id', 'id', 'start', 'end')
+                .iterator()
+        )
+        for user_id, id, start, end in periods:
+            existing[user_id].append((id, start, end))
+
+        deleted, ends, created = [], {}, []
+        for user_id in batch:
+            user_deleted, user_ends, user_created = _diff_periods(
+                existing.get(user_id, []), rebuilt.get(user_id, [])
+            )
+            deleted.extend(user_deleted)
+            ends.update(user_ends)
+            created.extend(user_created)
+        # Delete first, so that a deleted on-going Period can't clash with a
+        # new one in the unique index of on-going Periods.
+        for i in range(0, len(deleted), _MAX_STATEMENT_IDS):
+            models.Period.objects.filter(id__in=deleted[i:i + _MAX_STATEMENT_IDS]).delete()
+        _update_ends(ends)
+        models.Period.objects.bulk_create(created, batch_size=1000)
+
+        # An end tap only cancels a reminder if it ended something, so cancel
+        # those of users whose on-going Period the rebuild did away with.
+        scheduler.clear_users(_refresh_states(batch))
+        rollups.rebuild(batch)
+        stats = RebuildStats(
+            periods=stats.periods + sum(len(periods) for periods in rebuilt.values()),
+            created=stats.created + len(created),
+            updated=stats.updated + len(ends),
+            deleted=stats.deleted + len(deleted),
+        )
+    return stats
+
+
+def rebuild_daily_totals(user_ids=None, batch_size=None):
+    """Recomputes users' DailyTotals from their Periods
+
+    Users are rebuilt `batch_size` at a time, see `locked_batches()`. Returns
+    the number of DailyTotals written.
+    """
+    written = 0
+    for batch in locked_batches(user_ids, batch_size):
+        written += rollups.rebuild(batch)
+    return written
+
+
+def archive_periods(months=None, user_ids=None, batch_size=None, dry_run=False):
+    """Moves ended Periods from before the last `months` months into archives
+
+    Users are archived `batch_size` at a time, see `locked_batches()`. Their
+    DailyTotals keep counting the archived Periods. With `dry_run`, nothing is
+    changed. Returns ArchiveStats.
+    """
+    if months is None:
+        months = settings.ARCHIVE_AFTER_MONTHS
+    before = timezone.now().astimezone(timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
     )
+    for _ in range(months):
+        before = (before - datetime.timedelta(days=1)).replace(day=1)
+
+    stats = ArchiveStats(users=0, months=0, periods=0)
+    for batch in locked_batches(user_ids, batch_size):
+        archived = archive.archive_users(batch, before, dry_run)
+        stats = ArchiveStats(*(total + count for total, count in zip(stats, archived)))
+    return stats
+
+
+def _compact(periods, gap, close_after, now):
+    """Merges one user's `(id, start, end)` Periods (in start order)
+
+    Periods which overlap, or start within `gap` of the end of the one before,
+    are merged into the earlier one. An on-going Period followed by another is
+    ended when the next one starts, and (with `close_after`) one which has been
+    going for longer than that is ended `close_after` after it started.
+
+    Yields `(id, start, end, ended, merged_ids)` for each Period which needs
+    changing: its new end, whether an on-going Period was ended, and the
+    Periods merged into it (to be deleted).
+    """
+    def flush(current):
+        id, start, end, original_end, merged_ids = current
+        ended = False
+        if end is None and close_after is not None and start + close_after < now:
+            end = start + close_after
+        if original_end is None and end is not None:
+            ended = True
+        if end != original_end or merged_ids:
+            return id, start, end, ended, merged_ids
+
+    current = None
+    for id, start, end in periods:
+        if current is not None:
+            if current[2] is None:
+                current[2] = start
+            if start <= current[2] + gap:
+                current[2] = None if end is None else max(current[2], end)
+                current[4].append(id)
+                continue
+            change = flush(current)
+            if change is not None:
+                yield change
+        current = [id, start, end, end, []]
+    if current is not None:
+        change = flush(current)
+        if change is not None:
+            yield change
+
+
+def _supersede_events(changes):
+    """Records compacted Periods in the event log, so a rebuild keeps them
+
+    `changes` is a list of `(user_id, start, end)` for the compacted Periods.
+    The events between each one's start and end (which made up the Periods
+    merged into it) are marked superseded, and an end event is appended at
+    its end if there isn't one already.
+    """
+    # Three parameters per Period, as with `_update_ends()`.
+    for i in range(0, len(changes), _MAX_STATEMENT_IDS // 3):
+        chunk = changes[i:i + _MAX_STATEMENT_IDS // 3]
+        within = Q()
+        for user_id, start, end in chunk:
+            q = Q(user_id=user_id, timestamp__gt=start)
+            if end is not None:
+                q &= Q(timestamp__lt=end)
+            within |= q
+        models.TrackerEvent.objects.filter(within, superseded=False).update(superseded=True)
+
+        ended = [(user_id, end) for user_id, _, end in chunk if end is not None]
+        if not ended:
+            continue
+        logged = Q()
+        for user_id, end in ended:
+            logged |= Q(user_id=user_id, timestamp=end)
+        existing = set(
+            models.TrackerEvent.objects
+                .filter(logged, kind=models.TrackerEvent.END, superseded=False)
+                .values_list('user_id', 'timestamp')
+        )
+        models.TrackerEvent.objects.bulk_create(
+            models.TrackerEvent(user_id=user_id, kind=models.TrackerEvent.END, timestamp=end)
+            for user_id, end in ended
+            if (user_id, end) not in existing
+        )
+
+
+def compact_periods(gap=None, close_after=None, user_ids=None, batch_size=None, dry_run=False):
+    """Merges fragmented Periods and ends stray on-going ones, see `_compact()`
+
+    Each user's Periods are streamed in start order. Changes are applied a
+    batch of users at a time (see `locked_batches()`) with one UPDATE and one
+    DELETE per batch, and their DailyTotals and TrackerStates are recomputed.
+    Users whose on-going Period is ended won't be reminded to go home. With
+    `dry_run`, nothing is changed. The changes are recorded in the event log
+    (see `_supersede_events()`), so that `rebuild_periods()` keeps them.
+
+    Returns CompactStats.
+    """
+    if gap is None:
+        gap = settings.TRACKER_COMPACT_GAP
+    now = timezone.now()
+    stats = CompactStats(users=0, updated=0, merged=0, ended=0)
+
+    for batch in locked_batches(user_ids, batch_size):
+        periods = (
+            models.Period.objects
+                .filter(user_id__in=batch)
+                .order_by('user_id', 'start', 'id')
+                .values_list('user_id', 'id', 'start', 'end')
+                .iterator()
+        )
+        ends, merged_ids, ended_users, changed_users = {}, [], set(), set()
+        changes = []
+        for user_id, user_periods in itertools.groupby(periods, key=operator.itemgetter(0)):
+            user_periods = (period[1:] for period in user_periods)
+            for id, start, end, ended, merged in _compact(user_periods, gap, close_after, now):
+                ends[id] = end
+                changes.append((user_id, start, end))
+                merged_ids.extend(merged)
+                changed_users.add(user_id)
+                if ended:
+                    ended_users.add(user_id)
+        stats = CompactStats(
+            users=stats.users + len(changed_users),
+            updated=stats.updated + len(ends),
+            merged=stats.merged + len(merged_ids),
+            ended=stats.ended + len(ended_users),
+        )
+        if dry_run or not changed_users:
+            continue
+
+        # Delete first, as a merged on-going Period would otherwise clash with
+        # the one it's merged into in the unique index of on-going Periods.
+        for i in range(0, len(merged_ids), _MAX_STATEMENT_IDS):
+            models.Period.objects.filter(id__in=merged_ids[i:i + _MAX_STATEMENT_IDS]).delete()
+        _update_ends(ends)
+        _supersede_events(changes)
+        changed_users = sorted(changed_users)
+        _refresh_states(changed_users)
+        rollups.rebuild(changed_users)
+        scheduler.clear_users(ended_users)
+    return stats
@@ -15,10 +15,17 @@ urlpatterns = [
 
     url(r'^push/subscribe/$', views.subscribe, name='subscribe'),
     url(r'^push/unsubscribe/$', views.unsubscribe, name='unsubscribe'),
+    url(r'^push/sync/$', views.sync_subscriptions, name='sync-subscriptions'),
 
     url(r'^tracker/start/$', views.tracker_start, name='start'),
     url(r'^tracker/end/$', views.tracker_start, name='end'),
 
+    url(r'^history/$', views.history, name='history'),
+    url(r'^periods/$', views.periods, name='periods'),
+    url(r'^reports/(day|week|month)/$', views.report, name='report'),
+    url(r'^export/periods\.(csv|jsonl)$', views.export, name='export'),
+    url(r'^import/periods\.(csv|jsonl)$', views.import_periods, name='import'),
+
     url(r'^api/tracker/start/([a-zA-Z0-9\-_:]+)/', views.api_tracker_start, name='api-start'),
     url(r'^api/tracker/end/([a-zA-Z0-9\-_:]+)/', views.api_tracker_end, name='api-end'),
 
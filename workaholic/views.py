@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import json
+
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.decorators import login_required
@@ -10,23 +12,28 @@ from django.shortcuts import redirect, render, resolve_url
 from django.utils.http import is_safe_url
 from django.views.decorators.http import require_http_methods
 
-from . import models, push, forms, tracker, api
+from . import models, push, forms, tracker, api, webpush, reports, exports, imports
 from .json import json_view
 
 
 @login_required
 def index(request):
-    recent_periods = models.Period.objects.filter(user=request.user).order_by('-id')[:10]
+    recent_periods, _ = tracker.get_history(request.user, limit=10)
+    # The on-going Period (if any) is always the latest to have started, as a
+    # start ends any on-going Period. So we needn't look up the TrackerState.
+    has_ongoing_period = bool(recent_periods) and recent_periods[0].end is None
 
     api_key = api.get_api_key_for_user(request.user)
     api_start_url = reverse('api-start', args=[api_key])
     api_end_url = reverse('api-end', args=[api_key])
 
     return render(request, 'main.html', dict(
-        has_ongoing_period=tracker.has_ongoing_period(request.user),
+        has_ongoing_period=has_ongoing_period,
         recent_periods=recent_periods,
         api_start_url=api_start_url,
         api_end_url=api_end_url,
+        vapid_public_key=webpush.get_vapid_public_key() or '',
+        push_subscription_version=settings.PUSH_SUBSCRIPTION_VERSION,
     ))
 
 
@@ -78,22 +85,60 @@ def signup(request):
     ))
 
 
+def _parse_subscription(identifier, keys=None):
+    """Validates a subscription from the browser
+
+    `keys` is the `keys` member of the browser's `PushSubscription.toJSON()`.
+    Only browsers that can receive payloads give us keys. Returns a tuple of
+    `(identifier, p256dh_key, auth_secret)`.
+    """
+    keys = keys or {}
+    p256dh_key = keys.get('p256dh', '')
+    auth_secret = keys.get('auth', '')
+    identifier = push.normalize_identifier(identifier)
+    if p256dh_key or auth_secret:
+        webpush.validate_subscription_keys(p256dh_key, auth_secret)
+    return identifier, p256dh_key, auth_secret
+
+
 @login_required
 @json_view(['identifier'])
 @require_http_methods(['POST'])
-def subscribe(request, identifier):
+def subscribe(request, identifier, keys=None):
     try:
-        identifier = push.normalize_identifier(identifier)
-    except push.BadIdentifierException as e:
+        subscription = _parse_subscription(identifier, keys)
+    except (push.BadIdentifierException, webpush.BadKeyException) as e:
         return http.HttpResponseBadRequest, dict(success=False, error=e.msg)
     # Be nice and allow the client app to tell us about the same
     # subscription more than once.
-    models.PushSubscription.objects.get_or_create(
-        user=request.user, identifier=identifier
-    )
+    push.upsert_subscription(request.user, *subscription)
     return dict(success=True)
 
 
+@login_required
+@json_view(['subscriptions'])
+@require_http_methods(['POST'])
+def sync_subscriptions(request, subscriptions):
+    """Replaces all of the user's subscriptions with `subscriptions`
+
+    Each item is an object with an `identifier` and optional `keys`, like
+    the body of a request to `subscribe`.
+    """
+    try:
+        parsed = [
+            _parse_subscription(subscription['identifier'], subscription.get('keys'))
+            for subscription in subscriptions
+        ]
+    except (TypeError, KeyError, AttributeError):
+        return http.HttpResponseBadRequest, dict(
+            success=False, error='Expected a list of subscriptions with identifiers'
+        )
+    except (push.BadIdentifierException, webpush.BadKeyException) as e:
+        return http.HttpResponseBadRequest, dict(success=False, error=e.msg)
+    changed, removed = push.sync_subscriptions(request.user, parsed)
+    return dict(success=True, changed=changed, removed=removed)
+
+
 @login_required
 @json_view(['identifier'])
 @require_http_methods(['POST'])
@@ -124,6 +169,139 @@ def tracker_end(request):
     return redirect('index')
 
 
+def _serialize_period(period):
+    return dict(
+        id=period.id,
+        start=period.start.isoformat(),
+        end=period.end.isoformat() if period.end is not None else None,
+    )
+
+
+@login_required
+@json_view()
+@require_http_methods(['GET'])
+def history(request):
+    """A page of the user's periods, most recently started first
+
+    Pass the `next` cursor from a response as `cursor` to get the page after
+    it. Takes an optional `limit`.
+    """
+    try:
+        limit = int(request.GET.get('limit', settings.HISTORY_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= settings.HISTORY_MAX_PAGE_SIZE:
+        return http.HttpResponseBadRequest, dict(
+            success=False,
+            error='Expected a limit between 1 and %i' % settings.HISTORY_MAX_PAGE_SIZE
+        )
+    try:
+        periods, cursor = tracker.get_history(request.user, request.GET.get('cursor'), limit)
+    except tracker.BadCursorException as e:
+        return http.HttpResponseBadRequest, dict(success=False, error=e.msg)
+    return dict(
+        success=True,
+        periods=[_serialize_period(period) for period in periods],
+        next=cursor,
+    )
+
+
+@login_required
+@json_view()
+@require_http_methods(['GET'])
+def periods(request):
+    """The user's periods which overlap a range of dates
+
+    Takes `from` (required) and `to` (exclusive) dates (YYYY-MM-DD) and an
+    optional `tz`. On-going periods are included.
+    """
+    try:
+        tz = reports.get_timezone(request.GET.get('tz', settings.TIME_ZONE))
+        start_date = reports.parse_date(request.GET.get('from'))
+        end_date = reports.parse_date(request.GET.get('to'))
+    except reports.BadReportException as e:
+        return http.HttpResponseBadRequest, dict(success=False, error=e.msg)
+    if start_date is None:
+        return http.HttpResponseBadRequest, dict(success=False, error='Missing parameter: from')
+
+    start = reports.local_midnight(start_date, tz)
+    end = reports.local_midnight(end_date, tz) if end_date is not None else None
+    overlapping = tracker.get_overlapping_periods(request.user, start, end)
+    return dict(success=True, periods=[_serialize_period(period) for period in overlapping])
+
+
+@login_required
+@json_view()
+@require_http_methods(['GET'])
+def report(request, interval):
+    """Hours worked in each day, week or month
+
+    Takes optional `tz` (defaults to UTC), `from` and `to` (YYYY-MM-DD, `to`
+    is exclusive) query parameters.
+    """
+    try:
+        tz = reports.get_timezone(request.GET.get('tz', settings.TIME_ZONE))
+        start_date = reports.parse_date(request.GET.get('from'))
+        end_date = reports.parse_date(request.GET.get('to'))
+        hours = reports.worked_hours(request.user, interval, tz, start_date, end_date)
+    except reports.BadReportException as e:
+        return http.HttpResponseBadRequest, dict(success=False, error=e.msg)
+    return dict(
+        success=True,
+        interval=interval,
+        tz=tz.zone,
+        hours=[dict(date=date.isoformat(), hours=total) for date, total in hours],
+    )
+
+
+@login_required
+@require_http_methods(['GET'])
+def export(request, format):
+    """Streams all of the user's periods as CSV or JSONL
+
+    Takes the same `tz`, `from` and `to` query parameters as `report`.
+    Archived periods are included, without an `id`.
+    """
+    try:
+        tz = reports.get_timezone(request.GET.get('tz', settings.TIME_ZONE))
+        start_date = reports.parse_date(request.GET.get('from'))
+        end_date = reports.parse_date(request.GET.get('to'))
+    except reports.BadReportException as e:
+        return http.HttpResponseBadRequest(json.dumps(dict(success=False, error=e.msg)))
+
+    periods = exports.iter_user_periods(request.user.id, tz, start_date, end_date)
+    lines = exports.serialize(periods, ['id', 'start', 'end'], format, tz)
+    resp = http.StreamingHttpResponse(lines, content_type=exports.CONTENT_TYPES[format])
+    resp['Content-Disposition'] = 'attachment; filename="periods.%s"' % format
+    return resp
+
+
+@login_required
+@json_view()
+@require_http_methods(['POST'])
+def import_periods(request, format):
+    """Imports ended periods from a CSV or JSONL request body
+
+    Each row needs a `start` and `end` in ISO 8601. Times without an offset
+    are taken to be in the `tz` query parameter. With `dry_run=1`, the rows
+    are checked but nothing is saved.
+    """
+    try:
+        tz = reports.get_timezone(request.GET.get('tz', settings.TIME_ZONE))
+    except reports.BadReportException as e:
+        return http.HttpResponseBadRequest, dict(success=False, error=e.msg)
+    rows = imports.parse(imports.decode(request), format)
+    stats = imports.import_periods(
+        request.user, rows, tz, dry_run=request.GET.get('dry_run') == '1'
+    )
+    return dict(
+        success=True,
+        imported=stats.imported,
+        rejected=stats.rejected,
+        errors=[dict(line=line, error=error) for line, error in stats.errors],
+    )
+
+
 @api.endpoint()
 def api_tracker_start(request):
     tracker.start_period(request.user)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Message encryption (RFC 8291) and VAPID authentication (RFC 8292) for Web Push
+
+Push services only deliver payloads which have been encrypted for the
+browser that subscribed, using the `p256dh` public key and `auth` secret it
+gave us. VAPID lets us identify ourselves to push services by signing a
+short-lived JWT.
+"""
+
+import base64
+import functools
+import json
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+from django.conf import settings
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+class BadKeyException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# We always send a single record, so this only needs to be bigger than our
+# payloads. 4096 is the value recommended by RFC 8291.
+RECORD_SIZE = 4096
+
+# How long the VAPID JWTs we sign are valid for. RFC 8292 says no more than
+# 24 hours. We sign a new one once less than `VAPID_REFRESH` is left.
+VAPID_EXPIRY = 12 * 60 * 60
+VAPID_REFRESH = 60 * 60
+
+
+def b64_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64_decode(string):
+    string = string.encode('ascii') if isinstance(string, str) else string
+    return base64.urlsafe_b64decode(string + b'=' * (-len(string) % 4))
+
+
+def _hkdf(salt, info, length, key_material):
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=length,
+        salt=salt,
+        info=info,
+        backend=default_backend(),
+    ).derive(key_material)
+
+
+def _public_bytes(key):
+    return key.public_bytes(
+        serialization.Encoding.X962,
+        serialization.PublicFormat.UncompressedPoint
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _load_subscription_keys(p256dh_key, auth_secret):
+    """Decodes and validates a subscription's keys
+
+    Loading the public key checks that the point is on the curve, which is
+    the expensive part. Subscriptions' keys don't change, so we cache this
+    across all of the messages we send to the subscription.
+    """
+    try:
+        public_bytes = b64_decode(p256dh_key)
+        public_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), public_bytes)
+        auth_bytes = b64_decode(auth_secret)
+    except (ValueError, TypeError):
+        raise BadKeyException('Invalid push subscription keys')
+    if len(auth_bytes) != 16:
+        raise BadKeyException('Invalid push subscription auth secret')
+    return public_key, public_bytes, auth_bytes
+
+
+def validate_subscription_keys(p256dh_key, auth_secret):
+    """Raises `BadKeyException` if the keys a browser gave us aren't usable"""
+    _load_subscription_keys(p256dh_key, auth_secret)
+
+
+def encrypt(payload, p256dh_key, auth_secret):
+    """Encrypts `payload` (bytes) for a subscription, using `aes128gcm`
+
+    Returns the body to send to the push service. Each message gets its own
+    ephemeral key pair and salt, as RFC 8291 requires.
+    """
+    ua_public_key, ua_public, auth = _load_subscription_keys(p256dh_key, auth_secret)
+
+    as_private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    as_public = _public_bytes(as_private_key.public_key())
+    shared_secret = as_private_key.exchange(ec.ECDH(), ua_public_key)
+
+    ikm = _hkdf(auth, b'WebPush: info\x00' + ua_public + as_public, 32, shared_secret)
+    salt = os.urandom(16)
+    key = _hkdf(salt, b'Content-Encoding: aes128gcm\x00', 16, ikm)
+    nonce = _hkdf(salt, b'Content-Encoding: nonce\x00', 12, ikm)
+
+    # A single record, so it's the last record: pad with the 0x02 delimiter.
+    ciphertext = AESGCM(key).encrypt(nonce, payload + b'\x02', None)
+    header = salt + struct.pack('!LB', RECORD_SIZE, len(as_public)) + as_public
+    return header + ciphertext
+
+
+@functools.lru_cache(maxsize=None)
+def _load_vapid_key(private_key):
+    private_value = int.from_bytes(b64_decode(private_key), 'big')
+    return ec.derive_private_key(private_value, ec.SECP256R1(), default_backend())
+
+
+def get_vapid_public_key():
+    """Returns our VAPID public key, for browsers' `applicationServerKey`
+
+    Returns None if `settings.VAPID_PRIVATE_KEY` isn't set.
+    """
+    if not settings.VAPID_PRIVATE_KEY:
+        return None
+    return b64_encode(_public_bytes(_load_vapid_key(settings.VAPID_PRIVATE_KEY).public_key()))
+
+
+_vapid_headers = {}
+_vapid_headers_lock = threading.Lock()
+
+
+def _sign_vapid_jwt(private_key, audience, expires):
+    header = b64_encode(json.dumps(dict(typ='JWT', alg='ES256')).encode('utf-8'))
+    claims = b64_encode(json.dumps(dict(
+        aud=audience,
+        exp=expires,
+        sub=settings.VAPID_SUBJECT,
+    )).encode('utf-8'))
+    signing_input = ('%s.%s' % (header, claims)).encode('ascii')
+    der_signature = private_key.sign(signing_input, ec.ECDSA(hashes.SHA256()))
+    r, s = utils.decode_dss_signature(der_signature)
+    signature = r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+    return '%s.%s' % (signing_input.decode('ascii'), b64_encode(signature))
+
+
+def get_vapid_authorization(endpoint):
+    """Returns the `Authorization` header to send with a request to `endpoint`
+
+    The JWT only depends on the push service's origin, so we sign one per
+    origin and re-use it until it's close to expiring, rather than signing
+    one per message. Returns None if `settings.VAPID_PRIVATE_KEY` isn't set.
+    """
+    if not settings.VAPID_PRIVATE_KEY:
+        return None
+    parts = urllib.parse.urlsplit(endpoint)
+    audience = '%s://%s' % (parts.scheme, parts.netloc)
+    now = int(time.time())
+    with _vapid_headers_lock:
+        cached = _vapid_headers.get(audience)
+        if cached is not None and cached[1] - now > VAPID_REFRESH:
+            return cached[0]
+        private_key = _load_vapid_key(settings.VAPID_PRIVATE_KEY)
+        expires = now + VAPID_EXPIRY
+        header = 'vapid t=%s, k=%s' % (
+            _sign_vapid_jwt(private_key, audience, expires), get_vapid_public_key()
+        )
+        _vapid_headers[audience] = (header, expires)
+        return header